@@ -14,3 +14,10 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'binance_bot.settings')
 
 application = get_asgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.TELEGRAM_WEBHOOK_URL:
+    from bot.webhook import BotApplication  # noqa: E402
+
+    application = BotApplication(application)
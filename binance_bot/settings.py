@@ -81,7 +81,7 @@ WSGI_APPLICATION = 'binance_bot.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': env('DATABASE_PATH', default=str(BASE_DIR / 'db.sqlite3')),
     }
 }
 
@@ -127,3 +127,77 @@ STATIC_URL = '/static/'
 # Telegram
 TELEGRAM_BOT_TOKEN = env('TELEGRAM_BOT_TOKEN')
 # TELEGRAM_PROXY_URL = 'https://telegg.ru/orig/bot'
+# Bot API base URL, token excluded (e.g. 'https://api.telegram.org/bot')
+TELEGRAM_API_URL = env('TELEGRAM_API_URL', default=None)
+# Public base URL; when set, the ASGI app receives updates via webhook
+TELEGRAM_WEBHOOK_URL = env('TELEGRAM_WEBHOOK_URL', default=None)
+TELEGRAM_WEBHOOK_SECRET = env('TELEGRAM_WEBHOOK_SECRET', default=None)
+
+# Binance
+BINANCE_API_URL = env('BINANCE_API_URL', default='https://api.binance.com')
+BINANCE_STREAM_URL = env(
+    'BINANCE_STREAM_URL', default='wss://stream.binance.com:9443/stream')
+# Request weight per minute and IP
+BOT_REST_WEIGHT_LIMIT = env.int('BOT_REST_WEIGHT_LIMIT', default=6000)
+
+# Credential vault: Fernet master keys, the first one seals new values
+# (`python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"`)
+BOT_VAULT_KEYS = env.list('BOT_VAULT_KEYS', default=[])
+BOT_VAULT_CACHE_SIZE = env.int('BOT_VAULT_CACHE_SIZE', default=10000)
+BOT_VAULT_CACHE_TTL = env.int('BOT_VAULT_CACHE_TTL', default=60 * 60)  # s
+
+# Bot start-up
+BOT_WARMUP_RATE = env.float('BOT_WARMUP_RATE', default=50)  # accounts/s
+BOT_WARMUP_CHUNK_SIZE = env.int('BOT_WARMUP_CHUNK_SIZE', default=500)
+BOT_ACTIVATION_CONCURRENCY = env.int('BOT_ACTIVATION_CONCURRENCY', default=20)
+
+# User data event journal (SQLite, one file per shard)
+BOT_JOURNAL_PATH = env(
+    'BOT_JOURNAL_PATH', default=str(BASE_DIR / 'journal' / 'events.sqlite3'))
+BOT_JOURNAL_RETENTION = env.int('BOT_JOURNAL_RETENTION', default=48)  # hours
+
+# Running accounts saved for a restart to resume (JSON, one file per shard)
+BOT_CHECKPOINT_PATH = env(
+    'BOT_CHECKPOINT_PATH',
+    default=str(BASE_DIR / 'journal' / 'checkpoint.json'))
+BOT_CHECKPOINT_INTERVAL = env.int('BOT_CHECKPOINT_INTERVAL', default=30)  # s
+BOT_RESUME_RATE = env.float('BOT_RESUME_RATE', default=500)  # accounts/s
+# Seconds frames are held for the previous process to exit
+BOT_HANDOVER_TIMEOUT = env.int('BOT_HANDOVER_TIMEOUT', default=120)
+
+# Live state of the running bot for the admin dashboard (SQLite, shared by
+# all processes; empty disables the export)
+BOT_STATUS_PATH = env(
+    'BOT_STATUS_PATH', default=str(BASE_DIR / 'journal' / 'status.sqlite3'))
+BOT_STATUS_INTERVAL = env.int('BOT_STATUS_INTERVAL', default=5)  # s
+
+# Messages: `bot/locales/<locale>.json`; chats get the Telegram language
+# of whoever starts them when there is a table for it
+BOT_DEFAULT_LOCALE = env('BOT_DEFAULT_LOCALE', default='ru')
+
+# Observability
+BOT_METRICS_PORT = env.int('BOT_METRICS_PORT', default=0)  # 0 disables
+BOT_LOG_FORMAT = env('BOT_LOG_FORMAT', default='json')  # or 'text'
+BOT_LOG_LEVEL = env('BOT_LOG_LEVEL', default='INFO')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'bot.log.JsonFormatter'},
+        'text': {'format': '%(asctime)s %(levelname)s %(name)s %(message)s'},
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': BOT_LOG_FORMAT,
+        },
+    },
+    'loggers': {
+        'bot': {
+            'handlers': ['console'],
+            'level': BOT_LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}
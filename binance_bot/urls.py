@@ -16,6 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from bot import views
+
 urlpatterns = [
+    path(
+        'admin/bot/status/', admin.site.admin_view(views.status),
+        name='bot-status'),
     path('admin/', admin.site.urls),
 ]
@@ -1,8 +1,20 @@
 from django.contrib import admin
 
-from .models import Profile
+from .models import Alert, LinkedAccount, Profile
 
 
 @admin.register(Profile)
 class ProfileAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(Alert)
+class AlertAdmin(admin.ModelAdmin):
+    list_display = ('telegram_chat_id', 'symbol', 'kind', 'value', 'active')
+    list_filter = ('active', 'kind')
+
+
+@admin.register(LinkedAccount)
+class LinkedAccountAdmin(admin.ModelAdmin):
+    list_display = ('telegram_chat_id', 'label', 'created')
+    search_fields = ('telegram_chat_id', 'label')
@@ -0,0 +1,217 @@
+import asyncio
+from array import array
+from bisect import bisect_left, bisect_right
+
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+
+from . import messages
+
+# `Alert.kind`
+ABOVE, BELOW, MOVE, SPREAD = 'above', 'below', 'move', 'spread'
+MAX_ALERTS_PER_CHAT = 20
+
+
+def alert_values(alert):
+    return {
+        'pk': alert.pk, 'symbol': alert.symbol, 'kind': alert.kind,
+        'value': alert.value, 'reference': alert.reference,
+    }
+
+
+# chat id -> active alerts, for the chats of one warm-up chunk
+def load_alerts(chat_ids):
+    from .models import Alert
+    alerts = {}
+    for alert in Alert.objects.filter(
+            telegram_chat_id__in=chat_ids, active=True).order_by('pk'):
+        alerts.setdefault(alert.telegram_chat_id, []).append(
+            alert_values(alert))
+    return {chat_id: tuple(values) for chat_id, values in alerts.items()}
+
+
+class AlertRule:
+    __slots__ = (
+        'pk', 'chat_id', 'symbol', 'kind', 'value', 'reference', 'callback')
+
+    def __init__(self, chat_id, callback, pk, symbol, kind, value,
+                 reference=None):
+        self.pk = pk
+        self.chat_id = chat_id
+        self.symbol = symbol.upper()
+        self.kind = kind
+        self.value = value
+        self.reference = reference
+        self.callback = callback
+
+    @property
+    def armed(self):
+        return self.kind != MOVE or self.reference is not None
+
+    # (fires on the way up, trigger price) pairs
+    def triggers(self):
+        if self.kind == ABOVE:
+            return [(True, self.value)]
+        if self.kind == BELOW:
+            return [(False, self.value)]
+        move = self.reference * self.value / 100
+        return [(True, self.reference + move), (False, self.reference - move)]
+
+    def describe(self, price, locale=None):
+        change = None
+        if self.kind == MOVE:
+            change = (price - self.reference) / self.reference * 100
+        return messages.text(
+            f'alert.{self.kind}', locale, symbol=self.symbol, price=price,
+            value=self.value, reference=self.reference, change=change)
+
+    def __repr__(self):
+        return f'<AlertRule {self.pk} {self.symbol} {self.kind} {self.value}>'
+
+
+# Every alert of one symbol, indexed by trigger price: rules firing on the
+# way up and on the way down sit in two ascending price columns, so the
+# alerts crossed by a batch of ticks are a prefix and a suffix found by
+# bisect, whatever the number of rules.
+class AlertIndex:
+    def __init__(self):
+        self.rules = {}
+        self.unarmed = []
+        self.sides = {
+            True: (array('d'), []),
+            False: (array('d'), []),
+        }
+
+    def __len__(self):
+        return len(self.rules)
+
+    def add(self, rule):
+        self.rules[rule.pk] = rule
+        if rule.armed:
+            self.insert(rule)
+        else:
+            self.unarmed.append(rule)
+
+    def insert(self, rule):
+        for up, price in rule.triggers():
+            prices, rules = self.sides[up]
+            index = bisect_right(prices, price)
+            prices.insert(index, price)
+            rules.insert(index, rule)
+
+    def discard(self, rule):
+        for up, price in rule.triggers():
+            prices, rules = self.sides[up]
+            for index in range(bisect_left(prices, price),
+                               bisect_right(prices, price)):
+                if rules[index] is rule:
+                    del prices[index]
+                    del rules[index]
+                    break
+
+    def remove(self, rule):
+        if self.rules.pop(rule.pk, None) is None:
+            return
+        if rule in self.unarmed:
+            self.unarmed.remove(rule)
+        else:
+            self.discard(rule)
+
+    # Percent-move rules measure from the first trade after creation
+    def arm(self, price):
+        if price is None:
+            return []
+        armed, self.unarmed = self.unarmed, []
+        for rule in armed:
+            rule.reference = price
+            self.insert(rule)
+        return armed
+
+    # (rule, price) for every rule crossed by prices in [low, high]
+    def crossed(self, low, high):
+        prices, rules = self.sides[True]
+        count = bisect_right(prices, high)
+        fired = [(rule, high) for rule in rules[:count]]
+        del prices[:count], rules[:count]
+        prices, rules = self.sides[False]
+        start = bisect_left(prices, low)
+        fired += [(rule, low) for rule in rules[start:]]
+        del prices[start:], rules[start:]
+        result = []
+        for rule, price in fired:
+            if self.rules.pop(rule.pk, None) is None:
+                continue  # a percent move crossed both ways at once
+            if rule.kind == MOVE:
+                self.discard(rule)
+            result.append((rule, price))
+        return result
+
+
+# Keeps the rules of every chat on this process in sync with the `alerts`
+# carried by its profile, and delivers and deactivates them once fired.
+# A fired alert is not re-armed by profiles that still list it; it is
+# forgotten once a profile without it arrives.
+class AlertEngine:
+    # `on_fired(chat_id, pk)` reports a fired alert to whoever keeps the
+    # chat's profile, when that is another process
+    on_fired = None
+
+    def __init__(self, market):
+        self.market = market
+        self.market.on_armed = self.save_references
+        self.chats = {}
+        self.bots = {}
+        # chat id -> pks of fired alerts its profile may still list
+        self.fired = {}
+
+    def __len__(self):
+        return sum(len(rules) for rules in self.chats.values())
+
+    def sync(self, chat_id, alerts, bot):
+        self.bots[chat_id] = bot
+        fired = self.fired.get(chat_id)
+        if fired:
+            fired &= {alert['pk'] for alert in alerts}
+            if not fired:
+                del self.fired[chat_id]
+        rules = self.chats.setdefault(chat_id, {})
+        wanted = {
+            alert['pk']: alert for alert in alerts
+            if alert['pk'] not in (fired or ())}
+        for pk in [*rules]:
+            if pk not in wanted:
+                self.market.remove_alert(rules.pop(pk))
+        for pk, alert in wanted.items():
+            if pk not in rules:
+                rules[pk] = AlertRule(chat_id, self.fire, **alert)
+                self.market.add_alert(rules[pk])
+        if not rules:
+            del self.chats[chat_id]
+            del self.bots[chat_id]
+
+    # `price` is the trade price that crossed the rule, or the order book
+    # spread for spread rules
+    def fire(self, rule, price):
+        self.fired.setdefault(rule.chat_id, set()).add(rule.pk)
+        self.chats.get(rule.chat_id, {}).pop(rule.pk, None)
+        bot = self.bots.get(rule.chat_id)
+        if bot:
+            text = rule.describe(price, bot.locale(rule.chat_id))
+            bot.outbox.send(rule.chat_id, f"🔔 {text}")
+            bot.forget_alert(rule.chat_id, rule.pk)
+        if self.on_fired:
+            self.on_fired(rule.chat_id, rule.pk)
+        asyncio.create_task(self.deactivate(rule.pk))
+
+    async def deactivate(self, pk):
+        from .models import Alert
+        await sync_to_async(Alert.objects.filter(pk=pk).update)(
+            active=False, triggered=timezone.now())
+
+    def save_references(self, rules):
+        asyncio.create_task(sync_to_async(self.write_references)(rules))
+
+    def write_references(self, rules):
+        from .models import Alert
+        for rule in rules:
+            Alert.objects.filter(pk=rule.pk).update(reference=rule.reference)
@@ -0,0 +1,151 @@
+import asyncio
+import itertools
+import json
+import re
+import secrets
+import time
+
+from aiohttp import web, WSMsgType
+
+BENCH_MARK = re.compile(r'bench-(\d+)')
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return {f'p{point}': None for point in points}
+    values = sorted(values)
+    return {
+        f'p{point}': values[min(len(values) - 1, len(values) * point // 100)]
+        for point in points}
+
+
+# Stand-in for the Binance REST userDataStream endpoint and the combined
+# stream websocket; emits executionReport events at a configurable rate
+class FakeBinance:
+    def __init__(self):
+        self.listen_keys = {}
+        self.sockets = {}
+        self.subscribed = {}
+        self.sent = 0
+        self.order_ids = itertools.count(1)
+        self.app = web.Application()
+        self.app.router.add_post('/api/v3/userDataStream', self.create_key)
+        self.app.router.add_put('/api/v3/userDataStream', self.keep_alive)
+        self.app.router.add_get('/stream', self.stream)
+
+    async def create_key(self, request):
+        api_key = request.headers.get('X-MBX-APIKEY', '')
+        listen_key = self.listen_keys.setdefault(
+            api_key, secrets.token_hex(16))
+        return web.json_response({'listenKey': listen_key})
+
+    async def keep_alive(self, request):
+        return web.json_response({})
+
+    async def stream(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets[ws] = set()
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                command = json.loads(msg.data)
+                streams = self.sockets[ws]
+                for stream in command['params']:
+                    if command['method'] == 'SUBSCRIBE':
+                        streams.add(stream)
+                        self.subscribed[stream] = ws
+                    elif self.subscribed.get(stream) is ws:
+                        streams.discard(stream)
+                        del self.subscribed[stream]
+                await ws.send_json({'result': None, 'id': command['id']})
+        finally:
+            for stream in self.sockets.pop(ws):
+                if self.subscribed.get(stream) is ws:
+                    del self.subscribed[stream]
+        return ws
+
+    def frame(self, stream):
+        return json.dumps({'stream': stream, 'data': {
+            'e': 'executionReport',
+            'E': int(time.time() * 1000),
+            's': 'BTCUSDT',
+            'c': f'bench-{time.time_ns()}',
+            'S': 'BUY',
+            'o': 'LIMIT',
+            'q': '0.001',
+            'p': '30000',
+            'x': 'TRADE',
+            'X': 'FILLED',
+            'i': next(self.order_ids),
+        }})
+
+    async def emit(self, rate, duration):
+        if not self.subscribed:
+            return
+        tick = .01
+        streams = itertools.cycle([*self.subscribed])
+        started = time.monotonic()
+        due = 0
+        while time.monotonic() - started < duration:
+            due += rate * tick
+            while due >= 1:
+                due -= 1
+                stream = next(streams)
+                ws = self.subscribed.get(stream)
+                if ws is not None and not ws.closed:
+                    await ws.send_str(self.frame(stream))
+                    self.sent += 1
+            await asyncio.sleep(tick)
+
+
+# Stand-in for the Telegram Bot API; measures event-to-notification latency
+# from the timestamps the fake Binance puts into client order ids
+class FakeTelegram:
+    def __init__(self):
+        self.messages = 0
+        self.latencies = []
+        self.polled = asyncio.Event()
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.method)
+
+    async def payload(self, request):
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post())
+
+    async def method(self, request):
+        method = request.match_info['method']
+        data = await self.payload(request)
+        if method == 'getMe':
+            return self.ok({
+                'id': 1, 'is_bot': True,
+                'first_name': 'Bench', 'username': 'bench_bot'})
+        if method == 'getUpdates':
+            self.polled.set()
+            await asyncio.sleep(min(float(data.get('timeout') or 0), 1))
+            return self.ok([])
+        if method == 'sendMessage':
+            received = time.time_ns()
+            self.messages += 1
+            self.latencies += [
+                (received - int(sent)) / 1e6
+                for sent in BENCH_MARK.findall(data.get('text', ''))]
+            return self.ok({
+                'message_id': self.messages, 'date': int(time.time()),
+                'chat': {'id': int(data.get('chat_id', 0)), 'type': 'private'},
+                'text': data.get('text', '')})
+        return self.ok(True)
+
+    def ok(self, result):
+        return web.json_response({'ok': True, 'result': result})
+
+
+async def serve(app, host='127.0.0.1', port=0):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://{host}:{port}'
@@ -1,118 +1,640 @@
 import asyncio
-import json
+import logging
+from collections import deque
+from functools import partial
 
-from .core import ConnectionManager
+from django.conf import settings
+
+from . import messages, status
+from .alerts import AlertEngine
+from .checkpoint import (
+    AccountState, Checkpointer, Checkpoints, wait_exited)
+from .delivery import COALESCE_WINDOW, RateLimiter, labelled
+from .events import (
+    accepts, account_position, decode, ListenKeyExpired, FILTER_ALL,
+    FILTER_DEFAULT, trade_report,
+)
+from .journal import EventJournal
+from .keepalive import KeepAliveScheduler
+from .market import MarketData
+from .metrics import (
+    ACCOUNTS, LISTEN_KEY_FAILURES, LISTEN_KEY_LATENCY, LISTEN_KEYS_RESUMED,
+    QUEUE_DEPTH, SUBSCRIPTIONS,
+)
+from .portfolio import Balances, PriceCache, format_portfolio
+from .rest import BinanceClient, BinanceError
+from .streams import StreamMultiplexer
+from .vault import get_vault, VaultError
 
-BASE_URL = 'https://api.binance.com'
 DATA_STREAM = '/api/v3/userDataStream'
-WSS_URL = 'wss://stream.binance.com:9443/ws/'
-SUBSCRIBE = {
-  "method": "SUBSCRIBE",
-  "params": [
-    "btcusdt@aggTrade",
-    "btcusdt@depth"
-  ],
-  "id": 1
-}
-LISTEN_KEY_TIMEOUT = 30 * 60
-WS_CONNECTION_TIMEOUT = 24 * 60 * 60
-
-
-class BinanceAccount(ConnectionManager):
-    listen_key = None
+OPEN_ORDERS = '/api/v3/openOrders'
+MY_TRADES = '/api/v3/myTrades'
+ACCOUNT = '/api/v3/account'
+RESYNC_RATE = 2  # accounts re-synced per second after a stream gap
+RESYNC_OVERLAP = 5  # seconds fetched before the gap started
+COMBINED_STREAM_URL = settings.BINANCE_STREAM_URL
+LISTEN_KEY_MISSING = -1125
+HOLD_LIMIT = 1000  # frames held per account during a handover
+
+logger = logging.getLogger(__name__)
+
 
-    def __init__(self, bot, chat_id, api_key, notifications):
-        self.bot = bot.bot
+# One chat following an account, with the chat's notification settings;
+# `label` heads its messages when the chat follows several accounts
+class Subscription:
+    def __init__(self, chat_id, label=None):
         self.chat_id = chat_id
-        self.api_key = api_key
-        self.notifications = notifications
+        self.label = label
+        self.notifications = False
+        self.notification_filter = FILTER_DEFAULT
+        self.notification_window = COALESCE_WINDOW
+        self.notification_digest = False
+        self.locale = None
+
+    def __repr__(self):
+        return f'<Subscription {self.chat_id} {self.label or ""}>'
+
+
+# One Binance account, identified by the fingerprint of its API key, with
+# a single listenKey and stream however many chats subscribe to it
+class BinanceAccount(BinanceClient):
+    listen_key = None
+    secret_key_token = None
+    on_expired = None
+    on_gap = None
+    journal = None
+    # Time (ms) of the latest frame received
+    last_event = None
+    # Frames kept back while a previous process still delivers them
+    held = None
+    # Chats already told about the stream by a previous process
+    resumed = frozenset()
+    # Why the last listenKey request failed, until one succeeds
+    error = None
 
-    def get_api_key_header(self):
-        return {"X-MBX-APIKEY": self.api_key or ''}
+    def __init__(self, bot, fingerprint, api_key):
+        self.coalescer = bot.coalescer
+        self.fingerprint = fingerprint
+        # Credentials as stored, possibly sealed; opened through the vault
+        self.api_key_token = api_key
+        # Whether the stream is open
+        self.notifications = False
+        self.subscribers = {}
+        self.activating = asyncio.Lock()
+        # Symbols seen in this account's events, re-synced after a gap
+        self.symbols = set()
+        self.balances = Balances()
+
+    # Chat the account is logged and profiled under
+    @property
+    def chat_id(self):
+        return next(iter(self.subscribers), None)
+
+    # Whether any subscribed chat wants the stream
+    @property
+    def wanted(self):
+        return any(
+            subscription.notifications
+            for subscription in self.subscribers.values())
+
+    @property
+    def api_key(self):
+        return get_vault().reveal(self.api_key_token)
+
+    @property
+    def secret_key(self):
+        return get_vault().reveal(self.secret_key_token)
+
+    # Wipes the decrypted credentials of a dropped account
+    def forget(self):
+        for token in (self.api_key_token, self.secret_key_token):
+            get_vault().cache.discard(token)
 
     async def get_listen_key(self):
-        response = await self.request(
-            f'{BASE_URL}{DATA_STREAM}',
-            method='post',
-            headers=self.get_api_key_header()
-        )
         try:
-            self.listen_key = json.loads(response).get('listenKey')
-            print(f"Received listenKey {self.listen_key}")
-            return self.listen_key
+            with LISTEN_KEY_LATENCY.labels('create').time():
+                response = await self.api(DATA_STREAM, 'post', keyed=True)
+            self.listen_key = response.get('listenKey')
         except Exception as e:
-            print(e)
+            LISTEN_KEY_FAILURES.labels('create').inc()
+            logger.warning("listenKey request failed", extra={
+                'account': self.fingerprint, 'error': repr(e)})
+            self.error = repr(e)[:200]
+            return None
+        self.error = None
+        if not self.listen_key:
+            LISTEN_KEY_FAILURES.labels('create').inc()
+            logger.warning("listenKey refused", extra={
+                'account': self.fingerprint,
+                'response': str(response)[:200]})
+            self.error = str(response)[:200]
+        else:
+            logger.debug("Received listenKey", extra={
+                'account': self.fingerprint})
+        return self.listen_key
 
+    # True if the key was extended, False if Binance no longer knows it
     async def keep_alive_listen_key(self):
-        while True:
-            await asyncio.sleep(LISTEN_KEY_TIMEOUT)
-            await self.get_listen_key()
+        try:
+            with LISTEN_KEY_LATENCY.labels('keepalive').time():
+                await self.api(
+                    DATA_STREAM, 'put', keyed=True, listenKey=self.listen_key)
+        except BinanceError as e:
+            LISTEN_KEY_FAILURES.labels('keepalive').inc()
+            if e.code == LISTEN_KEY_MISSING:
+                return False
+            logger.warning("listenKey keep-alive failed", extra={
+                'account': self.fingerprint, 'error': str(e)})
+            return None
+        return True
 
-    async def user_stream(self, callback=print):
-        await self.ws_client(
-            f'{WSS_URL}{self.listen_key}',
-            callback=self.process_msg
-        )
+    # User data stream is carried by a shared multiplexed connection
+    def subscribe(self, mux, group=None):
+        mux.add(self.listen_key, self.process_msg, self.gap, group)
 
-    async def persistent_user_stream(self):
-        while True:
-            try:
-                self.bot.send_message(self.chat_id, "Веб-сокет открыт.")
-                await asyncio.wait_for(
-                    self.user_stream(),
-                    WS_CONNECTION_TIMEOUT
-                )
-            except asyncio.TimeoutError:
-                self.bot.send_message(
-                    self.chat_id, "Веб-сокет закрыт. Перезапуск...")
+    def unsubscribe(self, mux):
+        if self.listen_key:
+            mux.remove(self.listen_key)
 
     def process_msg(self, msg):
-        self.bot.send_message(self.chat_id, msg)
+        self.balances.apply(msg)
+        self.last_event = msg.get('E') or self.last_event
+        event_type = msg.get('e')
+        if event_type == 'listenKeyExpired':
+            if self.on_expired:
+                self.on_expired(self)
+            return
+        if 's' in msg:
+            self.symbols.add(msg['s'])
+        if self.held is not None:
+            self.held.append(msg)
+            return
+        self.deliver(msg)
+
+    # Each frame is decoded and rendered at most once, then handed to every
+    # subscribed chat whose filter accepts it
+    def deliver(self, msg):
+        event_type = msg.get('e')
+        event = None
+        for subscription in self.subscribers.values():
+            if not (subscription.notifications and accepts(
+                    subscription.notification_filter, event_type)):
+                continue
+            seq = None
+            if self.journal:
+                seq = self.journal.record(subscription.chat_id, msg)
+                if seq is None:
+                    continue  # already delivered
+            if event is None:
+                event = decode(msg, FILTER_ALL)
+            self.notify(subscription, event, seq)
+
+    def notify(self, subscription, event, seq=None):
+        self.coalescer.push(
+            subscription.chat_id, event, subscription.notification_window,
+            subscription.notification_digest,
+            seq and partial(self.journal.mark_delivered, [seq]),
+            subscription.label, subscription.locale)
+
+    # Frames journaled for the chat but not delivered before the last
+    # shutdown
+    def replay(self, subscription, frames):
+        for seq, msg in frames:
+            event = decode(msg, subscription.notification_filter)
+            if event is None or isinstance(event, ListenKeyExpired):
+                self.journal.mark_delivered([seq])
+                continue
+            self.notify(subscription, event, seq)
+
+    def gap(self, since):
+        if self.on_gap and self.secret_key_token:
+            self.on_gap(self, since)
+
+    # Fills and balances missed while the stream was down, fetched over
+    # REST and fed through `process_msg` so delivered ones are deduplicated
+    async def resync(self, since):
+        start = int((since - RESYNC_OVERLAP) * 1000)
+        open_orders = await self.api(OPEN_ORDERS, signed=True)
+        self.symbols.update(order['symbol'] for order in open_orders)
+        for symbol in sorted(self.symbols):
+            for trade in await self.api(
+                    MY_TRADES, signed=True, symbol=symbol, startTime=start):
+                self.process_msg(trade_report(trade))
+        account = await self.api(ACCOUNT, signed=True)
+        self.balances.load(account)
+        self.process_msg(account_position(account))
+
+    # Balances are fetched over REST only the first time; afterwards the
+    # stream (and gap resyncs) keep them current
+    async def portfolio(self, prices, locale=None):
+        if not self.balances.loaded:
+            self.balances.load(await self.api(ACCOUNT, signed=True))
+        held = self.balances.held()
+        table = await prices.get()
+        return format_portfolio(held, {
+            asset: prices.value(table, asset, amount)
+            for asset, amount in held.items()}, locale)
 
+    def __repr__(self):
+        return (f'<BinanceAccount {self.fingerprint} '
+                f'chats={len(self.subscribers)}>')
 
+
+# Reconciles running accounts with the desired profile state: each chat is
+# only touched when its keys or notification settings changed, or a stream
+# died. Accounts are shared by every chat linking the same API key, and
+# live as long as one of them does.
 class BinanceAccountsManager:
-    def __init__(self, queue):
+    is_shard = False
+    process = 'main'  # name in the status export
+
+    def __init__(self, queue, concurrency=None):
         self.queue = queue
+        # API key fingerprint -> account
         self.accounts = {}
+        # chat id -> {fingerprint: subscription}
+        self.chats = {}
+        self.reconciling = {}
+        self.deferred = {}
+        self.semaphore = asyncio.Semaphore(
+            concurrency or settings.BOT_ACTIVATION_CONCURRENCY)
+        self.mux = StreamMultiplexer(COMBINED_STREAM_URL)
+        self.market = MarketData(self.mux)
+        self.alerts = AlertEngine(self.market)
+        self.keep_alive = KeepAliveScheduler(self.renew_listen_key)
+        self.journal = EventJournal(self.journal_path())
+        self.resync_limiter = RateLimiter(RESYNC_RATE)
+        self.prices = PriceCache()
+        self.checkpoint = Checkpointer(self, self.checkpoint_path())
+        self.status = status.StatusExport(self, self.process)
+        # fingerprint -> state saved by the previous process
+        self.resumable = {}
+        self.holding = False
+        # chat id -> (account, subscription) whose journaled frames are
+        # replayed once the previous process has stopped delivering
+        self.replays = {}
+        QUEUE_DEPTH.set_function(self.queue.qsize)
+        ACCOUNTS.set_function(lambda: len(self.accounts))
+        SUBSCRIPTIONS.set_function(
+            lambda: sum(map(len, self.chats.values())))
+
+    def journal_path(self):
+        return settings.BOT_JOURNAL_PATH
+
+    def checkpoint_path(self):
+        return settings.BOT_CHECKPOINT_PATH
 
+    def account_states(self):
+        for fingerprint, account in self.accounts.items():
+            if account.notifications and account.listen_key:
+                socket = self.mux.owners.get(account.listen_key)
+                yield fingerprint, AccountState(
+                    account.listen_key, self.keep_alive.expiry(account),
+                    account.last_event, socket and socket.index,
+                    [*account.subscribers])
+
+    # The chat's accounts as (api key, secret key, label), its own key pair
+    # first, and its notification settings
     def parse_profile(self, profile):
         chat_id = profile.get('telegram_chat_id')
-        api_key = profile.get('binance_api_key')
-        notifications = profile.get('notifications')
-        return chat_id, api_key, notifications
-
-    def cancel_tasks(self, chat_id, bot):
-        _, *tasks = self.accounts.get(chat_id, (None, None))
-        if tasks and tasks[0]:
-            bot.bot.send_message(chat_id, "Веб-сокет закрыт.")
-            print(f"CANCELLING TASKS for {chat_id}")
-            print(tasks)
-            [task.cancel() for task in tasks if task]
-
-    async def activate_account(self, msg):
-        profile, bot = msg
-        parsed_profile = self.parse_profile(profile)
-        chat_id, api_key, notifications = parsed_profile
-        account = BinanceAccount(bot, *parsed_profile)
-        # Write to database
-        await bot.save_profile_db(chat_id, api_key, None, notifications)
-        self.cancel_tasks(chat_id, bot)
-        if notifications:
-            if account.api_key:
-                await account.get_listen_key()
-            if account.listen_key:
-                tasks = [asyncio.create_task(task()) for task in [
-                    account.persistent_user_stream,
-                    account.keep_alive_listen_key,
-                ]]
-                self.accounts[chat_id] = [account, *tasks]
+        credentials = [
+            (profile.get('binance_api_key'),
+             profile.get('binance_secret_key'), None),
+            *((account['binance_api_key'], account['binance_secret_key'],
+               account['label']) for account in profile.get('accounts', ())),
+        ]
+        preferences = {
+            'notifications': bool(profile.get('notifications')),
+            'notification_filter': (
+                profile.get('notification_filter') or FILTER_DEFAULT),
+            'notification_window': profile.get(
+                'notification_window', COALESCE_WINDOW),
+            'notification_digest': bool(profile.get('notification_digest')),
+            'locale': profile.get('locale'),
+        }
+        return chat_id, [c for c in credentials if c[0]], preferences
+
+    # fingerprint -> credentials; unreadable keys are skipped, and a key
+    # linked twice by one chat is followed once
+    def resolve(self, chat_id, credentials):
+        resolved = {}
+        for api_key, secret_key, label in credentials:
+            try:
+                fingerprint = get_vault().fingerprint(api_key)
+            except VaultError as e:
+                logger.warning("Unreadable API key", extra={
+                    'chat_id': chat_id, 'error': str(e)})
+                continue
+            resolved.setdefault(fingerprint, (api_key, secret_key, label))
+        return resolved
+
+    def is_running(self, account):
+        return (
+            account.listen_key in self.mux.routes
+            and account in self.keep_alive.entries)
+
+    def deactivate_account(self, account):
+        logger.info("Deactivating account", extra={
+            'account': account.fingerprint})
+        self.keep_alive.remove(account)
+        account.unsubscribe(self.mux)
+        account.notifications = False
+
+    def account_status(self, account, socket):
+        if not account.notifications:
+            return status.FAILED if account.error else status.OFF
+        if account.held is not None:
+            return status.HELD
+        if socket is None or socket.ws is None or (
+                account.listen_key in socket.pending['SUBSCRIBE']):
+            return status.CONNECTING
+        return status.STREAMING
+
+    # One row per chat following an account, for the admin dashboard
+    def status_rows(self):
+        for fingerprint, account in [*self.accounts.items()]:
+            socket = self.mux.owners.get(account.listen_key)
+            state = self.account_status(account, socket)
+            entry = self.keep_alive.entries.get(account)
+            expires = self.keep_alive.expiry(account)
+            for chat_id, subscription in [*account.subscribers.items()]:
+                backlog, lag = account.coalescer.backlog(chat_id)
+                yield (
+                    chat_id, subscription.label or '', fingerprint,
+                    state if subscription.notifications else (
+                        status.FAILED if account.error else status.OFF),
+                    socket and socket.index, account.last_event, expires,
+                    entry.failures if entry else 0, account.error, backlog,
+                    lag)
+
+    def status_summary(self):
+        coalescer = next(
+            (account.coalescer for account in self.accounts.values()), None)
+        return {
+            'accounts': len(self.accounts),
+            'chats': len(self.chats),
+            'sockets': len(self.mux.sockets),
+            'outbox': coalescer.outbox.depth if coalescer else 0,
+        }
+
+    # Picks up a listenKey left running by the previous process instead of
+    # asking Binance for a new one, on a socket shared with the same
+    # streams as before
+    def resume_account(self, account):
+        state = self.resumable.pop(account.fingerprint, None)
+        if state is None or not state.valid:
+            return False
+        account.listen_key = state.listen_key
+        account.last_event = state.last_event
+        account.resumed = set(state.chats)
+        account.subscribe(self.mux, state.socket)
+        self.keep_alive.add(account, expires=state.expires)
+        account.notifications = True
+        LISTEN_KEYS_RESUMED.inc()
+        return True
+
+    async def activate_account(self, account):
+        if await account.get_listen_key():
+            account.subscribe(self.mux)
+            self.keep_alive.add(account)
+            account.notifications = True
+            return True
+
+    def get_account(self, fingerprint, api_key, bot):
+        account = self.accounts.get(fingerprint)
+        if account is None:
+            account = self.accounts[fingerprint] = BinanceAccount(
+                bot, fingerprint, api_key)
+            account.on_expired = self.expire_listen_key
+            account.on_gap = self.recover
+            account.journal = self.journal
+            if self.holding:
+                account.held = deque(maxlen=HOLD_LIMIT)
+        elif account.api_key_token != api_key:
+            # Same key sealed anew, e.g. after a master key rotation
+            get_vault().cache.discard(account.api_key_token)
+            account.api_key_token = api_key
+        return account
+
+    # Removes the chat from the account; the stream is closed once no chat
+    # wants it, and the account dropped once no chat follows it
+    def unsubscribe_chat(self, chat_id, fingerprint):
+        subscription = self.chats.get(chat_id, {}).pop(fingerprint, None)
+        account = self.accounts.get(fingerprint)
+        if account is None:
+            return subscription
+        account.subscribers.pop(chat_id, None)
+        if account.notifications and not account.wanted:
+            self.deactivate_account(account)
+        if not account.subscribers:
+            del self.accounts[fingerprint]
+            account.forget()
+        return subscription
+
+    def drop_chat(self, chat_id):
+        for fingerprint in [*self.chats.get(chat_id, ())]:
+            self.unsubscribe_chat(chat_id, fingerprint)
+        self.chats.pop(chat_id, None)
+        self.alerts.sync(chat_id, (), None)
+
+    def recover(self, account, since):
+        asyncio.create_task(
+            self.resync_account(account, since),
+            name=f'resync-{account.fingerprint}')
+
+    # Re-syncs are paced so a dropped socket carrying hundreds of accounts
+    # does not burst against the REST weight limit
+    async def resync_account(self, account, since):
+        await self.resync_limiter.acquire()
+        async with self.semaphore:
+            try:
+                await account.resync(since)
+            except Exception as e:
+                logger.warning("Resync failed", extra={
+                    'account': account.fingerprint, 'error': repr(e)})
+
+    # One message per account of the chat, headed by its label
+    async def portfolio(self, chat_id, bot):
+        accounts = [
+            (self.accounts[fingerprint], subscription)
+            for fingerprint, subscription in self.chats.get(
+                chat_id, {}).items()
+            if self.accounts[fingerprint].secret_key_token]
+        if not accounts:
+            bot.outbox.send(chat_id, messages.text(
+                'keys.missing', bot.locale(chat_id)))
+            return
+        for account, subscription in accounts:
+            try:
+                text = await account.portfolio(
+                    self.prices, subscription.locale)
+            except Exception as e:
+                logger.warning("Portfolio failed", extra={
+                    'chat_id': chat_id, 'account': account.fingerprint,
+                    'error': repr(e)})
+                text = messages.text('portfolio.failed', subscription.locale)
+            bot.outbox.send(chat_id, labelled(subscription.label, text))
+
+    def tell(self, bot, subscription, key):
+        bot.outbox.send(subscription.chat_id, labelled(
+            subscription.label, messages.text(key, subscription.locale)))
+
+    def expire_listen_key(self, account):
+        asyncio.create_task(
+            self.renew_listen_key(account),
+            name=f'renew-{account.fingerprint}')
+
+    async def renew_listen_key(self, account):
+        account.unsubscribe(self.mux)
+        if await account.get_listen_key():
+            account.subscribe(self.mux)
+            return True
+
+    async def reconcile(self, profile, bot, stored=False):
+        chat_id, credentials, preferences = self.parse_profile(profile)
+        if not stored:
+            await bot.save_profile_db(profile)
+        self.alerts.sync(chat_id, profile.get('alerts') or (), bot)
+        wanted = self.resolve(chat_id, credentials)
+        for fingerprint in [*self.chats.get(chat_id, ())]:
+            if fingerprint not in wanted:
+                subscription = self.unsubscribe_chat(chat_id, fingerprint)
+                if subscription.notifications:
+                    self.tell(bot, subscription, 'stream.closed')
+        subscriptions = self.chats.setdefault(chat_id, {})
+        replayed = False
+        for fingerprint, (api_key, secret_key, label) in wanted.items():
+            account = self.get_account(fingerprint, api_key, bot)
+            if secret_key:
+                account.secret_key_token = secret_key
+            subscription = subscriptions.get(fingerprint)
+            if subscription is None:
+                subscription = subscriptions[fingerprint] = (
+                    account.subscribers[chat_id]) = Subscription(chat_id)
+            was_on = subscription.notifications
+            subscription.label = label if len(wanted) > 1 else None
+            for name, value in preferences.items():
+                setattr(subscription, name, value)
+            if not subscription.notifications:
+                if account.notifications and not account.wanted:
+                    self.deactivate_account(account)
+                if was_on:
+                    self.tell(bot, subscription, 'stream.closed')
+                continue
+            # Chats following one account are reconciled concurrently
+            async with account.activating:
+                if account.notifications and self.is_running(account):
+                    self.mux.revive(account.listen_key)
+                    if was_on:
+                        continue
+                elif not (self.resume_account(account)
+                          or await self.activate_account(account)):
+                    subscription.notifications = False
+                    self.tell(bot, subscription, 'keys.invalid')
+                    continue
+            if chat_id in account.resumed:
+                account.resumed.discard(chat_id)
             else:
-                self.accounts[chat_id] = None, None
-                bot.bot.send_message(chat_id, "Неверный ключ.")
+                self.tell(bot, subscription, 'stream.opened')
+            if not replayed:
+                replayed = True
+                if self.holding:
+                    self.replays[chat_id] = account, subscription
+                else:
+                    account.replay(
+                        subscription, self.journal.take_pending(chat_id))
+        if not subscriptions:
+            del self.chats[chat_id]
 
-    async def subscribe(self):
+    # Collapses updates per chat: only the latest profile is applied, and it
+    # is persisted if any of the collapsed updates was not stored yet
+    def collapse(self, pending, msg):
+        profile, bot, stored = msg
+        chat_id = profile.get('telegram_chat_id')
+        if chat_id in pending:
+            stored = stored and pending[chat_id][2]
+        pending[chat_id] = profile, bot, stored
+
+    def drain_queue(self, msg):
+        pending = {}
         while True:
-            msg = await self.queue.get()
-            print(f"Received profile data: {msg}")
+            self.collapse(pending, msg)
             self.queue.task_done()
-            await self.activate_account(msg)
+            if self.queue.empty():
+                return pending
+            msg = self.queue.get_nowait()
+
+    # One reconciliation per chat at a time; updates arriving meanwhile are
+    # collapsed and applied right after
+    async def reconcile_chat(self, chat_id, msg):
+        try:
+            while msg:
+                try:
+                    await self.reconcile(*msg)
+                except Exception:
+                    logger.exception("Reconcile failed", extra={
+                        'chat_id': chat_id})
+                msg = self.deferred.pop(chat_id, None)
+        finally:
+            self.reconciling.pop(chat_id, None)
+            self.semaphore.release()
+
+    # Frames are held back while the previous process still runs, then
+    # delivered unless its journal shows it delivered them already. Frames
+    # it left undelivered are only read from the journal at this point, as
+    # it may still deliver them from its outbox until it exits.
+    async def take_over(self, pids):
+        await wait_exited(pids)
+        self.journal.flush()
+        self.journal.reload()
+        self.journal.load_pending()
+        self.holding = False
+        self.checkpoint.paused = False
+        self.mux.groups.clear()
+        replays, self.replays = self.replays, {}
+        for chat_id, (account, subscription) in replays.items():
+            if self.chats.get(chat_id, {}).get(
+                    account.fingerprint) is subscription:
+                account.replay(
+                    subscription, self.journal.take_pending(chat_id))
+        held = 0
+        for account in [*self.accounts.values()]:
+            frames, account.held = account.held, None
+            for msg in frames or ():
+                account.deliver(msg)
+                held += 1
+        logger.info("Took over from previous process", extra={
+            'pids': sorted(pids), 'held': held})
+
+    # Stops receiving before the final checkpoint, so the next process
+    # resumes from where this one stopped
+    async def stop(self):
+        await self.mux.close()
+        self.checkpoint.stop()
+        await self.status.stop()
+
+    async def subscribe(self):
+        checkpoints = Checkpoints()
+        self.resumable = checkpoints.accounts
+        previous = checkpoints.running(self.checkpoint.owner)
+        if previous:
+            self.holding = self.checkpoint.paused = True
+            asyncio.create_task(self.take_over(previous))
+        else:
+            self.journal.load_pending()
+        logger.info("Checkpoint loaded", extra={
+            'accounts': len(checkpoints), 'previous': sorted(previous)})
+        self.checkpoint.start()
+        self.status.start()
+        self.keep_alive.start()
+        self.journal.start()
+        while True:
+            pending = self.drain_queue(await self.queue.get())
+            for chat_id, msg in pending.items():
+                if chat_id in self.reconciling:
+                    self.collapse(self.deferred, msg)
+                    continue
+                await self.semaphore.acquire()
+                self.reconciling[chat_id] = asyncio.create_task(
+                    self.reconcile_chat(chat_id, msg),
+                    name=f'reconcile-{chat_id}')
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+from .vault import VaultError, get_vault
+
+VERSION = 1
+RESUME_MARGIN = 5 * 60  # listenKeys expiring sooner than this are renewed
+HANDOVER_POLL = .5
+
+logger = logging.getLogger(__name__)
+
+
+# Saved state of one running account
+class AccountState:
+    __slots__ = ('listen_key', 'expires', 'last_event', 'socket', 'chats')
+
+    def __init__(self, listen_key, expires, last_event, socket, chats):
+        self.listen_key = listen_key
+        self.expires = expires
+        self.last_event = last_event
+        self.socket = socket
+        self.chats = chats
+
+    @property
+    def valid(self):
+        return bool(self.listen_key) and (
+            self.expires - time.time() > RESUME_MARGIN)
+
+    def as_list(self):
+        return [
+            self.listen_key, self.expires, self.last_event, self.socket,
+            self.chats]
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Guards against signalling an unrelated process that reused the pid
+def same_program(pid):
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as cmdline:
+            args = cmdline.read().decode(errors='replace').split('\0')
+    except OSError:
+        return process_alive(pid)
+    name = Path(sys.argv[0]).name
+    return any(Path(arg).name == name for arg in args)
+
+
+# Waits until the given processes have exited, at most `timeout` seconds
+async def wait_exited(pids, timeout=None):
+    deadline = time.monotonic() + (timeout or settings.BOT_HANDOVER_TIMEOUT)
+    while any(map(process_alive, pids)) and time.monotonic() < deadline:
+        await asyncio.sleep(HANDOVER_POLL)
+
+
+# Asks the previous bot processes to stop once this one has taken over;
+# they close their streams, save a final checkpoint and drain
+def retire(pids):
+    for pid in pids:
+        if pid == os.getpid() or not same_program(pid):
+            continue
+        logger.info("Retiring previous process", extra={'pid': pid})
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+# Checkpoints of every process sharing the base path (the main process and
+# its shards write `<stem>-<index><suffix>`)
+class Checkpoints:
+    def __init__(self, path=None):
+        path = Path(path or settings.BOT_CHECKPOINT_PATH)
+        self.accounts = {}
+        # pid -> pid of the process that started it (itself unless a shard)
+        self.pids = {}
+        self.owners = set()
+        for file in sorted(path.parent.glob(f'{path.stem}*{path.suffix}')):
+            try:
+                with open(file) as checkpoint:
+                    data = json.load(checkpoint)
+            except (OSError, ValueError) as e:
+                logger.warning("Unreadable checkpoint", extra={
+                    'path': str(file), 'error': repr(e)})
+                continue
+            if data.get('version') != VERSION:
+                continue
+            self.pids[data['pid']] = data['owner']
+            self.owners.add(data['owner'])
+            for fingerprint, state in data['accounts'].items():
+                self.accounts[fingerprint] = self.load(fingerprint, state)
+
+    def __len__(self):
+        return len(self.accounts)
+
+    # listenKeys are saved sealed; one that cannot be opened is renewed
+    def load(self, fingerprint, state):
+        state = AccountState(*state)
+        try:
+            state.listen_key = get_vault().reveal(state.listen_key)
+        except VaultError as e:
+            logger.warning("Unreadable listenKey", extra={
+                'fingerprint': fingerprint, 'error': str(e)})
+            state.listen_key = None
+        return state
+
+    # Previous processes still running. Processes started by `owner` are
+    # this one's siblings (the other shards), not predecessors.
+    def running(self, owner=None):
+        return {
+            pid for pid, started_by in self.pids.items()
+            if pid != os.getpid() and started_by != owner
+            and process_alive(pid)}
+
+    # Processes that started the previous ones and are still running,
+    # i.e. the front-end to hand over from
+    def owners_running(self):
+        return {
+            pid for pid in self.owners
+            if pid != os.getpid() and process_alive(pid)}
+
+    # Chats of the saved accounts, most recently active first
+    def priority(self):
+        chats = {}
+        for state in sorted(
+                self.accounts.values(),
+                key=lambda state: state.last_event or 0, reverse=True):
+            for chat_id in state.chats:
+                chats.setdefault(chat_id, None)
+        return [*chats]
+
+
+# Writes the manager's running accounts to a small JSON file at a fixed
+# interval, through a temporary file so a crash never leaves half of one
+class Checkpointer:
+    def __init__(self, manager, path, interval=None):
+        self.manager = manager
+        self.path = Path(path)
+        self.interval = interval or settings.BOT_CHECKPOINT_INTERVAL
+        self.paused = False
+        self.task = None
+        # listenKey -> sealed, so each key is only sealed once
+        self.sealed = {}
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    # Process that started this one and retires it on the next deploy
+    @property
+    def owner(self):
+        return os.getppid() if self.manager.is_shard else os.getpid()
+
+    def snapshot(self):
+        accounts = dict(self.manager.account_states())
+        sealed, self.sealed = self.sealed, {}
+        for state in accounts.values():
+            key = state.listen_key
+            self.sealed[key] = sealed.get(key) or get_vault().seal(key)
+            state.listen_key = self.sealed[key]
+        return {
+            'version': VERSION,
+            'pid': os.getpid(),
+            'owner': self.owner,
+            'saved': time.time(),
+            'accounts': {
+                fingerprint: state.as_list()
+                for fingerprint, state in accounts.items()},
+        }
+
+    def write(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(f'.{self.path.name}.tmp')
+        with open(temporary, 'w') as checkpoint:
+            json.dump(snapshot, checkpoint, separators=(',', ':'))
+        os.replace(temporary, self.path)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.paused:
+                continue
+            try:
+                await loop.run_in_executor(None, self.write, self.snapshot())
+            except OSError as e:
+                logger.error("Checkpoint failed", extra={'error': repr(e)})
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+        if not self.paused:
+            self.write()
@@ -1,15 +1,223 @@
 import asyncio
+import logging
+import random
+import time
+from urllib.parse import urlsplit
+
 import websockets
-from aiohttp import ClientSession
+from aiohttp import (
+    ClientError, ClientSession, ClientTimeout, TCPConnector, TraceConfig,
+)
+
+POOL_LIMIT = 100
+POOL_LIMIT_PER_HOST = 20
+DNS_CACHE_TTL = 5 * 60
+KEEPALIVE_TIMEOUT = 60
+REQUEST_TIMEOUT = 10
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+FAILURE_THRESHOLD = 5  # consecutive failures that open a host's circuit
+BREAKER_RESET = 30  # seconds before an open circuit lets one attempt through
+WS_ERRORS = (websockets.WebSocketException, OSError, asyncio.TimeoutError)
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStats:
+    def __init__(self):
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+        self.queued = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+
+    def trace_config(self):
+        trace_config = TraceConfig()
+        for signal, counter in [
+            (trace_config.on_request_start, 'requests'),
+            (trace_config.on_connection_create_end, 'created'),
+            (trace_config.on_connection_reuseconn, 'reused'),
+            (trace_config.on_connection_queued_start, 'queued'),
+            (trace_config.on_dns_cache_hit, 'dns_hits'),
+            (trace_config.on_dns_cache_miss, 'dns_misses'),
+        ]:
+            signal.append(self.counter(counter))
+        return trace_config
+
+    def counter(self, name):
+        async def increment(session, context, params):
+            setattr(self, name, getattr(self, name) + 1)
+        return increment
+
+    def as_dict(self):
+        return {**vars(self)}
+
+    def __repr__(self):
+        return ' '.join(f'{k}={v}' for k, v in self.as_dict().items())
+
+
+# Decorrelated jitter: each delay is drawn between the base and three times
+# the previous one, so clients that failed together drift apart
+class Backoff:
+    def __init__(self, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+        self.base, self.cap = base, cap
+        self.delay = base
+
+    def reset(self):
+        self.delay = self.base
+
+    def next(self):
+        self.delay = min(self.cap, random.uniform(self.base, self.delay * 3))
+        return self.delay
+
+
+class CircuitOpenError(ClientError):
+    pass
+
+
+# Per upstream host: after `threshold` consecutive failures calls fail fast
+# for `reset_timeout` seconds, then a single trial decides whether the
+# circuit closes again
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, host, threshold=FAILURE_THRESHOLD,
+                 reset_timeout=BREAKER_RESET):
+        self.host = host
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and (
+                time.monotonic() - self.opened >= self.reset_timeout):
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    async def wait(self):
+        while not self.allow():
+            await asyncio.sleep(max(
+                self.reset_timeout - (time.monotonic() - self.opened), 1))
+
+    def success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    # A trial cut short, e.g. by cancellation, decides nothing: the next
+    # call gets to try again
+    def abandon(self):
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                logger.warning("Circuit open", extra={'host': self.host})
+            self.state = self.OPEN
+            self.opened = time.monotonic()
+
+    def __repr__(self):
+        return f'<CircuitBreaker {self.host} {self.state}>'
 
 
 class ConnectionManager:
+    # One pooled session per process, shared by every subclass instance
+    session = None
+    pool_stats = PoolStats()
+    breakers = {}
+
+    @classmethod
+    def get_session(cls):
+        session = ConnectionManager.session
+        if session is None or session.closed:
+            connector = TCPConnector(
+                limit=POOL_LIMIT,
+                limit_per_host=POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=DNS_CACHE_TTL,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+            )
+            session = ClientSession(
+                connector=connector,
+                timeout=ClientTimeout(total=REQUEST_TIMEOUT),
+                trace_configs=[cls.pool_stats.trace_config()],
+            )
+            ConnectionManager.session = session
+        return session
+
+    @classmethod
+    async def close_session(cls):
+        session, ConnectionManager.session = ConnectionManager.session, None
+        if session is not None and not session.closed:
+            await session.close()
+
+    @classmethod
+    def breaker(cls, url):
+        host = urlsplit(url).hostname
+        breaker = cls.breakers.get(host)
+        if breaker is None:
+            breaker = cls.breakers[host] = CircuitBreaker(host)
+        return breaker
+
     async def request(self, url, method='get', **kwargs):
-        async with ClientSession() as session:
+        status, headers, text = await self.fetch(url, method, **kwargs)
+        return text
+
+    # (status, headers, body text), for callers that need the headers
+    async def fetch(self, url, method='get', **kwargs):
+        breaker = self.breaker(url)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit for {breaker.host} is open")
+        session = self.get_session()
+        try:
             async with getattr(session, method)(url, **kwargs) as response:
-                return await response.text()
+                text = await response.text()
+        except Exception:
+            breaker.failure()
+            raise
+        except BaseException:
+            breaker.abandon()
+            raise
+        if response.status >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        return response.status, response.headers, text
+
+    # Waits while the host's circuit is open
+    async def ws_connect(self, url, **kwargs):
+        breaker = self.breaker(url)
+        await breaker.wait()
+        try:
+            ws = await websockets.connect(url, **kwargs)
+        except WS_ERRORS:
+            breaker.failure()
+            raise
+        except BaseException:
+            breaker.abandon()
+            raise
+        breaker.success()
+        return ws
 
+    # Keeps a connection open, reconnecting with backoff, until cancelled.
+    # The backoff is reset by the first frame, not by the handshake, so a
+    # server accepting and dropping at once is not retried in a tight loop.
     async def ws_client(self, url, callback=print):
-        async with websockets.connect(url) as ws:
-            async for msg in ws:
-                callback(msg)
+        backoff = Backoff()
+        while True:
+            try:
+                ws = await self.ws_connect(url)
+                async with ws:
+                    async for msg in ws:
+                        backoff.reset()
+                        callback(msg)
+            except WS_ERRORS as e:
+                logger.warning("Websocket disconnected", extra={
+                    'url': url, 'error': repr(e)})
+            await asyncio.sleep(backoff.next())
@@ -0,0 +1,374 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from telegram.error import RetryAfter, TimedOut, NetworkError, TelegramError
+
+from . import messages
+from .metrics import OUTBOX_DEPTH, TELEGRAM_FAILURES, TELEGRAM_LATENCY
+
+OUTBOX_SIZE = 10000
+CHAT_QUEUE_SIZE = 100
+WORKERS = 8
+GLOBAL_RATE = 30  # messages per second, Telegram bot-wide limit
+CHAT_INTERVAL = 1  # seconds between messages to the same chat
+CHAT_LIMITED_METHODS = {'send_message'}  # callback answers and edits are not
+MAX_MESSAGE_LENGTH = 4096
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = .5
+BACKOFF_MAX = 30
+DRAIN_TIMEOUT = 10  # seconds queued messages get to go out on shutdown
+DRAIN_POLL = .05
+COALESCE_WINDOW = 2  # seconds, default per-chat grouping window
+DIGEST_INTERVAL = 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    # Token bucket: `rate` tokens per second, up to `burst` at once
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            self.refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+
+class OutboxItem:
+    __slots__ = ('created', 'method', 'args', 'kwargs', 'attempts', 'on_sent')
+
+    def __init__(self, method, args, kwargs, created=None, attempts=0,
+                 on_sent=()):
+        self.created = created or time.monotonic()
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = attempts
+        # Called on the loop once the call has succeeded
+        self.on_sent = on_sent
+
+    @property
+    def mergeable(self):
+        return self.method == 'send_message' and not self.kwargs
+
+    @property
+    def text(self):
+        return self.args[1]
+
+
+class OutboxStats:
+    def __init__(self):
+        self.enqueued = 0
+        self.sent = 0
+        self.batched = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency_last = 0
+        self.latency_max = 0
+        self.latency_total = 0
+
+    def observe(self, items):
+        now = time.monotonic()
+        for item in items:
+            latency = now - item.created
+            self.latency_last = latency
+            self.latency_max = max(self.latency_max, latency)
+            self.latency_total += latency
+        self.sent += 1
+        self.batched += len(items) - 1
+
+    @property
+    def latency_avg(self):
+        delivered = self.sent + self.batched
+        return self.latency_total / delivered if delivered else 0
+
+    def as_dict(self):
+        return {**vars(self), 'latency_avg': self.latency_avg}
+
+    def __repr__(self):
+        return ' '.join(f'{k}={v}' for k, v in self.as_dict().items())
+
+
+# Outbound Telegram calls, decoupled from the event loop.
+# Each chat has its own bounded queue, so a flooding chat only drops its own
+# oldest messages; workers serve chats round-robin within rate limits and
+# run blocking `telegram.Bot` calls in a thread pool.
+class Outbox:
+    def __init__(self, bot, loop, workers=WORKERS, rate=GLOBAL_RATE):
+        self.bot, self.loop = bot, loop
+        self.workers = workers
+        self.chats = {}
+        self.next_send = {}
+        self.ready = asyncio.Queue()
+        self.size = 0
+        # Batches taken off their queue and not yet delivered
+        self.sending = 0
+        self.stats = OutboxStats()
+        self.global_limit = RateLimiter(rate)
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix='outbox')
+        self.tasks = []
+        OUTBOX_DEPTH.set_function(lambda: self.size)
+
+    def start(self):
+        self.tasks = [
+            self.loop.create_task(self.worker(), name=f'outbox-{index}')
+            for index in range(self.workers)]
+
+    # Queued messages are delivered, within `timeout`, before the workers
+    # are cancelled
+    async def stop(self, timeout=DRAIN_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while (self.size or self.sending) and self.tasks and (
+                time.monotonic() < deadline):
+            await asyncio.sleep(DRAIN_POLL)
+        if self.size or self.sending:
+            logger.warning("Outbox not drained", extra={
+                'depth': self.size, 'sending': self.sending})
+        [task.cancel() for task in self.tasks]
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+
+    @property
+    def depth(self):
+        return self.size
+
+    def send(self, chat_id, text, on_sent=(), **kwargs):
+        self.put(chat_id, OutboxItem(
+            'send_message', (chat_id, text), kwargs, on_sent=on_sent))
+
+    # `key` is the chat the call is queued under; `args` and `kwargs`
+    # (which may include a `chat_id` of their own) go to the `telegram.Bot`
+    # method. Safe to call both from the loop and from dispatcher threads.
+    def call(self, key, method, *args, **kwargs):
+        self.put(key, OutboxItem(method, args, kwargs))
+
+    def put(self, chat_id, item):
+        if self.in_loop():
+            self.enqueue(chat_id, item)
+        else:
+            self.loop.call_soon_threadsafe(self.enqueue, chat_id, item)
+
+    def in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def enqueue(self, chat_id, item, front=False):
+        queue = self.chats.get(chat_id)
+        if queue is None:
+            queue = self.chats[chat_id] = deque()
+            self.ready.put_nowait(chat_id)
+        if len(queue) >= CHAT_QUEUE_SIZE or self.size >= OUTBOX_SIZE:
+            if not queue:
+                self.stats.dropped += 1
+                return
+            queue.pop() if front else queue.popleft()
+            self.size -= 1
+            self.stats.dropped += 1
+        queue.appendleft(item) if front else queue.append(item)
+        self.size += 1
+        if not front:
+            self.stats.enqueued += 1
+
+    # Messages queued for the chat and the age of the oldest, in seconds
+    def backlog(self, chat_id):
+        queue = self.chats.get(chat_id)
+        if not queue:
+            return 0, None
+        return len(queue), time.monotonic() - queue[0].created
+
+    def take_batch(self, chat_id):
+        queue = self.chats[chat_id]
+        items = [queue.popleft()]
+        if items[0].mergeable:
+            length = len(items[0].text)
+            while queue and queue[0].mergeable:
+                length += len(queue[0].text) + 2
+                if length > MAX_MESSAGE_LENGTH:
+                    break
+                items.append(queue.popleft())
+        self.size -= len(items)
+        return items
+
+    def merge(self, items):
+        if len(items) == 1:
+            return items[0]
+        return OutboxItem(
+            'send_message',
+            (items[0].args[0], '\n\n'.join(item.text for item in items)), {},
+            created=min(item.created for item in items),
+            attempts=max(item.attempts for item in items),
+            on_sent=[
+                callback for item in items for callback in item.on_sent])
+
+    def reschedule(self, chat_id):
+        if not self.chats.get(chat_id):
+            self.chats.pop(chat_id, None)
+            return
+        delay = self.next_send.get(chat_id, 0) - time.monotonic()
+        if delay > 0:
+            self.loop.call_later(delay, self.ready.put_nowait, chat_id)
+        else:
+            self.ready.put_nowait(chat_id)
+
+    async def worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            if not self.chats.get(chat_id):
+                self.chats.pop(chat_id, None)
+                continue
+            if self.next_send.get(chat_id, 0) > time.monotonic():
+                self.reschedule(chat_id)
+                continue
+            items = self.take_batch(chat_id)
+            self.sending += 1
+            try:
+                await self.global_limit.acquire()
+                delay = await self.deliver(chat_id, items)
+            finally:
+                self.sending -= 1
+            if items[0].method in CHAT_LIMITED_METHODS:
+                delay = max(delay, CHAT_INTERVAL)
+            if delay:
+                self.next_send[chat_id] = time.monotonic() + delay
+            self.reschedule(chat_id)
+
+    async def deliver(self, chat_id, items):
+        item = self.merge(items)
+        call = partial(
+            getattr(self.bot, item.method), *item.args, **item.kwargs)
+        started = time.perf_counter()
+        try:
+            await self.loop.run_in_executor(self.executor, call)
+        except RetryAfter as e:
+            TELEGRAM_FAILURES.labels(item.method).inc()
+            return self.retry(chat_id, item, e.retry_after)
+        except (TimedOut, NetworkError):
+            TELEGRAM_FAILURES.labels(item.method).inc()
+            return self.retry(chat_id, item, min(
+                BACKOFF_MAX, BACKOFF_BASE * 2 ** item.attempts))
+        except TelegramError as e:
+            self.stats.failed += 1
+            TELEGRAM_FAILURES.labels(item.method).inc()
+            logger.warning("Delivery failed", extra={
+                'chat_id': chat_id, 'error': str(e)})
+        else:
+            TELEGRAM_LATENCY.labels(item.method).observe(
+                time.perf_counter() - started)
+            self.stats.observe(items)
+            for callback in item.on_sent:
+                callback()
+        return 0
+
+    def retry(self, chat_id, item, delay):
+        item.attempts += 1
+        if item.attempts >= MAX_ATTEMPTS:
+            self.stats.failed += 1
+            return 0
+        self.stats.retried += 1
+        self.enqueue(chat_id, item, front=True)
+        return delay
+
+
+def labelled(source, text):
+    return f'{source}\n{text}' if source else text
+
+
+# Groups a chat's user data events for a short window (or a digest period)
+# and sends one summary per related group, e.g. all partial fills of an
+# order or all updates of one asset balance, instead of one message per
+# websocket frame. Events of a chat following several accounts are grouped
+# per account, and messages are headed by the account's label.
+class Coalescer:
+    def __init__(self, outbox, loop):
+        self.outbox, self.loop = outbox, loop
+        self.pending = {}
+        self.timers = {}
+        self.locales = {}
+        self.digests = set()
+        self.received = 0
+        self.sent = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    # `on_sent` is called once the event has reached the chat; `source`
+    # is the label of the account it came from, `locale` the chat's
+    def push(self, chat_id, event, window=COALESCE_WINDOW, digest=False,
+             on_sent=None, source=None, locale=None):
+        self.received += 1
+        callbacks = [on_sent] if on_sent else []
+        if digest:
+            window = DIGEST_INTERVAL
+        key = event.key()
+        if not window or key is None and not digest:
+            self.send(
+                chat_id, labelled(source, event.render(locale)), callbacks)
+            return
+        groups = self.pending.setdefault(chat_id, {})
+        events, sent = groups.setdefault(
+            (source, key) if key is not None else (source, object()),
+            ([], []))
+        events.append(event)
+        sent.extend(callbacks)
+        if chat_id not in self.timers:
+            self.locales[chat_id] = locale
+            if digest:
+                self.digests.add(chat_id)
+            self.timers[chat_id] = self.loop.call_later(
+                window, self.flush, chat_id)
+
+    def flush(self, chat_id):
+        self.timers.pop(chat_id, None)
+        groups = self.pending.pop(chat_id, {})
+        locale = self.locales.pop(chat_id, None)
+        digest = chat_id in self.digests
+        self.digests.discard(chat_id)
+        if digest and groups:
+            count = sum(len(events) for events, _ in groups.values())
+            self.send(chat_id, messages.text(
+                'digest.title', locale, count=count))
+        for (source, _), (events, callbacks) in groups.items():
+            self.send(chat_id, labelled(source, type(
+                events[0]).render_summary(events, locale)), callbacks)
+
+    # Events waiting for their window plus messages in the outbox
+    def backlog(self, chat_id):
+        queued, lag = self.outbox.backlog(chat_id)
+        return queued + sum(
+            len(events)
+            for events, _ in self.pending.get(chat_id, {}).values()), lag
+
+    def flush_all(self):
+        for chat_id, timer in [*self.timers.items()]:
+            timer.cancel()
+            self.flush(chat_id)
+
+    def send(self, chat_id, text, on_sent=()):
+        self.sent += 1
+        self.outbox.send(chat_id, text, on_sent=on_sent)
+
+    def __repr__(self):
+        return (f'received={self.received} sent={self.sent} '
+                f'pending={len(self)}')
@@ -0,0 +1,235 @@
+import json
+from decimal import Decimal, InvalidOperation
+
+from . import messages
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+loads = orjson.loads if orjson else json.loads
+
+
+class UserEvent:
+    # Binance payload key -> attribute name
+    FIELDS = {}
+    __slots__ = ('type', 'time', 'text', 'rendered')
+
+    def __init__(self, data):
+        self.type = data.get('e')
+        self.time = data.get('E')
+        self.text = None
+        self.rendered = None
+        for key, name in self.FIELDS.items():
+            setattr(self, name, data.get(key))
+
+    def as_dict(self):
+        return {
+            'e': self.type, 'E': self.time,
+            **{key: getattr(self, name) for key, name in self.FIELDS.items()},
+        }
+
+    def format(self):
+        if self.text is None:
+            self.text = json.dumps(self.as_dict(), ensure_ascii=False)
+        return self.text
+
+    # Fields shown in the notification, by attribute name
+    def values(self):
+        return {name: getattr(self, name) for name in self.FIELDS.values()}
+
+    # Rendered once per locale, however many chats the event is fanned out to
+    def render(self, locale=None):
+        if self.rendered is None:
+            self.rendered = {}
+        text = self.rendered.get(locale)
+        if text is None:
+            text = self.rendered[locale] = messages.render(
+                self.type, self.values(), locale)
+        return text
+
+    # Events sharing a key are summarised into one notification;
+    # `None` means the event is always delivered on its own
+    def key(self):
+        return None
+
+    # Values of the latest event, with `count` when several were folded
+    # into it
+    @classmethod
+    def summarise(cls, events):
+        values = events[-1].values()
+        if len(events) > 1:
+            values['count'] = len(events)
+        return values
+
+    @classmethod
+    def render_summary(cls, events, locale=None):
+        if len(events) == 1:
+            return events[0].render(locale)
+        return messages.render(
+            events[-1].type, cls.summarise(events), locale)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.as_dict()}>'
+
+
+class UnknownEvent(UserEvent):
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.data = data
+
+    def as_dict(self):
+        return self.data
+
+    def values(self):
+        return {'json': self.format()}
+
+
+def event_class(name, fields, base=UserEvent):
+    return type(name, (base,), {
+        'FIELDS': fields, '__slots__': tuple(fields.values())})
+
+
+def total(values):
+    try:
+        return str(sum(Decimal(value) for value in values if value))
+    except InvalidOperation:
+        return None
+
+
+# Partial fills of one order: latest state, summed fill and commission
+class OrderEvent(UserEvent):
+    __slots__ = ()
+
+    def key(self):
+        return 'order', self.symbol, self.order_id
+
+    @classmethod
+    def summarise(cls, events):
+        return {
+            **super().summarise(events),
+            'last_quantity': total(event.last_quantity for event in events),
+            'commission': total(event.commission for event in events),
+        }
+
+
+class BalanceEvent(UserEvent):
+    __slots__ = ()
+
+    def key(self):
+        return 'balance', self.asset
+
+    @classmethod
+    def summarise(cls, events):
+        return {
+            **super().summarise(events),
+            'delta': total(event.delta for event in events),
+        }
+
+
+class PositionEvent(UserEvent):
+    __slots__ = ()
+
+    def key(self):
+        return 'position',
+
+    # One `asset: free (locked)` line per balance
+    def values(self):
+        return {'balances': '\n'.join(
+            f"{balance.get('a')}: {balance.get('f')}"
+            + (f" ({balance['l']})" if float(balance.get('l') or 0) else '')
+            for balance in self.balances or ())}
+
+
+class ListEvent(UserEvent):
+    __slots__ = ()
+
+    def key(self):
+        return 'list', self.symbol, self.order_list_id
+
+
+ExecutionReport = event_class('ExecutionReport', {
+    's': 'symbol', 'c': 'client_order_id', 'S': 'side', 'o': 'order_type',
+    'q': 'quantity', 'p': 'price', 'x': 'execution_type',
+    'X': 'order_status', 'r': 'reject_reason', 'i': 'order_id',
+    'l': 'last_quantity', 'z': 'filled_quantity', 'L': 'last_price',
+    'n': 'commission', 'N': 'commission_asset', 'T': 'transaction_time',
+    't': 'trade_id', 'Z': 'filled_quote_quantity',
+}, OrderEvent)
+BalanceUpdate = event_class('BalanceUpdate', {
+    'a': 'asset', 'd': 'delta', 'T': 'clear_time',
+}, BalanceEvent)
+OutboundAccountPosition = event_class('OutboundAccountPosition', {
+    'u': 'last_update', 'B': 'balances',
+}, PositionEvent)
+ListStatus = event_class('ListStatus', {
+    's': 'symbol', 'g': 'order_list_id', 'c': 'contingency_type',
+    'l': 'list_status_type', 'L': 'list_order_status',
+    'r': 'reject_reason', 'C': 'client_order_list_id',
+    'T': 'transaction_time', 'O': 'orders',
+}, ListEvent)
+ListenKeyExpired = event_class('ListenKeyExpired', {})
+
+
+# REST payloads fetched after a stream gap, shaped as the stream events
+# they stand in for. Fields are deterministic so that fetching the same
+# gap twice, or a fill already seen on the stream, is deduplicated by
+# the journal.
+def trade_report(trade):
+    return {
+        'e': 'executionReport', 'E': trade['time'], 's': trade['symbol'],
+        'S': 'BUY' if trade['isBuyer'] else 'SELL', 'x': 'TRADE',
+        'i': trade['orderId'], 'l': trade['qty'], 'L': trade['price'],
+        'n': trade['commission'], 'N': trade['commissionAsset'],
+        'T': trade['time'], 't': trade['id'],
+    }
+
+
+def account_position(account):
+    return {
+        'e': 'outboundAccountPosition', 'E': account['updateTime'],
+        'u': account['updateTime'],
+        'B': [
+            {'a': balance['asset'], 'f': balance['free'],
+             'l': balance['locked']}
+            for balance in account['balances']
+            if float(balance['free']) or float(balance['locked'])],
+    }
+
+
+EVENT_TYPES = {
+    'executionReport': ExecutionReport,
+    'balanceUpdate': BalanceUpdate,
+    'outboundAccountPosition': OutboundAccountPosition,
+    'listStatus': ListStatus,
+    'listenKeyExpired': ListenKeyExpired,
+}
+
+# `Profile.notification_filter` -> event types forwarded to the chat;
+# `None` forwards everything
+FILTER_ALL = 'all'
+FILTER_DEFAULT = 'default'
+FILTER_ORDERS = 'orders'
+FILTERS = {
+    FILTER_ALL: None,
+    FILTER_DEFAULT: {'executionReport', 'balanceUpdate', 'listStatus'},
+    FILTER_ORDERS: {'executionReport', 'listStatus'},
+}
+# Handled by the bot itself, whatever the filter
+SERVICE_EVENTS = {'listenKeyExpired'}
+
+
+def accepts(notification_filter, event_type):
+    types = FILTERS.get(notification_filter, FILTERS[FILTER_DEFAULT])
+    return types is None or event_type in types or event_type in SERVICE_EVENTS
+
+
+# Returns None for events the filter drops, before building any object
+def decode(data, notification_filter=FILTER_DEFAULT):
+    event_type = data.get('e')
+    if not accepts(notification_filter, event_type):
+        return None
+    return EVENT_TYPES.get(event_type, UnknownEvent)(data)
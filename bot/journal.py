@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from django.conf import settings
+
+SEGMENT_LENGTH = 60 * 60  # seconds of frames per segment
+COMPACT_INTERVAL = 10 * 60
+RECENT_DIGESTS = 100000  # delivered frames remembered for deduplication
+REPLAY_LIMIT = 1000  # per chat
+PID_BITS = 22  # Linux pids stay below 2 ** 22
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS frames (
+    seq INTEGER PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    chat_id TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    frame TEXT NOT NULL,
+    delivered INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS frames_segment ON frames (segment);
+CREATE INDEX IF NOT EXISTS frames_pending ON frames (delivered, chat_id);
+'''
+
+
+# Fills are identified by their trade rather than the raw frame, so a fill
+# seen on the stream and fetched again by a gap resync (whose frames carry
+# fewer fields and other timestamps) is delivered once
+def frame_identity(data):
+    if data.get('e') == 'executionReport' and data.get('x') == 'TRADE':
+        return ['fill', data.get('s'), data.get('i'), data.get('t')]
+    return data
+
+
+def frame_digest(chat_id, data):
+    return hashlib.blake2b(
+        f'{chat_id}:{json.dumps(frame_identity(data), sort_keys=True)}'
+        .encode(), digest_size=16).digest()
+
+
+# Append-only record of every user data frame received and whether it was
+# delivered to its chat, in a SQLite file in WAL mode. Records and delivery
+# marks are buffered and written in one transaction per loop iteration, so
+# the cost is a sequential WAL append. Frames are grouped in hourly
+# segments; whole segments past the retention period are dropped.
+class EventJournal:
+    def __init__(self, path=None, retention=None):
+        path = Path(path or settings.BOT_JOURNAL_PATH)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.retention = (
+            retention or settings.BOT_JOURNAL_RETENTION) * 60 * 60
+        self.db = sqlite3.connect(str(path), isolation_level=None)
+        self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.executescript(SCHEMA)
+        self.reload()
+        self.pending = {}
+        self.inflight = {}
+        self.waiting = set()
+        self.records = []
+        self.delivered = []
+        self.scheduled = False
+        self.task = None
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM frames').fetchone()[0]
+
+    # Sequence and delivered frames as stored, including those written by
+    # a previous process sharing the file until it handed over. Sequence
+    # numbers carry the writer's pid in their low bits, so two processes
+    # appending to one file at the same time never issue the same one.
+    def reload(self):
+        last = self.db.execute(
+            'SELECT COALESCE(MAX(seq), 0) FROM frames').fetchone()[0]
+        self.seq = last >> PID_BITS
+        self.recent = OrderedDict.fromkeys(row[0] for row in self.db.execute(
+            'SELECT digest FROM (SELECT seq, digest FROM frames '
+            'WHERE delivered = 1 ORDER BY seq DESC LIMIT ?) ORDER BY seq',
+            (RECENT_DIGESTS,)))
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    # Undelivered frames of the previous run, replayed as chats come back;
+    # a frame delivered under another sequence number is skipped
+    def load_pending(self):
+        for seq, chat_id, digest, frame in self.db.execute(
+                'SELECT seq, chat_id, digest, frame FROM frames '
+                'WHERE delivered = 0 ORDER BY seq'):
+            if digest in self.recent or digest in self.waiting:
+                continue
+            frames = self.pending.setdefault(chat_id, [])
+            if len(frames) < REPLAY_LIMIT:
+                frames.append((seq, json.loads(frame)))
+                self.inflight[seq] = digest
+                self.waiting.add(digest)
+        logger.info("Journal loaded", extra={
+            'frames': sum(map(len, self.pending.values())),
+            'chats': len(self.pending)})
+
+    def take_pending(self, chat_id):
+        return self.pending.pop(chat_id, [])
+
+    # Sequence number of the recorded frame, None for a duplicate of one
+    # delivered or on its way
+    def record(self, chat_id, data):
+        digest = frame_digest(chat_id, data)
+        if digest in self.recent or digest in self.waiting:
+            return None
+        self.seq += 1
+        seq = self.seq << PID_BITS | os.getpid()
+        self.records.append((
+            seq, int(time.time()) // SEGMENT_LENGTH, chat_id, digest,
+            json.dumps(data)))
+        self.inflight[seq] = digest
+        self.waiting.add(digest)
+        if len(self.inflight) > RECENT_DIGESTS:
+            self.waiting.discard(self.inflight.pop(next(iter(self.inflight))))
+        self.schedule()
+        return seq
+
+    def mark_delivered(self, seqs):
+        self.delivered.extend(seqs)
+        for seq in seqs:
+            digest = self.inflight.pop(seq, None)
+            if digest is not None:
+                self.waiting.discard(digest)
+                self.recent[digest] = None
+        while len(self.recent) > RECENT_DIGESTS:
+            self.recent.popitem(last=False)
+        self.schedule()
+
+    def schedule(self):
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        records, self.records = self.records, []
+        delivered, self.delivered = self.delivered, []
+        if not (records or delivered):
+            return
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany(
+                'INSERT INTO frames (seq, segment, chat_id, digest, frame) '
+                'VALUES (?, ?, ?, ?, ?)', records)
+            self.db.executemany(
+                'UPDATE frames SET delivered = 1 WHERE seq = ?',
+                [(seq,) for seq in delivered])
+
+    # Drops segments past retention and returns their pages to the OS
+    def compact(self):
+        self.flush()
+        oldest = (int(time.time()) - self.retention) // SEGMENT_LENGTH
+        dropped = self.db.execute(
+            'DELETE FROM frames WHERE segment < ?', (oldest,)).rowcount
+        self.db.execute('PRAGMA incremental_vacuum')
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return dropped
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(COMPACT_INTERVAL)
+            try:
+                dropped = self.compact()
+                if dropped:
+                    logger.info("Journal compacted", extra={
+                        'dropped': dropped})
+            except sqlite3.Error as e:
+                logger.error("Journal compaction failed", extra={
+                    'error': repr(e)})
+
+    def close(self):
+        self.flush()
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.db.close()
@@ -0,0 +1,162 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+from itertools import count
+
+LISTEN_KEY_TIMEOUT = 30 * 60
+LISTEN_KEY_LIFETIME = 60 * 60
+JITTER = .1
+RETRY_DELAY = 60  # doubled after each failure in a row, up to RETRY_MAX
+RETRY_MAX = 5 * 60
+CONCURRENCY = 10
+EXPIRY_WARNING = 10 * 60
+REPORT_INTERVAL = 5 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class KeepAliveEntry:
+    __slots__ = ('account', 'deadline', 'expires', 'failures', 'seq')
+
+    def __init__(self, account, deadline, seq):
+        self.account = account
+        self.deadline = deadline
+        self.expires = time.monotonic() + LISTEN_KEY_LIFETIME
+        self.failures = 0
+        self.seq = seq
+
+
+# One task keeps every listenKey alive: deadlines sit in a heap, refreshes
+# run with bounded concurrency and are spread with jitter, so a restart
+# does not turn into a wave of simultaneous keep-alive calls.
+class KeepAliveScheduler:
+    def __init__(self, on_expired, concurrency=CONCURRENCY):
+        self.on_expired = on_expired
+        self.heap = []
+        self.entries = {}
+        self.seq = count()
+        self.wake = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.refreshing = set()
+        self.task = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    # `expires`: wall-clock expiry of a key resumed from a checkpoint,
+    # refreshed within what is left of its lifetime
+    def add(self, account, delay=None, expires=None):
+        left = LISTEN_KEY_LIFETIME
+        if expires is not None:
+            left = min(expires - time.time(), LISTEN_KEY_LIFETIME)
+        if delay is None:
+            # Spread freshly created keys over the first refresh period
+            delay = random.uniform(JITTER, 1) * min(
+                LISTEN_KEY_TIMEOUT, left / 2)
+        entry = KeepAliveEntry(
+            account, time.monotonic() + delay, next(self.seq))
+        entry.expires = time.monotonic() + left
+        self.entries[account] = entry
+        self.push(entry)
+
+    def remove(self, account):
+        self.entries.pop(account, None)
+
+    # Wall-clock time the account's listenKey lapses unless kept alive
+    def expiry(self, account):
+        entry = self.entries.get(account)
+        if entry is None:
+            return None
+        return time.time() + entry.expires - time.monotonic()
+
+    def push(self, entry):
+        heapq.heappush(self.heap, (entry.deadline, entry.seq, entry))
+        if self.heap[0][2] is entry:
+            self.wake.set()
+
+    def reschedule(self, entry, delay):
+        entry.deadline = time.monotonic() + delay
+        entry.seq = next(self.seq)
+        self.push(entry)
+
+    def is_current(self, entry, seq):
+        return self.entries.get(entry.account) is entry and entry.seq == seq
+
+    async def run(self):
+        last_report = time.monotonic()
+        while True:
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                _, seq, entry = heapq.heappop(self.heap)
+                if self.is_current(entry, seq):
+                    await self.semaphore.acquire()
+                    task = asyncio.create_task(
+                        self.refresh(entry),
+                        name=f'keepalive-{entry.account.fingerprint}')
+                    self.refreshing.add(task)
+                    task.add_done_callback(self.refreshing.discard)
+            if now - last_report >= REPORT_INTERVAL:
+                last_report = now
+                self.print_report()
+            timeout = self.heap[0][0] - now if self.heap else REPORT_INTERVAL
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(
+                    self.wake.wait(), min(timeout, REPORT_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+
+    # Whatever goes wrong, the entry is rescheduled: an error escaping here
+    # would drop the account from the schedule and let its key lapse
+    async def refresh(self, entry):
+        try:
+            alive = await entry.account.keep_alive_listen_key()
+        except Exception as e:
+            logger.warning("listenKey keep-alive error", extra={
+                'account': entry.account.fingerprint, 'error': repr(e)})
+            alive = None
+        finally:
+            self.semaphore.release()
+        if entry.account not in self.entries:
+            return
+        if alive is False:
+            # Binance dropped the key; the owner issues a new one
+            try:
+                alive = await self.on_expired(entry.account)
+            except Exception as e:
+                logger.warning("listenKey renewal error", extra={
+                    'account': entry.account.fingerprint, 'error': repr(e)})
+                alive = None
+        if alive:
+            entry.failures = 0
+            entry.expires = time.monotonic() + LISTEN_KEY_LIFETIME
+            self.reschedule(entry, LISTEN_KEY_TIMEOUT * random.uniform(
+                1 - JITTER, 1 + JITTER))
+        else:
+            entry.failures += 1
+            self.reschedule(entry, min(
+                RETRY_DELAY * 2 ** (entry.failures - 1), RETRY_MAX))
+
+    def report(self):
+        now = time.monotonic()
+        return {
+            'expiring': [
+                entry.account for entry in self.entries.values()
+                if entry.expires - now < EXPIRY_WARNING],
+            'failed': [
+                entry.account for entry in self.entries.values()
+                if entry.failures],
+        }
+
+    def print_report(self):
+        report = self.report()
+        if any(report.values()):
+            logger.warning("listenKeys need attention", extra={
+                'tracked': len(self), 'expiring': len(report['expiring']),
+                'failed': len(report['failed'])})
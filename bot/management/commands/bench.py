@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from bot.bench import FakeBinance, FakeTelegram, percentiles, serve
+
+SEED = '''
+from bot.models import Profile
+Profile.objects.bulk_create([Profile(
+    telegram_chat_id=str(chat_id), binance_api_key=f"bench-key-{chat_id}",
+    binance_secret_key="bench", notifications=True,
+) for chat_id in range(1, %d + 1)], batch_size=1000)
+'''
+
+
+def rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ('Runs the `bot` command against local Binance and Telegram '
+            'stand-ins and reports throughput, latency, memory and '
+            'start-up time')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', type=int, default=1000)
+        parser.add_argument(
+            '--rate', type=float, default=100,
+            help='user data events per second, across all accounts')
+        parser.add_argument('--duration', type=float, default=30)
+        parser.add_argument('--warmup-rate', type=float, default=500)
+        parser.add_argument('--startup-timeout', type=float, default=600)
+        parser.add_argument('--shards', type=int, default=0)
+        parser.add_argument(
+            '--output',
+            default=str(Path(settings.BASE_DIR) / 'bench_output.txt'),
+            help='results are appended as one JSON line per run')
+
+    def handle(self, *args, **options):
+        results = asyncio.run(self.run(**options))
+        with open(options['output'], 'a') as output:
+            output.write(json.dumps(results) + '\n')
+        for key, value in results.items():
+            self.stdout.write(f'{key}: {value}')
+
+    async def manage(self, env, *args, **kwargs):
+        return await asyncio.create_subprocess_exec(
+            sys.executable, str(Path(settings.BASE_DIR) / 'manage.py'), *args,
+            env=env, **kwargs)
+
+    async def wait_for(self, condition, timeout, interval=.2):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+        return condition()
+
+    async def run(self, accounts, rate, duration, warmup_rate,
+                  startup_timeout, shards, **options):
+        binance, telegram = FakeBinance(), FakeTelegram()
+        binance_runner, binance_url = await serve(binance.app)
+        telegram_runner, telegram_url = await serve(telegram.app)
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {
+                **os.environ,
+                'DATABASE_PATH': str(Path(tmp) / 'bench.sqlite3'),
+                'BOT_JOURNAL_PATH': str(Path(tmp) / 'journal.sqlite3'),
+                'BOT_CHECKPOINT_PATH': str(Path(tmp) / 'checkpoint.json'),
+                'BOT_STATUS_PATH': str(Path(tmp) / 'status.sqlite3'),
+                'BINANCE_API_URL': binance_url,
+                'BINANCE_STREAM_URL':
+                    f'{binance_url.replace("http", "ws")}/stream',
+                'TELEGRAM_API_URL': f'{telegram_url}/bot',
+                'BOT_WARMUP_RATE': str(warmup_rate),
+            }
+            for args in [
+                ('migrate', '--noinput', '-v0'),
+                ('shell', '-c', SEED % accounts),
+            ]:
+                process = await self.manage(env, *args)
+                await process.wait()
+
+            with open(Path(tmp) / 'bot.log', 'w') as log:
+                started = time.monotonic()
+                bot = await self.manage(
+                    env, 'bot', '--shards', str(shards),
+                    stdout=log, stderr=subprocess.STDOUT)
+                await self.wait_for(telegram.polled.is_set, startup_timeout)
+                rss_empty = rss_kb(bot.pid)
+                ready = await self.wait_for(
+                    lambda: len(binance.subscribed) >= accounts,
+                    startup_timeout)
+                startup = time.monotonic() - started
+                subscribed = len(binance.subscribed)
+                rss_loaded = rss_kb(bot.pid)
+
+                emitted = time.monotonic()
+                await binance.emit(rate, duration)
+                await self.wait_for(
+                    lambda: len(telegram.latencies) >= binance.sent, 30)
+                elapsed = time.monotonic() - emitted
+
+                bot.send_signal(signal.SIGINT)
+                await bot.wait()
+        await binance_runner.cleanup()
+        await telegram_runner.cleanup()
+
+        latencies = telegram.latencies
+        return {
+            'commit': git_commit(),
+            'accounts': accounts,
+            'shards': shards,
+            'rate': rate,
+            'duration': duration,
+            'ready': ready,
+            'subscribed': subscribed,
+            'startup_s': round(startup, 2),
+            'events_sent': binance.sent,
+            'events_delivered': len(latencies),
+            'events_per_s': round(len(latencies) / elapsed, 1),
+            'messages': telegram.messages,
+            'latency_ms': {
+                key: value and round(value, 1)
+                for key, value in percentiles(latencies).items()},
+            'rss_kb': rss_loaded,
+            'rss_per_account_kb': (
+                round((rss_loaded - rss_empty) / accounts, 2)
+                if rss_loaded and rss_empty and accounts else None),
+        }
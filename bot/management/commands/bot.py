@@ -1,35 +1,68 @@
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import signal
+from pathlib import Path
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
-from bot.telegram_utils import BinanceBot
-from bot.binance_utils import BinanceAccountsManager
+from bot.profiler import SLOW_THRESHOLD
+from bot.runtime import BotRuntime
 
 
 class Command(BaseCommand):
     help = 'Configures and initiates Telegram Bot'
 
     def add_arguments(self, parser):
-        # parser.add_argument('poll_ids', nargs='+', type=int)
-        pass
+        parser.add_argument(
+            '--shards', type=int, default=0,
+            help='Run accounts in N worker processes '
+                 '(SIGUSR1 adds a shard, SIGUSR2 removes one)')
+        parser.add_argument(
+            '--metrics-port', type=int, default=settings.BOT_METRICS_PORT,
+            help='Serve Prometheus metrics on this port (0 disables); '
+                 'shards use the following ports')
+        parser.add_argument(
+            '--profile', action='store_true',
+            help='Sample the stack whenever the event loop is blocked and '
+                 'write collapsed stacks for flamegraph tools')
+        parser.add_argument(
+            '--profile-threshold', type=float, default=SLOW_THRESHOLD * 1000,
+            help='Loop lag in ms before stacks are sampled')
+        parser.add_argument(
+            '--profile-output',
+            default=str(Path(settings.BASE_DIR) / 'loop_profile.folded'),
+            help='Shards write to the same name with their index appended')
 
-    async def run_bot(self, loop, queue):
-        bot = BinanceBot(loop, queue)
-        with ThreadPoolExecutor() as pool:
-            await loop.run_in_executor(
-                pool, bot.set_updater)
+    def add_signal_handlers(self, loop, runtime):
+        # Sent by the next process once it has taken over the streams
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        coordinator = runtime.coordinator
+        if coordinator:
+            loop.add_signal_handler(signal.SIGUSR1, coordinator.add_shard)
+            loop.add_signal_handler(signal.SIGUSR2, coordinator.remove_shard)
 
-    async def run_manager(self, loop, queue):
-        manager = BinanceAccountsManager(queue)
-        loop.create_task(manager.subscribe())
-
-    def main(self):
+    def main(self, shards=0, metrics_port=None, profile=None):
         loop = asyncio.get_event_loop()
-        queue = asyncio.Queue()
-        loop.create_task(self.run_bot(loop, queue))
-        loop.create_task(self.run_manager(loop, queue))
-        loop.run_forever()
+        runtime = BotRuntime(
+            loop, shards=shards, metrics_port=metrics_port, profile=profile)
+        loop.run_until_complete(runtime.start())
+        self.add_signal_handlers(loop, runtime)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            loop.run_until_complete(runtime.stop())
 
     def handle(self, *args, **options):
-        self.main()
+        if options['shards'] < 0:
+            raise CommandError('--shards must not be negative')
+        if options['profile_threshold'] <= 0:
+            raise CommandError('--profile-threshold must be positive')
+        profile = None
+        if options['profile']:
+            profile = (
+                options['profile_output'], options['profile_threshold'] / 1000)
+        self.main(
+            shards=options['shards'], metrics_port=options['metrics_port'],
+            profile=profile)
@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from bot.models import LinkedAccount, Profile
+from bot.vault import get_vault, VaultError
+
+FIELDS = ('binance_api_key', 'binance_secret_key')
+MODELS = (Profile, LinkedAccount)
+
+
+class Command(BaseCommand):
+    help = ('Seals plaintext Binance credentials and rewraps sealed ones '
+            'under the current master key (the first of BOT_VAULT_KEYS), '
+            'streaming through profiles and linked accounts in batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Count the rows that would change without writing them')
+
+    def handle(self, *args, **options):
+        vault = get_vault()
+        if not vault.enabled:
+            raise CommandError('BOT_VAULT_KEYS is not set')
+        batch_size, dry_run = options['batch_size'], options['dry_run']
+        for model in MODELS:
+            self.rotate(model, vault, batch_size, dry_run)
+        vault.cache.clear()
+
+    def rotate(self, model, vault, batch_size, dry_run):
+        last_pk, scanned, changed, failed = 0, 0, 0, 0
+        while True:
+            batch = [*model.objects.filter(pk__gt=last_pk).order_by(
+                'pk').only('pk', 'telegram_chat_id', *FIELDS)[:batch_size]]
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            scanned += len(batch)
+            updated = []
+            for row in batch:
+                try:
+                    values = {
+                        field: vault.rotate(getattr(row, field))
+                        for field in FIELDS}
+                except VaultError as e:
+                    failed += 1
+                    self.stderr.write(f'{model.__name__} {row.pk}: {e}')
+                    continue
+                if any(getattr(row, field) != value
+                       for field, value in values.items()):
+                    for field, value in values.items():
+                        setattr(row, field, value)
+                    updated.append(row)
+            changed += len(updated)
+            if updated and not dry_run:
+                self.save(model, updated)
+            self.stdout.write(
+                f'{model.__name__}: {scanned} scanned, {changed} '
+                f'{"to rotate" if dry_run else "rotated"}, {failed} failed')
+
+    # `Profile.updated` lets running bots pick up the new values: bumped
+    # on the profile itself, or on the one owning a linked account
+    def save(self, model, rows):
+        now = timezone.now()
+        fields = [*FIELDS]
+        if model is Profile:
+            for row in rows:
+                row.updated = now
+            fields.append('updated')
+        with transaction.atomic():
+            model.objects.bulk_update(rows, fields)
+            if model is not Profile:
+                Profile.objects.filter(telegram_chat_id__in={
+                    row.telegram_chat_id for row in rows
+                }).update(updated=now)
@@ -1,10 +1,13 @@
 from django.db.models import QuerySet
 
+STANDARD_FIELDS = (
+    'telegram_chat_id',
+    'binance_api_key', 'binance_secret_key',
+    'notifications', 'notification_filter',
+    'notification_window', 'notification_digest', 'locale',
+)
+
 
 class ProfileQueryset(QuerySet):
     def standard_values(self):
-        return self.values(
-            'telegram_chat_id',
-            'binance_api_key', 'binance_secret_key',
-            'notifications'
-        )
+        return self.values(*STANDARD_FIELDS)
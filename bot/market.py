@@ -0,0 +1,286 @@
+import asyncio
+import logging
+from array import array
+from bisect import bisect_left
+
+from .alerts import SPREAD, AlertIndex
+from .rest import BinanceClient
+
+DEPTH = '/api/v3/depth'
+# Spread alerts only read the top of the book, so the snapshot is a
+# weight 5 request rather than the weight 50 of a full 1000 level one
+SNAPSHOT_LIMIT = 100
+SNAPSHOT_RETRY_DELAY = 5
+MAX_LEVELS = 5000  # per side; levels far from the top are dropped past it
+
+logger = logging.getLogger(__name__)
+
+
+# One side of an order book in two parallel sorted arrays. Keys are signed
+# so that the best level is always the last one: bids keep their price,
+# asks keep the negated price. Lookups are a bisect, and updates near the
+# top of the book only shift the few levels above them.
+class PriceLevels:
+    def __init__(self, sign):
+        self.sign = sign
+        self.keys = array('d')
+        self.quantities = array('d')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self, price, quantity):
+        key = self.sign * price
+        index = bisect_left(self.keys, key)
+        found = index < len(self.keys) and self.keys[index] == key
+        if quantity:
+            if found:
+                self.quantities[index] = quantity
+            else:
+                self.keys.insert(index, key)
+                self.quantities.insert(index, quantity)
+        elif found:
+            del self.keys[index]
+            del self.quantities[index]
+
+    def replace(self, levels):
+        levels = sorted(
+            (self.sign * float(price), float(quantity))
+            for price, quantity in levels if float(quantity))
+        self.keys = array('d', (key for key, _ in levels))
+        self.quantities = array('d', (quantity for _, quantity in levels))
+
+    def trim(self, limit=MAX_LEVELS):
+        if len(self.keys) > 2 * limit:
+            del self.keys[:-limit]
+            del self.quantities[:-limit]
+
+    def best(self):
+        if not self.keys:
+            return None
+        return self.sign * self.keys[-1], self.quantities[-1]
+
+    def top(self, depth):
+        return [
+            (self.sign * self.keys[i], self.quantities[i])
+            for i in range(len(self.keys) - 1,
+                           max(len(self.keys) - depth, 0) - 1, -1)]
+
+
+# Local book kept in sync from `<symbol>@depth` diffs on top of a REST
+# snapshot, following Binance's procedure: diffs are buffered until the
+# snapshot arrives, stale ones are dropped and any gap in update ids
+# forces a new snapshot.
+class OrderBook:
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.bids = PriceLevels(1)
+        self.asks = PriceLevels(-1)
+        self.last_update_id = None
+        self.buffer = []
+
+    @property
+    def synced(self):
+        return self.last_update_id is not None
+
+    def reset(self):
+        self.last_update_id = None
+        self.buffer = []
+
+    def load(self, snapshot):
+        self.bids.replace(snapshot['bids'])
+        self.asks.replace(snapshot['asks'])
+        self.last_update_id = snapshot['lastUpdateId']
+        buffer, self.buffer = self.buffer, []
+        return all(self.apply(diff) for diff in buffer)
+
+    # False when the diff does not follow the book and a resync is needed
+    def apply(self, diff):
+        if not self.synced:
+            self.buffer.append(diff)
+            return True
+        if diff['u'] <= self.last_update_id:
+            return True
+        if diff['U'] > self.last_update_id + 1:
+            self.reset()
+            return False
+        for levels, side in [(diff['b'], self.bids), (diff['a'], self.asks)]:
+            for price, quantity in levels:
+                side.update(float(price), float(quantity))
+        self.bids.trim()
+        self.asks.trim()
+        self.last_update_id = diff['u']
+        return True
+
+    def best_bid(self):
+        return self.bids.best()
+
+    def best_ask(self):
+        return self.asks.best()
+
+    def spread(self):
+        bid, ask = self.bids.best(), self.asks.best()
+        if bid is None or ask is None:
+            return None
+        return ask[0] - bid[0]
+
+
+# Shared state of one symbol, fed by its aggTrade stream, and by its depth
+# stream while it has spread alerts
+class Market:
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.book = OrderBook(symbol)
+        self.last_price = None
+        self.watchers = 0
+        self.alerts = AlertIndex()
+        self.spread_alerts = []
+        self.snapshot = None
+        # Price range of the trades not yet checked against the alerts
+        self.low = self.high = None
+
+    def trade(self, data):
+        price = self.last_price = float(data['p'])
+        if self.low is None:
+            self.low = self.high = price
+        elif price < self.low:
+            self.low = price
+        elif price > self.high:
+            self.high = price
+
+    def take_range(self):
+        low, high, self.low, self.high = self.low, self.high, None, None
+        return low, high
+
+
+# Keeps exactly one aggTrade subscription per symbol on the shared stream
+# multiplexer, however many chats watch it, and evaluates every chat's
+# alerts against that shared state. The depth stream and its snapshot are
+# only taken while the symbol has spread alerts. Alerts are one-shot;
+# price alerts are checked once per loop iteration for all trades
+# received meanwhile.
+class MarketData(BinanceClient):
+    on_armed = None
+
+    def __init__(self, mux):
+        self.mux = mux
+        self.markets = {}
+
+    def streams(self, symbol):
+        symbol = symbol.lower()
+        return f'{symbol}@aggTrade', f'{symbol}@depth@100ms'
+
+    def watch(self, symbol):
+        symbol = symbol.upper()
+        market = self.markets.get(symbol)
+        if market is None:
+            market = self.markets[symbol] = Market(symbol)
+            trades, _ = self.streams(symbol)
+            self.mux.add(trades, lambda data: self.on_trade(market, data))
+        market.watchers += 1
+        return market
+
+    def watch_depth(self, market):
+        _, depth = self.streams(market.symbol)
+        self.mux.add(depth, lambda data: self.on_depth(market, data))
+        self.resync(market)
+
+    def unwatch_depth(self, market):
+        _, depth = self.streams(market.symbol)
+        self.mux.remove(depth)
+        if market.snapshot:
+            market.snapshot.cancel()
+            market.snapshot = None
+        market.book = OrderBook(market.symbol)
+
+    def unwatch(self, symbol):
+        symbol = symbol.upper()
+        market = self.markets.get(symbol)
+        if market is None:
+            return
+        market.watchers -= 1
+        if market.watchers > 0:
+            return
+        del self.markets[symbol]
+        if market.spread_alerts:
+            self.unwatch_depth(market)
+        trades, _ = self.streams(symbol)
+        self.mux.remove(trades)
+
+    def add_alert(self, alert):
+        market = self.watch(alert.symbol)
+        if alert.kind == SPREAD:
+            market.spread_alerts.append(alert)
+            if len(market.spread_alerts) == 1:
+                self.watch_depth(market)
+        else:
+            market.alerts.add(alert)
+
+    def remove_alert(self, alert):
+        market = self.markets.get(alert.symbol)
+        if market is None:
+            return
+        if alert in market.spread_alerts:
+            market.spread_alerts.remove(alert)
+            if not market.spread_alerts:
+                self.unwatch_depth(market)
+        elif alert.pk in market.alerts.rules:
+            market.alerts.remove(alert)
+        else:
+            return
+        self.unwatch(alert.symbol)
+
+    def resync(self, market):
+        market.book.reset()
+        if market.snapshot is None or market.snapshot.done():
+            market.snapshot = asyncio.create_task(
+                self.load_snapshot(market), name=f'snapshot-{market.symbol}')
+
+    async def load_snapshot(self, market):
+        while self.markets.get(market.symbol) is market:
+            try:
+                snapshot = await self.api(
+                    DEPTH, symbol=market.symbol, limit=SNAPSHOT_LIMIT)
+                if 'lastUpdateId' in snapshot and market.book.load(snapshot):
+                    return
+                logger.warning("Depth snapshot rejected", extra={
+                    'symbol': market.symbol,
+                    'response': str(snapshot)[:200]})
+            except Exception as e:
+                logger.warning("Depth snapshot failed", extra={
+                    'symbol': market.symbol, 'error': repr(e)})
+            market.book.reset()
+            await asyncio.sleep(SNAPSHOT_RETRY_DELAY)
+
+    def on_trade(self, market, data):
+        pending = market.low is not None
+        market.trade(data)
+        if not pending:
+            asyncio.get_running_loop().call_soon(self.evaluate_prices, market)
+
+    def evaluate_prices(self, market):
+        low, high = market.take_range()
+        for rule, price in market.alerts.crossed(low, high):
+            rule.callback(rule, price)
+            self.unwatch(market.symbol)
+        armed = market.alerts.arm(market.last_price)
+        if armed and self.on_armed:
+            self.on_armed(armed)
+
+    def on_depth(self, market, data):
+        if not market.book.apply(data):
+            logger.info("Depth gap, resyncing", extra={
+                'symbol': market.symbol})
+            self.resync(market)
+            return
+        if market.book.synced:
+            self.evaluate_spread(market)
+
+    def evaluate_spread(self, market):
+        spread = market.book.spread()
+        if spread is None:
+            return
+        for rule in [
+                rule for rule in market.spread_alerts if spread >= rule.value]:
+            rule.callback(rule, spread)
+            self.remove_alert(rule)
@@ -0,0 +1,116 @@
+import json
+import threading
+from functools import lru_cache
+from pathlib import Path
+from string import Formatter
+
+from django.conf import settings
+
+LOCALES_DIR = Path(__file__).with_name('locales')
+LOCALES = ('ru', 'en')
+DEFAULT_LOCALE = settings.BOT_DEFAULT_LOCALE
+RENDER_CACHE_SIZE = 10000
+MISSING = '—'  # shown for fields the event does not carry
+TRANSLATE = 't'  # `{side!t}` shows the table's `side.BUY` for `BUY`
+
+
+def supported(locale):
+    return locale if locale in LOCALES else DEFAULT_LOCALE
+
+
+# `str.format` syntax parsed once; fields are plain names, and `!t` looks
+# the value up in the string table
+class Template:
+    __slots__ = ('parts', 'fields')
+
+    def __init__(self, text):
+        self.parts = [*Formatter().parse(text)]
+        self.fields = tuple(dict.fromkeys(
+            name for _, name, _, _ in self.parts if name))
+
+    def render(self, values, strings):
+        chunks = []
+        for literal, name, spec, conversion in self.parts:
+            chunks.append(literal)
+            if name is None:
+                continue
+            value = values.get(name)
+            if value is None:
+                chunks.append(MISSING)
+                continue
+            if conversion == TRANSLATE:
+                value = strings.get(f'{name}.{value}', value)
+            chunks.append(format(value, spec))
+        return ''.join(chunks)
+
+
+# Strings of one locale, read from `locales/<locale>.json` on first use;
+# each template is compiled the first time it is rendered
+class StringTable:
+    def __init__(self, locale):
+        self.locale = locale
+        with open(LOCALES_DIR / f'{locale}.json', encoding='utf-8') as file:
+            self.strings = json.load(file)
+        self.templates = {}
+
+    def get(self, key, default=None):
+        return self.strings.get(key, default)
+
+    def template(self, key):
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = Template(self.strings[key])
+        return template
+
+    def text(self, key, **values):
+        return self.template(key).render(values, self)
+
+    def event_key(self, event_type):
+        key = f'event.{event_type}'
+        return key if key in self.strings else 'event.unknown'
+
+
+tables = {}
+tables_lock = threading.Lock()
+
+
+def table(locale=None):
+    locale = supported(locale)
+    strings = tables.get(locale)
+    if strings is None:
+        with tables_lock:
+            strings = tables.get(locale)
+            if strings is None:
+                strings = tables[locale] = StringTable(locale)
+    return strings
+
+
+def text(key, locale=None, **values):
+    return table(locale).text(key, **values)
+
+
+def options(key, locale=None):
+    return table(locale).get(key)
+
+
+# Memoised on the locale, the template and the values of the fields it
+# shows, so events differing only in fields left out share one rendering
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_fields(locale, key, fields):
+    strings = table(locale)
+    template = strings.template(key)
+    return template.render(dict(zip(template.fields, fields)), strings)
+
+
+# Notification text of a user data event, given its display values; a
+# `count` above one adds the number of events folded into it
+def render(event_type, values, locale=None):
+    locale = supported(locale)
+    strings = table(locale)
+    key = strings.event_key(event_type)
+    rendered = render_fields(locale, key, tuple(
+        values.get(name) for name in strings.template(key).fields))
+    count = values.get('count')
+    if count and count > 1:
+        rendered = f"{rendered}\n{strings.text('event.count', count=count)}"
+    return rendered
@@ -0,0 +1,210 @@
+import asyncio
+import copy
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+
+METRICS_PATH = '/metrics'
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+LATENCY_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf'))
+LAG_INTERVAL = .5  # seconds between event-loop lag samples
+
+
+def label_text(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return f'{{{pairs}}}'
+
+
+# Metrics are plain attribute updates on the hot path; all formatting is
+# left to the scrape. Labelled metrics keep one child per label values,
+# a copy of the metric holding its own value.
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.reset()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = copy.copy(self)
+            child.reset()
+        return child
+
+    def samples(self):
+        if not self.label_names:
+            return self.samples_for(self.name, '')
+        return [
+            sample for values, child in sorted(self.children.items())
+            for sample in child.samples_for(
+                self.name, label_text(self.label_names, values))]
+
+    def render(self):
+        return '\n'.join([
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.kind}',
+            *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def reset(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples_for(self, name, labels):
+        return [f'{name}{labels} {self.value}']
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def reset(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    # Read at scrape time, for values the code already keeps (queue sizes)
+    def set_function(self, function):
+        self.function = function
+
+    def samples_for(self, name, labels):
+        value = self.function() if self.function else self.value
+        return [f'{name}{labels} {value}']
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets=LATENCY_BUCKETS, **kwargs):
+        self.buckets = buckets
+        super().__init__(*args, **kwargs)
+
+    def reset(self):
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def samples_for(self, name, labels):
+        samples = []
+        cumulative = 0
+        prefix = labels[:-1] + ',' if labels else '{'
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else f'{bound:g}'
+            samples.append(f'{name}_bucket{prefix}le="{le}"}} {cumulative}')
+        return samples + [
+            f'{name}_sum{labels} {self.sum}',
+            f'{name}_count{labels} {self.count}']
+
+
+class Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+REGISTRY = []
+
+SOCKETS = Gauge(
+    'bot_stream_sockets', 'Open combined-stream websocket connections')
+STREAMS = Gauge('bot_streams', 'Streams routed by the multiplexer')
+QUEUE_DEPTH = Gauge(
+    'bot_profile_queue_depth', 'Profile updates waiting for reconciliation')
+ACCOUNTS = Gauge(
+    'bot_accounts', 'Binance accounts known to the manager, one stream each')
+SUBSCRIPTIONS = Gauge(
+    'bot_account_subscriptions', 'Chat subscriptions to Binance accounts')
+FRAMES = Counter('bot_frames_received_total', 'Websocket data frames routed')
+LISTEN_KEY_LATENCY = Histogram(
+    'bot_listen_key_seconds', 'listenKey create and keep-alive latency',
+    labels=('operation',))
+LISTEN_KEY_FAILURES = Counter(
+    'bot_listen_key_failures_total', 'Failed listenKey requests',
+    labels=('operation',))
+LISTEN_KEYS_RESUMED = Counter(
+    'bot_listen_keys_resumed_total',
+    'listenKeys taken over from a checkpoint instead of requested')
+TELEGRAM_LATENCY = Histogram(
+    'bot_telegram_send_seconds', 'Telegram Bot API call latency',
+    labels=('method',))
+TELEGRAM_FAILURES = Counter(
+    'bot_telegram_failures_total', 'Telegram calls that raised',
+    labels=('method',))
+REST_REQUESTS = Counter(
+    'bot_rest_requests_total', 'Binance REST calls by how they were served',
+    labels=('outcome',))
+REST_WAITS = Counter(
+    'bot_rest_weight_waits_total', 'Waits for the REST weight budget')
+REST_WEIGHT = Gauge(
+    'bot_rest_used_weight', 'Request weight used in the current minute')
+OUTBOX_DEPTH = Gauge('bot_outbox_depth', 'Messages waiting in the outbox')
+LOOP_LAG = Histogram(
+    'bot_loop_lag_seconds', 'Event-loop lag, sampled every half second')
+
+
+def render():
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+# Sleeps for a fixed interval and records how late it wakes up: the time
+# the loop spent on other callbacks past the deadline
+async def monitor_loop_lag(interval=LAG_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0, loop.time() - started - interval))
+
+
+async def handle_metrics(request):
+    return web.Response(
+        body=render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+# Serves `/metrics` next to the bot on its own event loop
+class MetricsServer:
+    def __init__(self, port, host='0.0.0.0'):
+        self.host, self.port = host, port
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get(METRICS_PATH, handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
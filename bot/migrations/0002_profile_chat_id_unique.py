@@ -0,0 +1,39 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:43
+
+from django.db import migrations, models
+
+
+# Keeps the most recent row for every chat before the unique constraint
+def drop_duplicate_chats(apps, schema_editor):
+    Profile = apps.get_model('bot', 'Profile')
+    seen = set()
+    duplicates = []
+    for pk, chat_id in Profile.objects.order_by('-id').values_list(
+            'id', 'telegram_chat_id').iterator():
+        if chat_id is None:
+            continue
+        if chat_id in seen:
+            duplicates.append(pk)
+        seen.add(chat_id)
+    Profile.objects.filter(id__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='Изменён'),
+        ),
+        migrations.RunPython(drop_duplicate_chats, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='profile',
+            name='telegram_chat_id',
+            field=models.CharField(blank=True, max_length=128, null=True, unique=True, verbose_name='ID пользователя'),
+        ),
+    ]
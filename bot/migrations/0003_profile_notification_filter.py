@@ -0,0 +1,18 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0002_profile_chat_id_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='notification_filter',
+            field=models.CharField(choices=[('default', 'Ордера и балансы'), ('orders', 'Только ордера'), ('all', 'Все события')], default='default', max_length=16, verbose_name='Фильтр уведомлений'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0003_profile_notification_filter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Alert',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('telegram_chat_id', models.CharField(db_index=True, max_length=128, verbose_name='ID пользователя')),
+                ('symbol', models.CharField(max_length=20, verbose_name='Пара')),
+                ('kind', models.CharField(choices=[('above', 'Цена выше'), ('below', 'Цена ниже'), ('move', 'Изменение, %')], max_length=8, verbose_name='Тип')),
+                ('value', models.FloatField(verbose_name='Порог')),
+                ('reference', models.FloatField(blank=True, null=True, verbose_name='Цена отсчёта')),
+                ('active', models.BooleanField(db_index=True, default=True, verbose_name='Активно')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('triggered', models.DateTimeField(blank=True, null=True, verbose_name='Сработало')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0004_alert'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='notification_digest',
+            field=models.BooleanField(default=False, verbose_name='Сводка раз в час'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='notification_window',
+            field=models.PositiveSmallIntegerField(default=2, verbose_name='Окно группировки уведомлений, с'),
+        ),
+    ]
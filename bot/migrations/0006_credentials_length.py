@@ -0,0 +1,23 @@
+# Generated by Django 3.1.5 on 2026-10-18 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0005_profile_notification_window'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='profile',
+            name='binance_api_key',
+            field=models.CharField(blank=True, max_length=512, null=True, verbose_name='API ключ Binance'),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='binance_secret_key',
+            field=models.CharField(blank=True, max_length=512, null=True, verbose_name='Секретный ключ Binance'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.5 on 2026-10-18 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0006_credentials_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LinkedAccount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('telegram_chat_id', models.CharField(db_index=True, max_length=128, verbose_name='ID пользователя')),
+                ('label', models.CharField(max_length=32, verbose_name='Название')),
+                ('binance_api_key', models.CharField(max_length=512, verbose_name='API ключ Binance')),
+                ('binance_secret_key', models.CharField(blank=True, max_length=512, verbose_name='Секретный ключ Binance')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Создан')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.5 on 2026-10-19 00:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0007_linkedaccount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='locale',
+            field=models.CharField(blank=True, choices=[('ru', 'Русский'), ('en', 'English')], default='', max_length=8, verbose_name='Язык'),
+        ),
+    ]
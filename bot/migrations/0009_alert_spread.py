@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0008_profile_locale'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='alert',
+            name='kind',
+            field=models.CharField(choices=[('above', 'Цена выше'), ('below', 'Цена ниже'), ('move', 'Изменение, %'), ('spread', 'Спред')], max_length=8, verbose_name='Тип'),
+        ),
+    ]
@@ -1,4 +1,7 @@
 from django.db import models
+from .alerts import ABOVE, BELOW, MOVE, SPREAD
+from .delivery import COALESCE_WINDOW
+from .events import FILTER_ALL, FILTER_DEFAULT, FILTER_ORDERS
 from .managers import ProfileQueryset
 
 
@@ -6,19 +9,91 @@ class Profile(models.Model):
     telegram_chat_id = models.CharField(
         max_length=128,
         verbose_name="ID пользователя",
-        null=True, blank=True,
+        null=True, blank=True, unique=True,
     )
+    # Sealed by `vault.Vault` when BOT_VAULT_KEYS is set
     binance_api_key = models.CharField(
-        max_length=128,
+        max_length=512,
         verbose_name="API ключ Binance",
         null=True, blank=True,
     )
     binance_secret_key = models.CharField(
-        max_length=128,
+        max_length=512,
         verbose_name="Секретный ключ Binance",
         null=True, blank=True,
     )
     notifications = models.BooleanField(
         default=True, editable=True, verbose_name='Уведомления')
+    notification_filter = models.CharField(
+        max_length=16,
+        choices=[
+            (FILTER_DEFAULT, 'Ордера и балансы'),
+            (FILTER_ORDERS, 'Только ордера'),
+            (FILTER_ALL, 'Все события'),
+        ],
+        default=FILTER_DEFAULT,
+        verbose_name='Фильтр уведомлений',
+    )
+    notification_window = models.PositiveSmallIntegerField(
+        default=COALESCE_WINDOW,
+        verbose_name='Окно группировки уведомлений, с',
+    )
+    notification_digest = models.BooleanField(
+        default=False, verbose_name='Сводка раз в час')
+    # Blank for BOT_DEFAULT_LOCALE
+    locale = models.CharField(
+        max_length=8,
+        choices=[('ru', 'Русский'), ('en', 'English')],
+        blank=True, default='',
+        verbose_name='Язык',
+    )
+    updated = models.DateTimeField(
+        auto_now=True, db_index=True, verbose_name='Изменён')
 
     objects = ProfileQueryset.as_manager()
+
+
+class Alert(models.Model):
+    ABOVE, BELOW, MOVE, SPREAD = ABOVE, BELOW, MOVE, SPREAD
+
+    telegram_chat_id = models.CharField(
+        max_length=128,
+        verbose_name="ID пользователя",
+        db_index=True,
+    )
+    symbol = models.CharField(max_length=20, verbose_name='Пара')
+    kind = models.CharField(
+        max_length=8,
+        choices=[
+            (ABOVE, 'Цена выше'),
+            (BELOW, 'Цена ниже'),
+            (MOVE, 'Изменение, %'),
+            (SPREAD, 'Спред'),
+        ],
+        verbose_name='Тип',
+    )
+    value = models.FloatField(verbose_name='Порог')
+    reference = models.FloatField(
+        null=True, blank=True, verbose_name='Цена отсчёта')
+    active = models.BooleanField(
+        default=True, db_index=True, verbose_name='Активно')
+    created = models.DateTimeField(auto_now_add=True, verbose_name='Создано')
+    triggered = models.DateTimeField(
+        null=True, blank=True, verbose_name='Сработало')
+
+
+# Binance account followed by a chat in addition to the profile's own key
+# pair. Chats linking the same key share one user data stream.
+class LinkedAccount(models.Model):
+    telegram_chat_id = models.CharField(
+        max_length=128,
+        verbose_name="ID пользователя",
+        db_index=True,
+    )
+    label = models.CharField(max_length=32, verbose_name='Название')
+    # Sealed by `vault.Vault` when BOT_VAULT_KEYS is set
+    binance_api_key = models.CharField(
+        max_length=512, verbose_name="API ключ Binance")
+    binance_secret_key = models.CharField(
+        max_length=512, blank=True, verbose_name="Секретный ключ Binance")
+    created = models.DateTimeField(auto_now_add=True, verbose_name='Создан')
@@ -0,0 +1,106 @@
+import time
+from decimal import Decimal
+
+from . import messages
+from .rest import BinanceClient
+
+TICKER_PRICE = '/api/v3/ticker/price'
+PRICE_TTL = 10
+QUOTE = 'USDT'
+BRIDGE = 'BTC'  # assets without a USDT pair are valued through it
+MAX_LINES = 30
+
+
+# Balances of one account, loaded once over REST and then kept current by
+# the user data stream: `outboundAccountPosition` carries absolute free
+# and locked amounts of the assets it lists, `balanceUpdate` a free delta.
+# Binance follows a delta with a position that already includes it, and
+# either may arrive first, so each asset keeps the event time (`E`) of
+# its amounts, and only newer events change them.
+class Balances:
+    def __init__(self):
+        self.assets = {}
+        self.times = {}
+        self.loaded = False
+
+    def load(self, account):
+        updated = account.get('updateTime', 0)
+        for balance in account['balances']:
+            self.set(balance['asset'], updated, (
+                Decimal(balance['free']), Decimal(balance['locked'])))
+        self.loaded = True
+
+    def set(self, asset, updated, amounts):
+        if updated >= self.times.get(asset, 0):
+            self.assets[asset] = amounts
+            self.times[asset] = updated
+
+    def apply(self, msg):
+        event_type, updated = msg.get('e'), msg.get('E', 0)
+        if event_type == 'outboundAccountPosition':
+            for balance in msg.get('B') or ():
+                self.set(balance['a'], updated, (
+                    Decimal(balance['f']), Decimal(balance['l'])))
+        elif (event_type == 'balanceUpdate'
+              and updated > self.times.get(msg['a'], 0)):
+            free, locked = self.assets.get(msg['a'], (0, 0))
+            self.set(msg['a'], updated, (free + Decimal(msg['d']), locked))
+
+    def held(self):
+        return {
+            asset: free + locked
+            for asset, (free, locked) in self.assets.items() if free + locked}
+
+
+# Last prices of every symbol, fetched in one request and shared by all
+# accounts; concurrent refreshes are coalesced by the client
+class PriceCache(BinanceClient):
+    def __init__(self, ttl=PRICE_TTL):
+        self.ttl = ttl
+        self.prices = {}
+        self.expires = 0
+
+    async def get(self):
+        if time.monotonic() >= self.expires:
+            tickers = await self.api(TICKER_PRICE)
+            self.prices = {
+                ticker['symbol']: Decimal(ticker['price'])
+                for ticker in tickers}
+            self.expires = time.monotonic() + self.ttl
+        return self.prices
+
+    def value(self, prices, asset, amount):
+        if asset == QUOTE:
+            return amount
+        if f'{asset}{QUOTE}' in prices:
+            return amount * prices[f'{asset}{QUOTE}']
+        if f'{asset}{BRIDGE}' in prices and f'{BRIDGE}{QUOTE}' in prices:
+            return (amount * prices[f'{asset}{BRIDGE}']
+                    * prices[f'{BRIDGE}{QUOTE}'])
+        return None
+
+
+def format_portfolio(held, values, locale=None):
+    if not held:
+        return messages.text('portfolio.empty', locale)
+    rows = sorted(
+        held.items(), key=lambda item: values.get(item[0]) or 0, reverse=True)
+    lines = [messages.text('portfolio.title', locale)]
+    for asset, amount in rows[:MAX_LINES]:
+        value = values.get(asset)
+        lines.append(
+            messages.text(
+                'portfolio.line', locale, asset=asset,
+                amount=f'{amount.normalize():f}', value=f'{value:.2f}',
+                quote=QUOTE)
+            if value is not None else
+            messages.text(
+                'portfolio.unpriced', locale, asset=asset,
+                amount=f'{amount.normalize():f}'))
+    if len(rows) > MAX_LINES:
+        lines.append(messages.text(
+            'portfolio.more', locale, count=len(rows) - MAX_LINES))
+    total = sum(value for value in values.values() if value is not None)
+    lines.append(messages.text(
+        'portfolio.total', locale, total=f'{total:.2f}', quote=QUOTE))
+    return '\n'.join(lines)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+HEARTBEAT = .01  # seconds between loop heartbeats
+SAMPLE_INTERVAL = .005  # seconds between stack samples of a stalled loop
+SLOW_THRESHOLD = .1  # seconds the loop may be busy before it is sampled
+DUMP_INTERVAL = 60
+MAX_DEPTH = 64
+
+logger = logging.getLogger(__name__)
+
+
+# `co_qualname` is only there from Python 3.11
+def frame_name(frame):
+    code = frame.f_code
+    module = frame.f_globals.get('__name__', '?')
+    return f'{module}.{getattr(code, "co_qualname", code.co_name)}'
+
+
+# Chat of the innermost frame working on behalf of a chat or an account,
+# whose chat is its first subscriber. The frames belong to the loop
+# thread and keep running meanwhile, so only plain instance attributes
+# are read, never properties, and a frame changing under the sample gives
+# up rather than breaking the watchdog.
+def frame_account(frame):
+    try:
+        while frame is not None:
+            for name in ('self', 'account'):
+                attributes = getattr(frame.f_locals.get(name), '__dict__', {})
+                chat_id = attributes.get('chat_id')
+                if chat_id is None:
+                    chat_id = next(iter(attributes.get('subscribers', ())),
+                                   None)
+                if chat_id is not None:
+                    return chat_id
+            frame = frame.f_back
+    except Exception:
+        pass
+    return None
+
+
+def task_name(loop):
+    task = asyncio.current_task(loop)
+    return task.get_name() if task else 'callback'
+
+
+# Watches the event loop from a separate thread. The loop bumps a heartbeat
+# every few milliseconds; while the heartbeat is late by more than the
+# threshold, the loop thread's stack is sampled. Samples are counted per
+# task, chat and stack in the collapsed format read by flamegraph.pl and
+# speedscope, and every stall is logged with its duration and top frame.
+class LoopProfiler:
+    def __init__(self, loop, output, threshold=SLOW_THRESHOLD):
+        self.loop = loop
+        self.output = Path(output)
+        self.threshold = threshold
+        self.samples = Counter()
+        self.stalls = 0
+        self.stalled = 0
+        self.lag_max = 0
+        self.beat = time.monotonic()
+        self.thread_id = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.watch, name='loop-profiler', daemon=True)
+        self.dumped = time.monotonic()
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.loop.call_soon(self.heartbeat)
+        self.thread.start()
+        logger.info("Loop profiler started", extra={
+            'threshold_ms': self.threshold * 1000, 'output': str(self.output)})
+
+    def heartbeat(self):
+        self.beat = time.monotonic()
+        if not self.stopped.is_set():
+            self.loop.call_later(HEARTBEAT, self.heartbeat)
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return None
+        stack = []
+        innermost = frame
+        while frame is not None and len(stack) < MAX_DEPTH:
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+        account = frame_account(innermost)
+        prefix = [f'task:{task_name(self.loop)}']
+        if account is not None:
+            prefix.append(f'chat:{account}')
+        self.samples[';'.join(prefix + stack[::-1])] += 1
+        return prefix, stack[0] if stack else '?'
+
+    def watch(self):
+        stall = None
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            now = time.monotonic()
+            lag = now - self.beat - HEARTBEAT
+            if lag > self.threshold:
+                where = self.sample()
+                if stall is None:
+                    stall = self.beat, where
+            elif stall is not None:
+                self.finish(stall, now)
+                stall = None
+            if now - self.dumped >= DUMP_INTERVAL:
+                self.dump()
+
+    def finish(self, stall, now):
+        started, where = stall
+        duration = self.beat - started - HEARTBEAT
+        self.stalls += 1
+        self.stalled += duration
+        self.lag_max = max(self.lag_max, duration)
+        prefix, top = where or ([], '?')
+        logger.warning("Event loop stalled", extra={
+            'duration_ms': round(duration * 1000, 1),
+            'where': ';'.join(prefix), 'frame': top})
+
+    def dump(self):
+        self.dumped = time.monotonic()
+        samples = self.samples.copy()
+        with open(self.output, 'w') as output:
+            for stack, count in samples.most_common():
+                output.write(f'{stack} {count}\n')
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.dump()
+        logger.info("Loop profiler stopped", extra={
+            'stalls': self.stalls, 'stalled_s': round(self.stalled, 3),
+            'lag_max_ms': round(self.lag_max * 1000, 1),
+            'output': str(self.output)})
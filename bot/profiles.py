@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import resource
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.utils import timezone
+
+from .managers import STANDARD_FIELDS
+from .models import LinkedAccount, Profile
+
+FLUSH_INTERVAL = 2
+REFRESH_INTERVAL = 30
+BATCH_SIZE = 500
+PROGRESS_INTERVAL = 10
+MAX_ACCOUNTS_PER_CHAT = 10  # linked, besides the profile's own key pair
+
+logger = logging.getLogger(__name__)
+
+
+def profile_values(profile):
+    return {field: getattr(profile, field) for field in STANDARD_FIELDS}
+
+
+def account_values(account):
+    return {
+        'pk': account.pk, 'label': account.label,
+        'binance_api_key': account.binance_api_key,
+        'binance_secret_key': account.binance_secret_key,
+    }
+
+
+# chat id -> linked accounts, for the chats of one warm-up chunk
+def load_accounts(chat_ids):
+    accounts = {}
+    for account in LinkedAccount.objects.filter(
+            telegram_chat_id__in=chat_ids).order_by('pk'):
+        accounts.setdefault(account.telegram_chat_id, []).append(
+            account_values(account))
+    return {chat_id: tuple(values) for chat_id, values in accounts.items()}
+
+
+# In-memory profiles keyed by chat id. Reads are served from memory once the
+# table is loaded; writes are collected and flushed in batches, and rows
+# changed elsewhere (e.g. in the admin) are picked up by `refresh`.
+class ProfileStore:
+    def __init__(self):
+        self.profiles = {}
+        self.created = set()
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.synced = timezone.now()
+
+    def __len__(self):
+        return len(self.profiles)
+
+    def __contains__(self, chat_id):
+        return chat_id in self.profiles
+
+    def load(self, profiles, complete=True):
+        with self.lock:
+            for profile in profiles:
+                self.profiles.setdefault(profile.telegram_chat_id, profile)
+            self.loaded = self.loaded or complete
+
+    # Next `size` rows after `last_pk`, as cached profiles
+    def load_chunk(self, last_pk, size):
+        chunk = [*Profile.objects.filter(pk__gt=last_pk).order_by('pk')[:size]]
+        self.load(chunk, complete=False)
+        return (
+            chunk[-1].pk if chunk else None,
+            [self.profiles[profile.telegram_chat_id] for profile in chunk])
+
+    def get(self, chat_id):
+        profile = self.profiles.get(chat_id)
+        if profile is None and not self.loaded:
+            profile = Profile.objects.filter(telegram_chat_id=chat_id).first()
+            if profile:
+                self.load([profile], complete=False)
+        return profile
+
+    def get_or_create(self, chat_id):
+        profile = self.get(chat_id)
+        if profile is not None:
+            return profile, False
+        with self.lock:
+            profile = self.profiles.get(chat_id)
+            if profile is None:
+                profile = self.profiles[chat_id] = Profile(
+                    telegram_chat_id=chat_id)
+                self.created.add(chat_id)
+                return profile, True
+        return profile, False
+
+    def update(self, chat_id, **fields):
+        profile, _ = self.get_or_create(chat_id)
+        with self.lock:
+            for field, value in fields.items():
+                setattr(profile, field, value)
+            if chat_id not in self.created:
+                self.dirty.setdefault(chat_id, set()).update(fields)
+        return profile
+
+    def take_pending(self):
+        with self.lock:
+            created, self.created = self.created, set()
+            dirty, self.dirty = self.dirty, {}
+        return (
+            [self.profiles[chat_id] for chat_id in created],
+            [self.profiles[chat_id] for chat_id in dirty],
+            {field for fields in dirty.values() for field in fields},
+        )
+
+    def restore(self, created, updated, fields):
+        with self.lock:
+            self.created.update(p.telegram_chat_id for p in created)
+            for profile in updated:
+                self.dirty.setdefault(
+                    profile.telegram_chat_id, set()).update(fields)
+
+    def flush(self):
+        pending = created, updated, fields = self.take_pending()
+        if not (created or updated):
+            return
+        try:
+            self.write(created, updated, fields)
+        except Exception:
+            self.restore(*pending)
+            raise
+
+    def write(self, created, updated, fields):
+        now = timezone.now()
+        with transaction.atomic():
+            for profile in created + updated:
+                profile.updated = now
+            if created:
+                Profile.objects.bulk_create(
+                    created, batch_size=BATCH_SIZE, ignore_conflicts=True)
+                # The row may have been created by another process, and
+                # backends without RETURNING leave primary keys unset:
+                # resolve them and write our values over
+                pks = dict(Profile.objects.filter(telegram_chat_id__in=[
+                    profile.telegram_chat_id for profile in created
+                ]).values_list('telegram_chat_id', 'pk'))
+                for profile in created:
+                    profile.pk = pks.get(profile.telegram_chat_id)
+                Profile.objects.bulk_update(
+                    created, [*STANDARD_FIELDS, 'updated'],
+                    batch_size=BATCH_SIZE)
+            if updated:
+                Profile.objects.bulk_update(
+                    updated, [*fields, 'updated'], batch_size=BATCH_SIZE)
+
+    # Chat ids whose rows were changed outside of this store, with their
+    # linked accounts: a row this store wrote carries the `updated` it was
+    # given, and rotating credentials bumps the `updated` of the profiles
+    # owning the linked accounts it re-seals
+    def refresh(self):
+        synced, self.synced = self.synced, timezone.now()
+        changed = []
+        for profile in Profile.objects.filter(updated__gt=synced).iterator():
+            chat_id = profile.telegram_chat_id
+            with self.lock:
+                if chat_id in self.dirty or chat_id in self.created:
+                    continue
+                cached = self.profiles.get(chat_id)
+                if cached and cached.updated == profile.updated:
+                    continue
+                if cached or self.loaded:
+                    self.profiles[chat_id] = profile
+                    changed.append(chat_id)
+        accounts = load_accounts(changed) if changed else {}
+        return {chat_id: accounts.get(chat_id, ()) for chat_id in changed}
+
+    async def run(self, on_changed=None):
+        ticks = 0
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            ticks += 1
+            try:
+                await sync_to_async(self.flush)()
+                if ticks * FLUSH_INTERVAL % REFRESH_INTERVAL == 0:
+                    changed = await sync_to_async(self.refresh)()
+                    if changed and on_changed:
+                        on_changed(changed)
+            except Exception as e:
+                logger.error("Profile store sync failed", extra={
+                    'error': repr(e)})
+
+
+class WarmupProgress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.started = self.reported = time.monotonic()
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.done / elapsed if elapsed else 0
+
+    def advance(self):
+        self.done += 1
+        if time.monotonic() - self.reported >= PROGRESS_INTERVAL:
+            self.reported = time.monotonic()
+            self.report()
+
+    def report(self):
+        rate = self.rate
+        left = max(self.total - self.done, 0)
+        eta = left / rate if rate else 0
+        percent = self.done / self.total * 100 if self.total else 100
+        logger.info("Warm-up progress", extra={
+            'done': self.done, 'total': self.total,
+            'percent': round(percent, 1), 'rate': round(rate, 1),
+            'eta_s': round(eta)})
+
+    def finish(self):
+        elapsed = time.monotonic() - self.started
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+        logger.info("Warm-up done", extra={
+            'done': self.done, 'elapsed_s': round(elapsed, 1),
+            'peak_rss_mb': peak})
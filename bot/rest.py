@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import time
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+
+from .core import ConnectionManager
+from .events import loads
+from .metrics import REST_REQUESTS, REST_WAITS, REST_WEIGHT
+
+BASE_URL = settings.BINANCE_API_URL
+RECV_WINDOW = 5000
+WEIGHT_HEADER = 'X-MBX-USED-WEIGHT-1M'
+ORDER_COUNT_HEADER = 'X-MBX-ORDER-COUNT-'
+WEIGHT_WINDOW = 60  # seconds; Binance counts weight per calendar minute
+WEIGHT_HEADROOM = .9  # share of the limit spent before requests queue
+BANNED = {418, 429}
+# Request weights; callables take the request parameters
+WEIGHTS = {
+    '/api/v3/depth': lambda params: (
+        5 if params.get('limit', 100) <= 100 else
+        25 if params['limit'] <= 500 else
+        50 if params['limit'] <= 1000 else 250),
+    '/api/v3/exchangeInfo': 20,
+    '/api/v3/ticker/price': lambda params: 2 if 'symbol' in params else 4,
+    '/api/v3/openOrders': lambda params: 6 if 'symbol' in params else 80,
+    '/api/v3/myTrades': 20,
+    '/api/v3/account': 20,
+    '/api/v3/userDataStream': 2,
+}
+# Seconds public responses are reused for
+CACHE_TTL = {
+    '/api/v3/exchangeInfo': 60 * 60,
+    '/api/v3/ticker/price': 2,
+}
+CACHE_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class BinanceError(Exception):
+    def __init__(self, status, code=None, message=None):
+        super().__init__(f"{status} {code}: {message}")
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+def request_weight(path, params):
+    weight = WEIGHTS.get(path, 1)
+    return weight(params) if callable(weight) else weight
+
+
+# Request weight left to this IP in the current minute. Our own count is
+# corrected by the used-weight header of every response, which Binance
+# keeps per IP, so other processes (shards) sharing the IP are accounted
+# for too. Requests past the headroom wait for the next window, in order;
+# a 429/418 blocks everything until its Retry-After.
+class WeightBudget:
+    def __init__(self, host, limit=None):
+        self.host = host
+        self.limit = limit or settings.BOT_REST_WEIGHT_LIMIT
+        self.used = 0
+        self.window = 0
+        self.blocked_until = 0
+        self.order_counts = {}
+        self.lock = asyncio.Lock()
+
+    def roll(self, now):
+        window = int(now // WEIGHT_WINDOW)
+        if window != self.window:
+            self.window, self.used = window, 0
+
+    async def acquire(self, weight):
+        async with self.lock:
+            while True:
+                now = time.time()
+                self.roll(now)
+                if self.blocked_until > now:
+                    delay = self.blocked_until - now
+                elif self.used + weight > self.limit * WEIGHT_HEADROOM:
+                    delay = (self.window + 1) * WEIGHT_WINDOW - now
+                else:
+                    self.used += weight
+                    return
+                REST_WAITS.inc()
+                await asyncio.sleep(delay)
+
+    def update(self, status, headers):
+        self.roll(time.time())
+        used = headers.get(WEIGHT_HEADER)
+        if used is not None:
+            self.used = max(self.used, int(used))
+        for name, value in headers.items():
+            if name.upper().startswith(ORDER_COUNT_HEADER):
+                self.order_counts[name[len(ORDER_COUNT_HEADER):]] = int(value)
+        if status in BANNED:
+            retry_after = int(headers.get('Retry-After') or WEIGHT_WINDOW)
+            self.blocked_until = time.time() + retry_after
+            logger.warning("REST weight limit hit", extra={
+                'host': self.host, 'status': status,
+                'retry_after': retry_after})
+        REST_WEIGHT.set(self.used)
+
+    def __repr__(self):
+        return (f'<WeightBudget {self.host} used={self.used}/{self.limit} '
+                f'orders={self.order_counts}>')
+
+
+# Binance REST on the shared session. Every call is charged against the
+# per-IP weight budget; signed calls add the HMAC signature of the
+# account's secret key. Identical public GETs issued at the same time
+# share one upstream request, and slowly changing ones are cached.
+class BinanceClient(ConnectionManager):
+    api_key = None
+    secret_key = None
+    budgets = {}
+    cache = {}
+    inflight = {}
+
+    @classmethod
+    def budget(cls, url):
+        host = urlsplit(url).hostname
+        budget = cls.budgets.get(host)
+        if budget is None:
+            budget = cls.budgets[host] = WeightBudget(host)
+        return budget
+
+    def get_api_key_header(self):
+        return {"X-MBX-APIKEY": self.api_key or ''}
+
+    def sign(self, params):
+        params = {
+            **params, 'timestamp': int(time.time() * 1000),
+            'recvWindow': RECV_WINDOW}
+        params['signature'] = hmac.new(
+            self.secret_key.encode(), urlencode(params).encode(),
+            hashlib.sha256).hexdigest()
+        return params
+
+    # `keyed` sends the API key header, `signed` also signs the parameters
+    async def api(self, path, method='get', keyed=False, signed=False,
+                  **params):
+        if keyed or signed or method != 'get':
+            return await self.call(path, method, keyed, signed, params)
+        key = path, tuple(sorted(params.items()))
+        cached = self.cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            REST_REQUESTS.labels('cached').inc()
+            return cached[1]
+        future = self.inflight.get(key)
+        if future is not None:
+            REST_REQUESTS.labels('coalesced').inc()
+            return await asyncio.shield(future)
+        future = self.inflight[key] = asyncio.ensure_future(
+            self.call(path, method, keyed, signed, params))
+        try:
+            data = await asyncio.shield(future)
+        finally:
+            self.inflight.pop(key, None)
+        if path in CACHE_TTL:
+            self.store(key, data, CACHE_TTL[path])
+        return data
+
+    @classmethod
+    def store(cls, key, data, ttl):
+        now = time.monotonic()
+        if len(cls.cache) >= CACHE_SIZE:
+            for stale in [k for k, v in cls.cache.items() if v[0] <= now]:
+                del cls.cache[stale]
+            if len(cls.cache) >= CACHE_SIZE:
+                del cls.cache[next(iter(cls.cache))]
+        cls.cache[key] = now + ttl, data
+
+    async def call(self, path, method, keyed, signed, params):
+        url = f'{BASE_URL}{path}'
+        budget = self.budget(url)
+        await budget.acquire(request_weight(path, params))
+        kwargs = {}
+        if keyed or signed:
+            kwargs['headers'] = self.get_api_key_header()
+        if params or signed:
+            kwargs['params'] = self.sign(params) if signed else params
+        REST_REQUESTS.labels('sent').inc()
+        status, headers, text = await self.fetch(url, method, **kwargs)
+        budget.update(status, headers)
+        try:
+            data = loads(text)
+        except ValueError:
+            raise BinanceError(status, message=text[:200])
+        error = data if isinstance(data, dict) else {}
+        if status >= 400 or error.get('code', 0) < 0:
+            raise BinanceError(status, error.get('code'), error.get('msg'))
+        return data
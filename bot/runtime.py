@@ -0,0 +1,85 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+
+from .binance_utils import BinanceAccountsManager
+from .core import ConnectionManager
+from .metrics import MetricsServer, monitor_loop_lag
+from .profiler import LoopProfiler
+from .sharding import ShardCoordinator
+from .telegram_utils import BinanceBot
+
+logger = logging.getLogger(__name__)
+
+
+# Telegram front-end and accounts manager sharing one event loop; used by
+# the `bot` command (long polling) and by the ASGI app (webhook)
+class BotRuntime:
+    # `profile`: (output path, threshold in seconds) to run the loop
+    # profiler, in every shard too
+    def __init__(self, loop, shards=0, webhook=None, metrics_port=None,
+                 profile=None):
+        self.loop = loop
+        self.shards = shards
+        self.webhook = webhook
+        self.metrics = metrics_port and MetricsServer(metrics_port)
+        self.profile = profile
+        self.profiler = profile and LoopProfiler(loop, *profile)
+        self.bot = None
+        self.coordinator = None
+        self.manager = None
+        self.polling = None
+
+    async def start(self):
+        queue = asyncio.Queue()
+        if self.profiler:
+            self.profiler.start()
+        self.loop.create_task(monitor_loop_lag())
+        if self.metrics:
+            await self.metrics.start()
+        self.bot = BinanceBot(self.loop, queue)
+        await self.bot.create_dispatcher()
+        if self.shards:
+            self.coordinator = ShardCoordinator(
+                queue, self.shards, self.profile)
+            self.loop.create_task(self.coordinator.subscribe())
+            self.bot.on_portfolio = self.coordinator.portfolio
+            self.coordinator.on_alert_fired = self.bot.forget_alert
+        else:
+            self.manager = BinanceAccountsManager(queue)
+            self.loop.create_task(self.manager.subscribe())
+            self.bot.on_portfolio = self.manager.portfolio
+        if self.webhook:
+            await self.bot.set_webhook(*self.webhook)
+        else:
+            self.polling = self.loop.create_task(self.bot.poll_updates())
+
+    async def stop(self):
+        if self.polling:
+            self.polling.cancel()
+        logger.info("HTTP pool", extra={
+            'stats': vars(ConnectionManager.pool_stats)})
+        if self.coordinator:
+            await self.coordinator.stop()
+        if self.manager:
+            await self.manager.stop()
+        if self.bot:
+            logger.info("Handlers", extra={
+                'stats': vars(self.bot.handler_stats)})
+            logger.info("Coalescer", extra={
+                'received': self.bot.coalescer.received,
+                'sent': self.bot.coalescer.sent})
+            self.bot.coalescer.flush_all()
+            logger.info("Outbox", extra={
+                'depth': self.bot.outbox.depth,
+                'stats': self.bot.outbox.stats.as_dict()})
+            await self.bot.outbox.stop()
+            await sync_to_async(self.bot.store.flush)()
+        if self.manager:
+            self.manager.journal.close()
+        if self.metrics:
+            await self.metrics.stop()
+        if self.profiler:
+            self.profiler.stop()
+        await ConnectionManager.close_session()
@@ -0,0 +1,337 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+from pathlib import Path
+from queue import Empty
+
+from . import messages
+from .binance_utils import BinanceAccountsManager
+from .delivery import DRAIN_TIMEOUT
+from .vault import get_vault, VaultError
+
+REPLICAS = 100  # virtual nodes per shard
+HANDOVER_TIMEOUT = 60
+SUPERVISE_INTERVAL = 5
+LISTEN_TIMEOUT = 1
+# Seconds a stopping worker gets to drain its outbox and exit
+STOP_TIMEOUT = DRAIN_TIMEOUT + 5
+
+logger = logging.getLogger(__name__)
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    def __init__(self, shards=(), replicas=REPLICAS):
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+        for shard in shards:
+            self.add(shard)
+
+    def __len__(self):
+        return len(self.points) // self.replicas
+
+    def __contains__(self, shard):
+        return shard in self.owners
+
+    def add(self, shard):
+        for replica in range(self.replicas):
+            point = ring_hash(f'{shard}:{replica}')
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, shard)
+
+    def remove(self, shard):
+        keep = [i for i, owner in enumerate(self.owners) if owner != shard]
+        self.points = [self.points[i] for i in keep]
+        self.owners = [self.owners[i] for i in keep]
+
+    def lookup(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, ring_hash(key)) % len(self.points)
+        return self.owners[index]
+
+
+# Worker side: a regular manager fed from the coordinator's command queue,
+# reporting back once a chat is running so the coordinator can hand over
+class ShardManager(BinanceAccountsManager):
+    is_shard = True
+
+    def __init__(self, queue, index, events):
+        self.index, self.events = index, events
+        self.process = f'shard-{index}'
+        super().__init__(queue)
+        self.alerts.on_fired = self.report_fired
+
+    def journal_path(self):
+        path = Path(super().journal_path())
+        return path.with_name(f'{path.stem}-{self.index}{path.suffix}')
+
+    def checkpoint_path(self):
+        path = Path(super().checkpoint_path())
+        return path.with_name(f'{path.stem}-{self.index}{path.suffix}')
+
+    async def reconcile(self, profile, bot, stored=False):
+        await super().reconcile(profile, bot, stored)
+        self.events.put(('active', self.index, profile['telegram_chat_id']))
+
+    # The coordinator keeps the profiles, and sends the chat's profile back
+    # once it no longer lists the alert
+    def report_fired(self, chat_id, pk):
+        self.events.put(('forget_alert', self.index, chat_id, pk))
+
+    # Chat moved to another shard, which is already running it
+    def release(self, chat_id):
+        self.drop_chat(chat_id)
+
+    # Polls with a timeout, as `ShardCoordinator.listen` does, so the
+    # executor thread never outlives the loop
+    async def pump(self, commands, bot):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                command, *args = await loop.run_in_executor(
+                    None, commands.get, True, LISTEN_TIMEOUT)
+            except Empty:
+                continue
+            if command == 'profile':
+                profile, stored = args
+                await self.queue.put((profile, bot, stored))
+            elif command == 'release':
+                self.release(*args)
+            elif command == 'portfolio':
+                asyncio.create_task(self.portfolio(*args, bot))
+            elif command == 'stop':
+                loop.stop()
+                return
+
+
+def run_shard(index, shards, commands, events, profile=None):
+    import django
+    django.setup()
+    from django.conf import settings
+    from .core import ConnectionManager
+    from .metrics import MetricsServer, monitor_loop_lag
+    from .profiler import LoopProfiler
+    from .telegram_utils import ShardBot
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    queue = asyncio.Queue()
+    profiler = None
+    if profile:
+        output, threshold = profile
+        output = Path(output)
+        profiler = LoopProfiler(loop, output.with_name(
+            f'{output.stem}-{index}{output.suffix}'), threshold)
+        profiler.start()
+
+    async def start():
+        bot = ShardBot(loop, queue, shards)
+        manager = ShardManager(queue, index, events)
+        loop.create_task(manager.subscribe())
+        loop.create_task(manager.pump(commands, bot))
+        loop.create_task(monitor_loop_lag())
+        if settings.BOT_METRICS_PORT:
+            # The coordinator serves the base port, shards the next ones
+            await MetricsServer(settings.BOT_METRICS_PORT + 1 + index).start()
+        return bot, manager
+
+    bot, manager = loop.run_until_complete(start())
+    logger.info("Shard started", extra={'shard': index})
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(manager.stop())
+        bot.coalescer.flush_all()
+        loop.run_until_complete(bot.outbox.stop())
+        manager.journal.close()
+        bot.store.flush()
+        loop.run_until_complete(ConnectionManager.close_session())
+        if profiler:
+            profiler.stop()
+
+
+class Shard:
+    def __init__(self, index, shards, events, profile=None):
+        self.index = index
+        self.commands = multiprocessing.get_context('spawn').Queue()
+        self.process = multiprocessing.get_context('spawn').Process(
+            target=run_shard,
+            args=(index, shards, self.commands, events, profile),
+            name=f'bot-shard-{index}', daemon=True)
+        self.process.start()
+
+    def send(self, *command):
+        self.commands.put(command)
+
+
+# Front-end side: owns the hash ring and forwards every profile update to
+# the shard that owns the chat. Moving a chat between shards starts it on
+# the new shard first and releases it on the old one only once it runs.
+class ShardCoordinator:
+    # `on_alert_fired(chat_id, pk)` updates the front-end's profiles
+    on_alert_fired = None
+
+    def __init__(self, queue, shards, profile=None):
+        self.queue = queue
+        self.planned = shards
+        self.profile = profile
+        self.events = multiprocessing.get_context('spawn').Queue()
+        self.shards = {}
+        self.ring = HashRing()
+        self.profiles = {}
+        self.owners = {}
+        self.handovers = {}
+        self.stopped = False
+        for _ in range(shards):
+            self.add_shard()
+
+    def spawn(self, index):
+        shards = max(self.planned, len(self.shards) + 1)
+        return Shard(index, shards, self.events, self.profile)
+
+    def add_shard(self):
+        index = max(self.shards, default=-1) + 1
+        self.shards[index] = self.spawn(index)
+        self.ring.add(index)
+        logger.info("Added shard", extra={
+            'shard': index, 'shards': len(self.shards)})
+        self.rebalance()
+
+    def remove_shard(self, index=None):
+        if len(self.shards) < 2:
+            return
+        index = max(self.shards) if index is None else index
+        self.ring.remove(index)
+        logger.info("Removing shard", extra={'shard': index})
+        self.rebalance()
+        asyncio.create_task(self.retire_shard(index))
+
+    async def retire_shard(self, index):
+        await asyncio.sleep(HANDOVER_TIMEOUT)
+        await self.stop_shard(index)
+
+    # Joined from the executor, so the front-end keeps dispatching updates
+    # while the worker drains; a worker still running after that is
+    # terminated
+    async def stop_shard(self, index):
+        shard = self.shards.pop(index, None)
+        if not shard:
+            return
+        shard.send('stop')
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, shard.process.join, STOP_TIMEOUT)
+        if shard.process.is_alive():
+            logger.warning("Shard did not stop, terminating", extra={
+                'shard': index})
+            shard.process.terminate()
+            await loop.run_in_executor(None, shard.process.join, STOP_TIMEOUT)
+
+    # Chats are placed by their own API key rather than by id, so chats
+    # sharing an account share its stream too
+    def lookup(self, chat_id):
+        api_key = self.profiles[chat_id].get('binance_api_key')
+        try:
+            key = get_vault().fingerprint(api_key) if api_key else chat_id
+        except VaultError:
+            key = chat_id
+        return self.ring.lookup(key)
+
+    def rebalance(self):
+        for chat_id in self.profiles:
+            owner = self.lookup(chat_id)
+            if self.owners.get(chat_id) != owner:
+                self.forward(chat_id, stored=True)
+
+    def forward(self, chat_id, stored):
+        owner = self.lookup(chat_id)
+        previous = self.owners.get(chat_id)
+        if previous is not None and previous != owner:
+            self.handovers[chat_id] = previous
+        self.owners[chat_id] = owner
+        self.shards[owner].send('profile', self.profiles[chat_id], stored)
+
+    def handover(self, index, chat_id):
+        previous = self.handovers.get(chat_id)
+        if previous is None or self.owners.get(chat_id) != index:
+            return
+        del self.handovers[chat_id]
+        if previous in self.shards:
+            self.shards[previous].send('release', chat_id)
+
+    # A worker fired the alert: drop it from the profiles here and on the
+    # front-end, then send the worker the updated profile
+    def forget_alert(self, chat_id, pk):
+        profile = self.profiles.get(chat_id)
+        if profile is None:
+            return
+        profile['alerts'] = tuple(
+            alert for alert in profile.get('alerts', ())
+            if alert['pk'] != pk)
+        if self.on_alert_fired:
+            self.on_alert_fired(chat_id, pk)
+        if self.owners.get(chat_id) in self.shards:
+            self.forward(chat_id, stored=True)
+
+    async def portfolio(self, chat_id, bot):
+        owner = self.owners.get(chat_id)
+        if owner is None or owner not in self.shards:
+            bot.outbox.send(chat_id, messages.text(
+                'keys.missing', bot.locale(chat_id)))
+            return
+        self.shards[owner].send('portfolio', chat_id)
+
+    # Polls with a timeout so the executor thread never outlives `stop`
+    async def listen(self):
+        loop = asyncio.get_running_loop()
+        while not self.stopped:
+            try:
+                event, index, chat_id, *args = await loop.run_in_executor(
+                    None, self.events.get, True, LISTEN_TIMEOUT)
+            except Empty:
+                continue
+            if event == 'active':
+                self.handover(index, chat_id)
+            elif event == 'forget_alert':
+                self.forget_alert(chat_id, *args)
+
+    # Respawns crashed workers and replays their slice of profiles
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for index, shard in [*self.shards.items()]:
+                if shard.process.is_alive():
+                    continue
+                logger.error("Shard died, respawning", extra={'shard': index})
+                self.shards[index] = self.spawn(index)
+                for chat_id, owner in self.owners.items():
+                    if owner == index:
+                        self.shards[index].send(
+                            'profile', self.profiles[chat_id], True)
+
+    async def subscribe(self):
+        asyncio.create_task(self.listen())
+        asyncio.create_task(self.supervise())
+        while True:
+            profile, bot, stored = await self.queue.get()
+            self.queue.task_done()
+            if not stored:
+                # Persisted by the front-end, so workers never write profiles
+                await bot.save_profile_db(profile)
+                stored = True
+            chat_id = profile.get('telegram_chat_id')
+            self.profiles[chat_id] = {**profile}
+            self.forward(chat_id, stored)
+
+    async def stop(self):
+        self.stopped = True
+        await asyncio.gather(*map(self.stop_shard, [*self.shards]))
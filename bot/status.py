@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+EXPORT_BATCH = 1000  # rows built between yields to the loop
+STALE_INTERVALS = 3  # exports missed before a process is shown as gone
+
+# Subscription states
+STREAMING = 'streaming'
+CONNECTING = 'connecting'
+HELD = 'held'
+FAILED = 'failed'
+OFF = 'off'
+STATES = (STREAMING, CONNECTING, HELD, FAILED, OFF)
+
+COLUMNS = (
+    'chat_id', 'label', 'fingerprint', 'state', 'socket', 'last_event',
+    'expires', 'failures', 'error', 'backlog', 'lag')
+ORDERINGS = ('chat_id', 'fingerprint', 'last_event', 'backlog', 'lag')
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS processes (
+    process TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    started REAL NOT NULL,
+    updated REAL NOT NULL,
+    accounts INTEGER NOT NULL,
+    chats INTEGER NOT NULL,
+    sockets INTEGER NOT NULL,
+    outbox INTEGER NOT NULL,
+    PRIMARY KEY (process, pid)
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    process TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    chat_id TEXT NOT NULL,
+    label TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    state TEXT NOT NULL,
+    socket INTEGER,
+    last_event INTEGER,
+    expires REAL,
+    failures INTEGER NOT NULL,
+    error TEXT,
+    backlog INTEGER NOT NULL,
+    lag REAL
+);
+CREATE INDEX IF NOT EXISTS subscriptions_process
+    ON subscriptions (process, pid);
+CREATE INDEX IF NOT EXISTS subscriptions_chat ON subscriptions (chat_id);
+CREATE INDEX IF NOT EXISTS subscriptions_fingerprint
+    ON subscriptions (fingerprint);
+CREATE INDEX IF NOT EXISTS subscriptions_state ON subscriptions (state);
+'''
+
+
+# Periodic export of the manager's live state to a SQLite file shared by
+# all bot processes, each replacing its own rows. Rows are keyed by process
+# name and pid, so during a handover the old and new process (both `main`,
+# say) are shown side by side rather than overwriting each other. The admin
+# reads the file and never talks to the bot; rows are built in batches on
+# the loop and written from the default executor.
+class StatusExport:
+    def __init__(self, manager, process, path=None, interval=None):
+        self.manager = manager
+        self.process = process
+        self.pid = os.getpid()
+        self.path = path if path is not None else settings.BOT_STATUS_PATH
+        self.interval = interval or settings.BOT_STATUS_INTERVAL
+        self.started = time.time()
+        self.db = None
+        self.task = None
+
+    def start(self):
+        if self.path and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def connect(self):
+        if self.db is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False,
+                timeout=self.interval)
+            self.db.execute('PRAGMA journal_mode = WAL')
+            self.db.execute('PRAGMA synchronous = OFF')
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    async def collect(self):
+        rows = []
+        for row in self.manager.status_rows():
+            rows.append((self.process, self.pid, *row))
+            if len(rows) % EXPORT_BATCH == 0:
+                await asyncio.sleep(0)
+        return rows, self.manager.status_summary()
+
+    def write(self, rows, summary):
+        db = self.connect()
+        with db:
+            db.execute('BEGIN')
+            db.execute(
+                'DELETE FROM subscriptions WHERE process = ? AND pid = ?',
+                (self.process, self.pid))
+            db.executemany(
+                f'INSERT INTO subscriptions (process, pid, '
+                f'{", ".join(COLUMNS)}) '
+                f'VALUES ({", ".join("?" * (len(COLUMNS) + 2))})', rows)
+            db.execute(
+                'INSERT OR REPLACE INTO processes VALUES (?, ?, ?, ?, ?, ?, '
+                '?, ?)', (
+                    self.process, self.pid, self.started, time.time(),
+                    summary['accounts'], summary['chats'],
+                    summary['sockets'], summary['outbox']))
+
+    def remove(self):
+        db = self.connect()
+        with db:
+            db.execute('BEGIN')
+            for table in ('subscriptions', 'processes'):
+                db.execute(
+                    f'DELETE FROM {table} WHERE process = ? AND pid = ?',
+                    (self.process, self.pid))
+        db.close()
+        self.db = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(
+                    None, self.write, *await self.collect())
+            except sqlite3.Error as e:
+                logger.error("Status export failed", extra={
+                    'error': repr(e)})
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.remove)
+        except sqlite3.Error as e:
+            logger.error("Status export failed", extra={'error': repr(e)})
+
+
+# Read side used by the admin: filtered, ordered and paginated in SQL, so
+# a page costs the same with ten or ten thousand accounts. Works as the
+# object list of a `django.core.paginator.Paginator`.
+class StatusQuery:
+    def __init__(self, path=None, state=None, process=None, search=None,
+                 ordering=None):
+        self.path = path or settings.BOT_STATUS_PATH
+        self.where, self.params = ['p.updated > ?'], [
+            time.time() - settings.BOT_STATUS_INTERVAL * STALE_INTERVALS]
+        if state in STATES:
+            self.where.append('s.state = ?')
+            self.params.append(state)
+        if process:
+            self.where.append('s.process = ?')
+            self.params.append(process)
+        if search:
+            self.where.append(
+                "(s.chat_id = ? OR s.fingerprint LIKE ? ESCAPE '\\' "
+                "OR s.label = ?)")
+            self.params.extend([
+                search, search.replace('%', '\\%').replace('_', '\\_') + '%',
+                search])
+        descending = bool(ordering) and ordering.startswith('-')
+        field = ordering.lstrip('-') if ordering else None
+        if field not in ORDERINGS:
+            field, descending = 'chat_id', False
+        self.order = f'{field} {"DESC" if descending else "ASC"}, s.rowid'
+
+    def connect(self):
+        if not Path(self.path).exists():
+            return None
+        return sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+
+    def query(self, select, suffix='', params=()):
+        db = self.connect()
+        if db is None:
+            return []
+        try:
+            return db.execute(
+                f'SELECT {select} FROM subscriptions s JOIN processes p '
+                f'USING (process, pid) '
+                f'WHERE {" AND ".join(self.where)} {suffix}',
+                [*self.params, *params]).fetchall()
+        except sqlite3.OperationalError:
+            return []  # not exported yet
+        finally:
+            db.close()
+
+    def count(self):
+        rows = self.query('COUNT(*)')
+        return rows[0][0] if rows else 0
+
+    def __getitem__(self, page):
+        rows = self.query(
+            f's.process, s.pid, '
+            f'{", ".join(f"s.{name}" for name in COLUMNS)}',
+            f'ORDER BY {self.order} LIMIT ? OFFSET ?',
+            (page.stop - page.start, page.start))
+        return [
+            dict(zip(('process', 'pid', *COLUMNS), row)) for row in rows]
+
+    def processes(self):
+        db = self.connect()
+        if db is None:
+            return []
+        stale = time.time() - settings.BOT_STATUS_INTERVAL * STALE_INTERVALS
+        try:
+            rows = db.execute(
+                'SELECT *, updated > ? FROM processes '
+                'ORDER BY process, started',
+                (stale,)).fetchall()
+        except sqlite3.OperationalError:
+            return []
+        finally:
+            db.close()
+        names = (
+            'process', 'pid', 'started', 'updated', 'accounts', 'chats',
+            'sockets', 'outbox', 'alive')
+        return [dict(zip(names, row)) for row in rows]
+
+    def states(self):
+        return dict(self.query(
+            's.state, COUNT(*)', 'GROUP BY s.state'))
@@ -0,0 +1,307 @@
+import asyncio
+import json
+import logging
+import time
+from itertools import count
+
+from .core import Backoff, ConnectionManager, WS_ERRORS
+from .delivery import RateLimiter
+from .events import loads
+from .metrics import FRAMES, SOCKETS, STREAMS
+
+STREAMS_PER_SOCKET = 200  # Binance allows up to 1024
+PARAMS_PER_MESSAGE = 100
+CONTROL_RATE = 5  # incoming messages per second allowed by Binance
+WS_CONNECTION_TIMEOUT = 24 * 60 * 60
+ROTATE_BEFORE = 30 * 60  # rotate before Binance drops the connection
+STABLE_CONNECTION = 60  # seconds up before the reconnect backoff is reset
+
+logger = logging.getLogger(__name__)
+
+
+class MultiplexedSocket(ConnectionManager):
+    def __init__(self, mux, index):
+        self.mux, self.index = mux, index
+        self.streams = set()
+        self.pending = {'SUBSCRIBE': set(), 'UNSUBSCRIBE': set()}
+        self.requests = {}
+        self.ids = count(1)
+        self.ws = None
+        self.connected = None
+        # Since when the streams resubscribed after a drop were not received
+        self.disconnected = None
+        self.recovering = set()
+        self.backoff = Backoff()
+        self.changed = asyncio.Event()
+        self.limiter = RateLimiter(CONTROL_RATE)
+        self.task = asyncio.create_task(
+            self.run(), name=f'socket-{self.index}')
+
+    def __len__(self):
+        return len(self.streams)
+
+    def __repr__(self):
+        return f'<MultiplexedSocket #{self.index} streams={len(self)}>'
+
+    def subscribe(self, stream):
+        self.streams.add(stream)
+        self.pending['UNSUBSCRIBE'].discard(stream)
+        self.pending['SUBSCRIBE'].add(stream)
+        self.changed.set()
+
+    def unsubscribe(self, stream):
+        self.streams.discard(stream)
+        self.pending['SUBSCRIBE'].discard(stream)
+        self.pending['UNSUBSCRIBE'].add(stream)
+        self.changed.set()
+
+    def close(self):
+        self.task.cancel()
+
+    @property
+    def alive(self):
+        return not self.task.done()
+
+    def restart(self):
+        logger.warning("Socket task died, restarting", extra={
+            'socket': self.index})
+        self.task = asyncio.create_task(
+            self.run(), name=f'socket-{self.index}')
+
+    # Reconnects with jittered backoff, reset once a connection has stayed
+    # up for a while, so a flapping upstream is not hammered by every socket.
+    # Unexpected errors are logged and retried the same way rather than
+    # ending the task with every stream on it.
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self.connect(), WS_CONNECTION_TIMEOUT)
+                logger.warning("Socket closed by server", extra={
+                    'socket': self.index})
+            except asyncio.TimeoutError:
+                logger.info("Socket reached connection lifetime", extra={
+                    'socket': self.index})
+            except WS_ERRORS as e:
+                logger.warning("Socket disconnected", extra={
+                    'socket': self.index, 'error': repr(e)})
+            except Exception:
+                logger.exception("Socket failed", extra={
+                    'socket': self.index})
+            if self.disconnected is None:
+                self.disconnected = time.time()
+            if self.connected and (
+                    time.monotonic() - self.connected > STABLE_CONNECTION):
+                self.backoff.reset()
+            self.connected = None
+            await asyncio.sleep(self.backoff.next())
+
+    async def connect(self):
+        ws = await self.ws_connect(self.mux.url)
+        async with ws:
+            self.ws = ws
+            self.connected = time.monotonic()
+            # Fresh connection: (re)subscribe everything we own
+            self.pending['SUBSCRIBE'] = {*self.streams}
+            self.pending['UNSUBSCRIBE'].clear()
+            self.requests.clear()
+            if self.disconnected is not None:
+                self.recovering = {*self.streams}
+            self.changed.set()
+            flusher = asyncio.create_task(self.flush())
+            rotation = asyncio.get_running_loop().call_later(
+                WS_CONNECTION_TIMEOUT - ROTATE_BEFORE, self.mux.rotate, self)
+            try:
+                async for raw in ws:
+                    self.mux.route(self, raw)
+            finally:
+                rotation.cancel()
+                flusher.cancel()
+                self.ws = None
+
+    # Sends pending (un)subscriptions in batches, within the control rate
+    async def flush(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            for method, pending in self.pending.items():
+                while pending:
+                    params = [
+                        pending.pop()
+                        for _ in range(min(len(pending), PARAMS_PER_MESSAGE))]
+                    request_id = next(self.ids)
+                    self.requests[request_id] = method, params
+                    await self.limiter.acquire()
+                    await self.ws.send(json.dumps({
+                        'method': method,
+                        'params': params,
+                        'id': request_id,
+                    }))
+
+    def confirm(self, request_id, error=None):
+        method, params = self.requests.pop(request_id, (None, ()))
+        if error:
+            logger.warning("Stream request failed", extra={
+                'socket': self.index, 'method': method, 'error': error})
+        elif method == 'SUBSCRIBE':
+            self.mux.confirm(self, params)
+            gapped = self.recovering.intersection(params)
+            if gapped:
+                self.recovering -= gapped
+                self.mux.recover(gapped, self.disconnected)
+            if not self.recovering:
+                self.disconnected = None
+
+
+# Packs many streams (listenKeys) onto a few combined-stream connections
+# and routes every frame to the callback registered for its stream.
+class StreamMultiplexer:
+    def __init__(self, url, streams_per_socket=STREAMS_PER_SOCKET):
+        self.url = url
+        self.streams_per_socket = streams_per_socket
+        self.sockets = []
+        self.indexes = count(1)
+        self.routes = {}
+        self.gaps = {}
+        self.owners = {}
+        self.moving = {}
+        # Previous socket index -> socket, while resuming from a checkpoint
+        self.groups = {}
+        SOCKETS.set_function(lambda: len(self.sockets))
+        STREAMS.set_function(lambda: len(self.routes))
+
+    def __len__(self):
+        return len(self.routes)
+
+    # `on_gap(since)` is called once the stream is received again after
+    # its connection dropped, for the caller to fetch what it missed.
+    # Streams added with the same `group` share a socket where room allows,
+    # so resumed streams keep their previous grouping.
+    def add(self, stream, callback, on_gap=None, group=None):
+        self.routes[stream] = callback
+        if on_gap:
+            self.gaps[stream] = on_gap
+        else:
+            self.gaps.pop(stream, None)
+        if stream not in self.owners:
+            socket = self.place(group=group)
+            self.owners[stream] = socket
+            socket.subscribe(stream)
+
+    def remove(self, stream):
+        self.routes.pop(stream, None)
+        self.gaps.pop(stream, None)
+        socket = self.owners.pop(stream, None)
+        if socket:
+            socket.unsubscribe(stream)
+        old = self.moving.pop(stream, None)
+        if old:
+            old.unsubscribe(stream)
+        self.rebalance()
+
+    async def close(self):
+        for socket in self.sockets:
+            socket.close()
+        await asyncio.gather(
+            *(socket.task for socket in self.sockets), return_exceptions=True)
+
+    # Restarts the socket carrying `stream` if its task has died
+    def revive(self, stream):
+        socket = self.owners.get(stream)
+        if socket and not socket.alive:
+            socket.restart()
+
+    def place(self, exclude=None, group=None):
+        if group is not None:
+            socket = self.groups.get(group)
+            if socket not in self.sockets or (
+                    len(socket) >= self.streams_per_socket):
+                socket = self.groups[group] = MultiplexedSocket(
+                    self, next(self.indexes))
+                self.sockets.append(socket)
+            return socket
+        candidates = [
+            socket for socket in self.sockets
+            if socket is not exclude and len(socket) < self.streams_per_socket]
+        if candidates:
+            return min(candidates, key=len)
+        socket = MultiplexedSocket(self, next(self.indexes))
+        self.sockets.append(socket)
+        return socket
+
+    # Folds the emptiest socket into the others when they have room for it.
+    # Streams are subscribed on their new socket first; the old socket keeps
+    # delivering until the new subscription is confirmed (make-before-break).
+    def rebalance(self):
+        for socket in [*self.sockets]:
+            if not len(socket) and socket not in self.moving.values():
+                self.sockets.remove(socket)
+                socket.close()
+        draining = set(self.moving.values())
+        active = [s for s in self.sockets if s not in draining]
+        if len(active) < 2:
+            return
+        spare = sum(self.streams_per_socket - len(s) for s in active)
+        emptiest = min(active, key=len)
+        if spare - (self.streams_per_socket - len(emptiest)) < len(emptiest):
+            return
+        for stream in [*emptiest.streams]:
+            target = self.place(exclude=emptiest)
+            self.moving[stream] = emptiest
+            self.owners[stream] = target
+            target.subscribe(stream)
+
+    # Moves every stream of an ageing connection onto a new one before
+    # Binance closes it; the old one keeps delivering each stream until its
+    # new subscription is confirmed, then is dropped once empty
+    def rotate(self, socket):
+        if socket not in self.sockets:
+            return
+        logger.info("Rotating socket ahead of connection lifetime", extra={
+            'socket': socket.index, 'streams': len(socket)})
+        target = MultiplexedSocket(self, next(self.indexes))
+        self.sockets.append(target)
+        for stream in [*socket.streams]:
+            if self.owners.get(stream) is not socket:
+                continue  # already moving away
+            self.moving[stream] = socket
+            self.owners[stream] = target
+            target.subscribe(stream)
+
+    def recover(self, streams, since):
+        for stream in streams:
+            on_gap = self.gaps.get(stream)
+            if on_gap:
+                on_gap(since)
+
+    def confirm(self, socket, streams):
+        for stream in streams:
+            old = self.moving.pop(stream, None)
+            if old and self.owners.get(stream) is socket:
+                old.unsubscribe(stream)
+        self.rebalance()
+
+    # A frame that cannot be parsed or whose callback fails is logged and
+    # dropped; the connection and its other streams carry on
+    def route(self, socket, raw):
+        try:
+            msg = loads(raw)
+        except ValueError:
+            msg = None
+        if not isinstance(msg, dict):
+            logger.warning("Malformed frame", extra={
+                'socket': socket.index, 'frame': str(raw)[:200]})
+            return
+        if 'id' in msg:
+            socket.confirm(msg['id'], msg.get('error'))
+            return
+        FRAMES.inc()
+        stream = msg.get('stream')
+        owner = self.moving.get(stream) or self.owners.get(stream)
+        callback = self.routes.get(stream)
+        if owner is socket and callback:
+            try:
+                callback(msg.get('data'))
+            except Exception:
+                logger.exception("Stream callback failed", extra={
+                    'socket': socket.index, 'stream': stream})
@@ -1,4 +1,10 @@
 import asyncio
+import logging
+import re
+import time
+import warnings
+from collections import deque
+from aiohttp import ClientError, ClientTimeout
 from asgiref.sync import sync_to_async
 
 from telegram import (
@@ -7,70 +13,238 @@ from telegram import (
 )
 from telegram.ext import (
     MessageHandler, ConversationHandler, CommandHandler,
-    Updater, Filters, CallbackContext, CallbackQueryHandler,
+    Dispatcher, Filters, CallbackContext, CallbackQueryHandler,
 )
 from telegram.utils.request import Request
-from telegram.error import BadRequest
-
-from django.conf import settings as _
-from bot.models import Profile
+from telegram.error import TelegramError
+
+from django.conf import settings
+from bot.alerts import MAX_ALERTS_PER_CHAT, alert_values, load_alerts
+from bot.core import ConnectionManager, REQUEST_TIMEOUT
+from bot.events import FILTER_ALL, FILTER_DEFAULT, FILTER_ORDERS
+from bot.managers import STANDARD_FIELDS
+from bot.models import Alert, LinkedAccount
+from bot.delivery import Coalescer, Outbox, RateLimiter, GLOBAL_RATE
+from bot.profiles import (
+    MAX_ACCOUNTS_PER_CHAT, ProfileStore, WarmupProgress, account_values,
+    load_accounts, profile_values,
+)
+from bot import messages
+from bot.checkpoint import Checkpoints, retire, wait_exited
+from bot.vault import get_vault
+
+POLL_TIMEOUT = 25
+POLL_RETRY_DELAY = 3
+HANDOVER_GRACE = 5  # s for the queued chats to reach their streams
+# `BTCUSDT > 30000`, `BTCUSDT < 25000`, `BTCUSDT 5%` or `BTCUSDT ± 5%`
+ALERT_PATTERN = re.compile(
+    r'^\s*([A-Za-z0-9]{2,20})\s*([<>±])?\s*(\d+(?:[.,]\d+)?)\s*(%)?\s*$')
+# `BTCUSDT spread 10`: the order book's ask-bid spread reaching 10
+ALERT_SPREAD_PATTERN = re.compile(
+    r'^\s*([A-Za-z0-9]{2,20})\s+(?:spread|спред)\s+(\d+(?:[.,]\d+)?)\s*$',
+    re.IGNORECASE)
+ALERT_DELETE_PATTERN = re.compile(r'^\s*-\s*(\d+)\s*$')
+# `<label> <API key> <secret key>`
+ACCOUNT_PATTERN = re.compile(r'^\s*(\S{1,32})\s+(\S+)\s+(\S+)\s*$')
+
+logger = logging.getLogger(__name__)
+
+
+# (symbol, kind, value) of an alert typed by the user, or None: a percent
+# move takes no sign but `±`, and a price threshold needs `<` or `>`
+def parse_alert(text):
+    spread = ALERT_SPREAD_PATTERN.match(text)
+    if spread:
+        symbol, value = spread.groups()
+        kind = Alert.SPREAD
+    else:
+        match = ALERT_PATTERN.match(text)
+        if not match:
+            return None
+        symbol, sign, value, percent = match.groups()
+        if bool(percent) == (sign in ('<', '>')):
+            return None
+        kind = (
+            Alert.MOVE if percent
+            else Alert.ABOVE if sign == '>' else Alert.BELOW)
+    return symbol.upper(), kind, float(value.replace(',', '.'))
+
+
+class HandlerStats:
+    def __init__(self):
+        self.handled = 0
+        self.time_total = 0
+        self.time_max = 0
+
+    def observe(self, elapsed):
+        self.handled += 1
+        self.time_total += elapsed
+        self.time_max = max(self.time_max, elapsed)
+
+    def __repr__(self):
+        average = self.time_total / self.handled if self.handled else 0
+        return (f'handled={self.handled} avg={average * 1000:.2f}ms '
+                f'max={self.time_max * 1000:.2f}ms')
 
 
 class ProfileMixin:
     profiles = {}
 
-    def get_profile_db(self, chat_id):
-        return Profile.objects.get_or_create(telegram_chat_id=chat_id)
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.store = ProfileStore()
+        self.loop.create_task(self.store.run(self.on_profiles_changed))
+        self.handed_over.clear()
 
-    @sync_to_async
-    def save_profile_db(self, chat_id, api_key, secret_key, notifications):
-        profile_db, new = self.get_profile_db(chat_id)
-        profile_db.binance_api_key = api_key
-        profile_db.binance_secret_key = secret_key
-        profile_db.notifications = notifications
-        profile_db.save()
+    # Updates wait until the cache is warm, so handlers never hit the
+    # database
+    def ready(self):
+        return self.store.loaded
+
+    # Served from `ProfileStore`
+    def get_profile_db(self, chat_id):
+        return self.store.get_or_create(chat_id)
+
+    # Written to the database by the store's next batched flush. A chat
+    # not cached yet is looked up in the database, off the loop.
+    async def save_profile_db(self, profile):
+        chat_id = profile['telegram_chat_id']
+        fields = {
+            field: value for field, value in profile.items()
+            if field in STANDARD_FIELDS and field != 'telegram_chat_id'}
+        if chat_id in self.store or self.store.loaded:
+            self.store.update(chat_id, **fields)
+        else:
+            await sync_to_async(self.store.update)(chat_id, **fields)
+
+    # Rows edited outside the bot, e.g. in the admin
+    # `changed`: chat id -> linked accounts, of rows changed elsewhere
+    def on_profiles_changed(self, changed):
+        for chat_id, accounts in changed.items():
+            profile = {
+                **self.profiles.get(chat_id, {}),
+                **profile_values(self.store.get(chat_id)),
+                'accounts': accounts}
+            if profile == self.profiles.get(chat_id):
+                continue
+            self.profiles[chat_id] = profile
+            self.loop.create_task(
+                self.set_binance_account(chat_id, stored=True))
 
     # Profile passed to `binance_utils.BinanceAccountManager`
     # via `asyncio.Queue`
-    async def set_binance_account(self, chat_id):
+    # `stored` marks profiles that are already in the database
+    async def set_binance_account(self, chat_id, stored=False):
         profile = self.profiles[chat_id]
         asyncio.create_task(
-            self.queue.put((profile, self)))
-
-    # Invokes Django's sync-only method, so needs a wrapper like this
-    @sync_to_async
-    def dump_profiles(self):
-        profiles = [*Profile.objects.standard_values()]
-        self.profiles = {x['telegram_chat_id']: x for x in profiles}
-        for chat_id in self.profiles:
-            asyncio.run_coroutine_threadsafe(
-                self.set_binance_account(chat_id), self.loop)
+            self.queue.put((profile, self, stored)))
+
+    def locale(self, chat_id):
+        return self.profiles.get(chat_id, {}).get('locale')
+
+    # Fired alerts are deactivated by the accounts manager
+    def forget_alert(self, chat_id, pk):
+        profile = self.profiles.get(chat_id)
+        if profile:
+            profile['alerts'] = tuple(
+                alert for alert in profile.get('alerts', ())
+                if alert['pk'] != pk)
+
+    # Caches one chunk of rows read by the warm-up, with their alerts and
+    # linked accounts
+    async def cache_profiles(self, chunk):
+        chat_ids = [profile.telegram_chat_id for profile in chunk]
+        alerts = await sync_to_async(load_alerts)(chat_ids)
+        accounts = await sync_to_async(load_accounts)(chat_ids)
+        for profile in chunk:
+            chat_id = profile.telegram_chat_id
+            self.profiles[chat_id] = {
+                **profile_values(profile),
+                'alerts': alerts.get(chat_id, ()),
+                'accounts': accounts.get(chat_id, ())}
+
+    # Admits accounts at a steady rate, so a cold start does not request
+    # every listenKey at once
+    async def admit(self, chat_ids, limiter, progress):
+        for chat_id in chat_ids:
+            await limiter.acquire()
+            await self.queue.put((self.profiles[chat_id], self, True))
+            progress.advance()
+
+    # The table is read first, in chunks, and updates are handled as soon
+    # as it is cached; only admission to the streams is rate limited. Chats
+    # a previous process left streaming come first and faster, as their
+    # listenKeys are resumed rather than requested; that process is asked
+    # to stop once everything is queued, and updates are polled for once
+    # it has exited.
+    async def dump_profiles(self):
+        checkpoints = await sync_to_async(Checkpoints)()
+        previous = checkpoints.owners_running()
+        if not previous:
+            self.handed_over.set()
+        chat_ids = []
+        last_pk = 0
+        while True:
+            last_pk, chunk = await sync_to_async(self.store.load_chunk)(
+                last_pk, settings.BOT_WARMUP_CHUNK_SIZE)
+            if not chunk:
+                break
+            await self.cache_profiles(chunk)
+            chat_ids.extend(profile.telegram_chat_id for profile in chunk)
+        self.store.loaded = True
+        self.dispatch_waiting()
+        priority = [
+            chat_id for chat_id in checkpoints.priority()
+            if chat_id in self.profiles]
+        admitted = set(priority)
+        rest = [chat_id for chat_id in chat_ids if chat_id not in admitted]
+        progress = WarmupProgress(len(priority) + len(rest))
+        await self.admit(
+            priority, RateLimiter(settings.BOT_RESUME_RATE), progress)
+        await self.admit(
+            rest, RateLimiter(settings.BOT_WARMUP_RATE), progress)
+        progress.finish()
+        if previous:
+            await self.queue.join()
+            await asyncio.sleep(HANDOVER_GRACE)
+            retire(previous)
+            await wait_exited(previous)
+            self.handed_over.set()
 
 
 class BinanceMixin(ProfileMixin):
+    # `portfolio(chat_id, bot)` of whatever runs the accounts
+    on_portfolio = None
     (
         ROOT_ACTION,
         ADD_API_KEY, ADD_SECRET_KEY,
-        EDIT_NOTIFICATIONS
-    ) = range(4)  # conversation state codes
-    START_OPTIONS = {
-        'NEW': ['Добавить пару ключей'],
-        'EXISTING': ['Заменить пару ключей', 'Настроить уведомления'],
-    }
-    NOTIFICATIONS_OPTIONS = ['Включить', 'Отключить']
+        EDIT_NOTIFICATIONS, EDIT_ALERTS, EDIT_ACCOUNTS
+    ) = range(6)  # conversation state codes
+    # option lists in the string tables
+    START_OPTIONS = {'NEW': 'start.new', 'EXISTING': 'start.existing'}
+    NOTIFICATIONS_OPTIONS = 'notifications.options'
+    # option -> (notifications, notification_filter, notification_digest)
+    NOTIFICATIONS_SETTINGS = [
+        (True, FILTER_DEFAULT, False),
+        (False, None, None),
+        (True, FILTER_ORDERS, False),
+        (True, FILTER_ALL, False),
+        (True, None, True),
+    ]
 
     def __init__(self, *args):
         super().__init__(*args)
-        asyncio.run_coroutine_threadsafe(
-            self.dump_profiles(), self.loop)
+        self.run_in_loop(self.dump_profiles())
 
     def update_profile(self, chat_id, obj_dict):
         self.profiles[chat_id] = {
             **self.profiles.get(chat_id, {}), **obj_dict}
 
     def submit_profile(self, chat_id):
-        asyncio.run_coroutine_threadsafe(
-            self.set_binance_account(chat_id), self.loop)
+        self.run_in_loop(self.set_binance_account(chat_id))
+
+    def text(self, chat_id, key, **values):
+        return messages.text(key, self.locale(chat_id), **values)
 
     def options_list_buttons(self, list_):
         return [InlineKeyboardButton(
@@ -78,96 +252,234 @@ class BinanceMixin(ProfileMixin):
         ) for key, value in enumerate(list_)]
 
     def shredder(self, chat_id, message):
-        self.bot.delete_message(chat_id, message.message_id)
+        self.outbox.call(
+            chat_id, 'delete_message', chat_id, message.message_id)
 
-    def start(self, update: Updater, context: CallbackContext) -> int:
+    def start(self, update: Update, context: CallbackContext) -> int:
         chat_id, text, from_user = self.get_message_details(update)
         chat_id = str(chat_id)
         profile_db, new = self.get_profile_db(chat_id)
         if new:
             self.profiles[chat_id] = {'telegram_chat_id': chat_id}
+            locale = from_user.language_code
+            if locale in messages.LOCALES:
+                self.update_profile(chat_id, {'locale': locale})
+                self.store.update(chat_id, locale=locale)
         api_key = profile_db.binance_api_key
-        start_options = self.START_OPTIONS[
-            'NEW' if new or not api_key else 'EXISTING']
+        start_options = messages.options(self.START_OPTIONS[
+            'NEW' if new or not api_key else 'EXISTING'],
+            self.locale(chat_id))
         reply_keyboard = [self.options_list_buttons(start_options)]
         reply_markup = InlineKeyboardMarkup(reply_keyboard)
-        update.message.reply_text(
-            '\n'.join([
-                f"Здравствуйте, {from_user.first_name}!",
-                "Выберите действие:"
-            ]), reply_markup=reply_markup)
+        self.reply(
+            update.message,
+            self.text(chat_id, 'start.greeting', name=from_user.first_name),
+            reply_markup=reply_markup)
         return self.ROOT_ACTION
 
     def root_action(self, update: Update, context: CallbackContext) -> int:
         query = update.callback_query
-        query.answer()
+        self.answer(query)
         action, from_user = int(query.data), query.from_user
+        chat_id = str(query.message.chat_id)
         if action == 0:
-            query.edit_message_text(text="Введите API-ключ:")
+            self.edit(query, self.text(chat_id, 'keys.api_key'))
             return self.ADD_API_KEY
         elif action == 1:
-            reply_keyboard = [self.options_list_buttons(
-                self.NOTIFICATIONS_OPTIONS)]
+            reply_keyboard = [self.options_list_buttons(messages.options(
+                self.NOTIFICATIONS_OPTIONS, self.locale(chat_id)))]
             reply_markup = InlineKeyboardMarkup(reply_keyboard)
-            query.edit_message_text(
-                '\n'.join([
-                    "Настройка уведомлений:"
-                ]), reply_markup=reply_markup)
+            self.edit(
+                query, self.text(chat_id, 'notifications.title'),
+                reply_markup=reply_markup)
             return self.EDIT_NOTIFICATIONS
+        elif action == 2:
+            self.edit(query, '\n'.join([
+                *self.describe_alerts(chat_id),
+                "",
+                self.text(chat_id, 'alerts.help'),
+            ]))
+            return self.EDIT_ALERTS
+        elif action == 3:
+            self.edit(query, '\n'.join([
+                *self.describe_accounts(chat_id),
+                "",
+                self.text(chat_id, 'accounts.help'),
+            ]))
+            return self.EDIT_ACCOUNTS
+
+    def describe_alerts(self, chat_id):
+        alerts = self.profiles.get(chat_id, {}).get('alerts', ())
+        if not alerts:
+            return [self.text(chat_id, 'alerts.none')]
+        signs = {
+            Alert.ABOVE: '>', Alert.BELOW: '<', Alert.MOVE: '±',
+            Alert.SPREAD: 'spread'}
+        return [self.text(chat_id, 'alerts.title'), *(
+            f"{number}. {alert['symbol']} {signs[alert['kind']]} "
+            f"{alert['value']:g}{'%' if alert['kind'] == Alert.MOVE else ''}"
+            for number, alert in enumerate(alerts, 1))]
+
+    def describe_accounts(self, chat_id):
+        accounts = self.profiles.get(chat_id, {}).get('accounts', ())
+        if not accounts:
+            return [self.text(chat_id, 'accounts.none')]
+        return [self.text(chat_id, 'accounts.title'), *(
+            f"{number}. {account['label']}"
+            for number, account in enumerate(accounts, 1))]
 
     def add_api_key(self, update: Update, context: CallbackContext) -> int:
         chat_id, text, from_user = self.get_message_details(update)
         chat_id = str(chat_id)
         message = update.message
-        api_key = text
+        api_key = get_vault().seal(text)
         self.update_profile(chat_id, {'binance_api_key': api_key})
         self.shredder(chat_id, message)
-        update.message.reply_text(
-            text="API-ключ принят.\nВведите секретный ключ (любое значение):")
+        self.reply(message, self.text(chat_id, 'keys.secret_key'))
         return self.ADD_SECRET_KEY
 
     def add_secret_key(self, update: Update, context: CallbackContext) -> int:
         chat_id, text, from_user = self.get_message_details(update)
         chat_id = str(chat_id)
         message = update.message
-        secret_key = text
+        secret_key = get_vault().seal(text)
         self.update_profile(chat_id, {
             'binance_secret_key': secret_key,
             'notifications': True
         })
         self.submit_profile(chat_id)
         self.shredder(chat_id, message)
-        message.reply_text(
-            text=f"Пара ключей принята.")
+        self.reply(message, self.text(chat_id, 'keys.accepted'))
         return ConversationHandler.END
 
-    def edit_notifications(self, update: Update, context: CallbackContext) -> int:
+    def edit_notifications(
+            self, update: Update, context: CallbackContext) -> int:
         query = update.callback_query
-        query.answer()
+        self.answer(query)
         action = int(query.data)
         chat_id = str(query.message.chat_id)
-        notifications_state = self.profiles[chat_id].get('notifications')
-        notifications = action == 0
-        self.update_profile(chat_id, {'notifications': notifications})
+        (
+            notifications, notification_filter, notification_digest
+        ) = self.NOTIFICATIONS_SETTINGS[action]
+        preferences = {'notifications': notifications}
+        if notification_filter:
+            preferences['notification_filter'] = notification_filter
+        if notification_digest is not None:
+            preferences['notification_digest'] = notification_digest
+        self.update_profile(chat_id, preferences)
         self.submit_profile(chat_id)
-        profile_db, new = self.get_profile_db(chat_id)
-        profile_db.notifications = notifications
-        profile_db.save()
-        query.edit_message_text(
-            text=f"Уведомления {'включены' if notifications else 'отключены'}!")
+        self.store.update(chat_id, **preferences)
+        if notification_digest:
+            self.edit(query, self.text(chat_id, 'notifications.digest'))
+            return ConversationHandler.END
+        self.edit(query, self.text(
+            chat_id,
+            'notifications.on' if notifications else 'notifications.off'))
+        return ConversationHandler.END
+
+    def edit_alerts(self, update: Update, context: CallbackContext) -> int:
+        chat_id, text, from_user = self.get_message_details(update)
+        chat_id = str(chat_id)
+        alerts = self.profiles.get(chat_id, {}).get('alerts', ())
+        delete, alert = ALERT_DELETE_PATTERN.match(text), parse_alert(text)
+        if delete and 0 < int(delete[1]) <= len(alerts):
+            self.run_in_loop(self.delete_alert(
+                chat_id, alerts[int(delete[1]) - 1]['pk']))
+            self.reply(update.message, self.text(chat_id, 'alerts.deleted'))
+            return ConversationHandler.END
+        if not alert:
+            self.reply(update.message, self.text(chat_id, 'alerts.invalid'))
+            return self.EDIT_ALERTS
+        if len(alerts) >= MAX_ALERTS_PER_CHAT:
+            self.reply(update.message, self.text(
+                chat_id, 'alerts.limit', limit=MAX_ALERTS_PER_CHAT))
+            return ConversationHandler.END
+        self.run_in_loop(self.create_alert(chat_id, *alert))
+        self.reply(update.message, self.text(chat_id, 'alerts.added'))
+        return ConversationHandler.END
+
+    async def create_alert(self, chat_id, symbol, kind, value):
+        alert = await sync_to_async(Alert.objects.create)(
+            telegram_chat_id=chat_id, symbol=symbol, kind=kind, value=value)
+        self.update_profile(chat_id, {'alerts': (
+            *self.profiles.get(chat_id, {}).get('alerts', ()),
+            alert_values(alert))})
+        await self.set_binance_account(chat_id, stored=True)
+
+    async def delete_alert(self, chat_id, pk):
+        await sync_to_async(Alert.objects.filter(pk=pk).update)(active=False)
+        self.forget_alert(chat_id, pk)
+        await self.set_binance_account(chat_id, stored=True)
+
+    # Anything sent in this state may hold keys, however malformed, so the
+    # message is deleted before it is even parsed
+    def edit_accounts(self, update: Update, context: CallbackContext) -> int:
+        chat_id, text, from_user = self.get_message_details(update)
+        chat_id = str(chat_id)
+        self.shredder(chat_id, update.message)
+        accounts = self.profiles.get(chat_id, {}).get('accounts', ())
+        delete, match = (
+            ALERT_DELETE_PATTERN.match(text), ACCOUNT_PATTERN.match(text))
+        if delete and 0 < int(delete[1]) <= len(accounts):
+            self.run_in_loop(self.delete_account(
+                chat_id, accounts[int(delete[1]) - 1]['pk']))
+            self.reply(update.message, self.text(chat_id, 'accounts.deleted'))
+            return ConversationHandler.END
+        if not match:
+            self.reply(
+                update.message, self.text(chat_id, 'accounts.invalid'))
+            return self.EDIT_ACCOUNTS
+        if len(accounts) >= MAX_ACCOUNTS_PER_CHAT:
+            self.reply(update.message, self.text(
+                chat_id, 'accounts.limit', limit=MAX_ACCOUNTS_PER_CHAT))
+            return ConversationHandler.END
+        label, api_key, secret_key = match.groups()
+        vault = get_vault()
+        self.run_in_loop(self.create_account(
+            chat_id, label, vault.seal(api_key), vault.seal(secret_key)))
+        self.reply(update.message, self.text(chat_id, 'accounts.added'))
+        return ConversationHandler.END
+
+    async def create_account(self, chat_id, label, api_key, secret_key):
+        account = await sync_to_async(LinkedAccount.objects.create)(
+            telegram_chat_id=chat_id, label=label,
+            binance_api_key=api_key, binance_secret_key=secret_key)
+        self.update_profile(chat_id, {'accounts': (
+            *self.profiles.get(chat_id, {}).get('accounts', ()),
+            account_values(account))})
+        await self.set_binance_account(chat_id, stored=True)
+
+    async def delete_account(self, chat_id, pk):
+        await sync_to_async(
+            LinkedAccount.objects.filter(pk=pk).delete)()
+        self.update_profile(chat_id, {'accounts': tuple(
+            account
+            for account in self.profiles.get(chat_id, {}).get('accounts', ())
+            if account['pk'] != pk)})
+        await self.set_binance_account(chat_id, stored=True)
+
+    def portfolio(self, update: Update, context: CallbackContext) -> int:
+        chat_id = str(update.message.chat_id)
+        if self.on_portfolio:
+            self.run_in_loop(self.on_portfolio(chat_id, self))
         return ConversationHandler.END
 
     def cancel(self, update: Update, context: CallbackContext) -> int:
-        update.message.reply_text("Введите /start и выберите действие.")
+        self.reply(update.message, self.text(
+            str(update.message.chat_id), 'start.hint'))
         return ConversationHandler.END
 
     def get_handler(self):
         command_handlers = [
             CommandHandler('start', self.start),
-            CommandHandler('cancel', self.cancel)
+            CommandHandler('cancel', self.cancel),
+            CommandHandler('portfolio', self.portfolio),
         ]
         return ConversationHandler(
-            entry_points=[CommandHandler('start', self.start)],
+            entry_points=[
+                CommandHandler('start', self.start),
+                CommandHandler('portfolio', self.portfolio),
+            ],
             states={
                 self.ROOT_ACTION: [CallbackQueryHandler(self.root_action)],
                 self.ADD_API_KEY: [
@@ -180,15 +492,36 @@ class BinanceMixin(ProfileMixin):
                 ],
                 self.EDIT_NOTIFICATIONS: [CallbackQueryHandler(
                     self.edit_notifications)],
+                self.EDIT_ALERTS: [
+                    *command_handlers,
+                    MessageHandler(Filters.text, self.edit_alerts)
+                ],
+                self.EDIT_ACCOUNTS: [
+                    *command_handlers,
+                    MessageHandler(Filters.text, self.edit_accounts)
+                ],
             },
-            fallbacks=[CommandHandler('cancel', self.cancel)]
+            fallbacks=[
+                CommandHandler('cancel', self.cancel),
+                CommandHandler('portfolio', self.portfolio),
+            ]
         )
 
 
 class TelegramBot:
+    outbox_rate = GLOBAL_RATE
+
     def __init__(self, loop, queue):
         self.loop, self.queue = loop, queue
         self.create_bot()
+        self.outbox = Outbox(self.bot, loop, rate=self.outbox_rate)
+        self.outbox.start()
+        self.coalescer = Coalescer(self.outbox, loop)
+        # Updates received before `ready`, in arrival order
+        self.waiting = deque()
+        # Set once no other process polls for this bot's updates
+        self.handed_over = asyncio.Event()
+        self.handed_over.set()
 
     def create_bot(self):
         request = Request(
@@ -198,18 +531,103 @@ class TelegramBot:
         )
         self.bot = Bot(
             request=request,
-            token=_.TELEGRAM_BOT_TOKEN,
-            # base_url=_.TELEGRAM_PROXY_URL,
+            token=settings.TELEGRAM_BOT_TOKEN,
+            base_url=settings.TELEGRAM_API_URL,
         )
 
-    def set_updater(self):
-        updater = Updater(bot=self.bot)
-        updater.dispatcher.add_handler(
+    # Loop thread only needs a task; other threads hand the coroutine over
+    def run_in_loop(self, coro):
+        if self.outbox.in_loop():
+            return self.loop.create_task(coro)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    # Handlers run on the event loop, so their replies go through the outbox
+    def reply(self, message, text, **kwargs):
+        self.outbox.send(message.chat_id, text, **kwargs)
+
+    def answer(self, query, **kwargs):
+        self.outbox.call(
+            query.message.chat_id, 'answer_callback_query', query.id,
+            **kwargs)
+
+    def edit(self, query, text, **kwargs):
+        self.outbox.call(
+            query.message.chat_id, 'edit_message_text', text,
+            chat_id=query.message.chat_id,
+            message_id=query.message.message_id, **kwargs)
+
+    async def create_dispatcher(self):
+        # Command filters need the bot's username; fetch it off the loop once
+        await self.loop.run_in_executor(None, self.bot.get_me)
+        # No `run_async` handlers, so no dispatcher worker threads
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.dispatcher = Dispatcher(self.bot, None, workers=0)
+        self.dispatcher.add_handler(
             self.get_handler())
-        updater.dispatcher.add_handler(
+        self.dispatcher.add_handler(
             self.get_handler_echo())
-        updater.start_polling()
-        # updater.idle()  - not necessary, as this fuction is run in executor
+        self.handler_stats = HandlerStats()
+
+    # Whether handlers may run on the loop, i.e. without blocking I/O
+    def ready(self):
+        return True
+
+    def dispatch(self, update):
+        started = time.monotonic()
+        self.dispatcher.process_update(update)
+        self.handler_stats.observe(time.monotonic() - started)
+
+    # Updates are handled on the loop in arrival order; those arriving
+    # before `ready` are queued and handled once it is
+    def process_update(self, data):
+        update = Update.de_json(data, self.bot)
+        if self.waiting or not self.ready():
+            self.waiting.append(update)
+        else:
+            self.dispatch(update)
+
+    def dispatch_waiting(self):
+        logger.info("Dispatching waiting updates", extra={
+            'updates': len(self.waiting)})
+        while self.waiting:
+            self.dispatch(self.waiting.popleft())
+
+    async def api(self, method, request_timeout=REQUEST_TIMEOUT, **params):
+        session = ConnectionManager.get_session()
+        async with session.post(
+                f'{self.bot.base_url}/{method}', json=params,
+                timeout=ClientTimeout(total=request_timeout)
+        ) as response:
+            data = await response.json()
+        if not data.get('ok'):
+            raise TelegramError(data.get('description', 'Unknown error'))
+        return data['result']
+
+    # Telegram answers concurrent long polls of one bot with 409 and splits
+    # the updates between them, so polling waits for the handover
+    async def poll_updates(self):
+        await self.handed_over.wait()
+        offset, webhook_deleted = 0, False
+        while True:
+            try:
+                if not webhook_deleted:
+                    await self.api('deleteWebhook')
+                    webhook_deleted = True
+                updates = await self.api(
+                    'getUpdates',
+                    request_timeout=POLL_TIMEOUT + REQUEST_TIMEOUT,
+                    offset=offset, timeout=POLL_TIMEOUT)
+            except (ClientError, asyncio.TimeoutError, TelegramError) as e:
+                logger.warning("Polling failed", extra={'error': repr(e)})
+                await asyncio.sleep(POLL_RETRY_DELAY)
+                continue
+            for data in updates:
+                offset = data['update_id'] + 1
+                self.process_update(data)
+
+    async def set_webhook(self, url, secret):
+        await self.api('setWebhook', url=url, secret_token=secret)
 
     def get_handler_echo(self):
         # Echo as default
@@ -224,8 +642,9 @@ class TelegramBot:
 
     def do_echo(self, update: Update, context: CallbackContext):
         chat_id, text, from_user = self.get_message_details(update)
-        update.message.reply_text(
-            text=f"""{chat_id}
+        self.reply(
+            update.message,
+            f"""{chat_id}
 
 {text}
 {from_user.first_name}
@@ -234,3 +653,11 @@ class TelegramBot:
 
 class BinanceBot(BinanceMixin, TelegramBot):
     pass
+
+
+# Bot side of a shard worker: sends notifications and stores profiles,
+# sharing the Telegram rate budget with the other processes
+class ShardBot(ProfileMixin, TelegramBot):
+    def __init__(self, loop, queue, shards):
+        self.outbox_rate = GLOBAL_RATE / (shards + 1)
+        super().__init__(loop, queue)
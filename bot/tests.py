@@ -1,3 +1,1853 @@
-from django.test import TestCase
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from decimal import Decimal
+from io import StringIO
+from queue import Queue
+from types import SimpleNamespace
+from unittest import mock, skipIf
 
-# Create your tests here.
+from aiohttp import ClientError
+from asgiref.sync import sync_to_async
+from django.core.management import call_command
+from django.test import (
+    SimpleTestCase, TransactionTestCase, override_settings)
+from django.utils import timezone
+from telegram import User
+from telegram.error import RetryAfter
+
+from . import messages
+from .alerts import (
+    ABOVE, BELOW, MOVE, SPREAD, AlertEngine, AlertIndex, AlertRule)
+from .binance_utils import (
+    BinanceAccount, BinanceAccountsManager, Subscription)
+from .checkpoint import AccountState, Checkpointer, Checkpoints
+from .core import CircuitBreaker, ConnectionManager
+from .delivery import MAX_MESSAGE_LENGTH, Coalescer, Outbox, RateLimiter
+from .events import (
+    EVENT_TYPES, FILTER_ALL, FILTER_DEFAULT, FILTER_ORDERS, BalanceUpdate,
+    ExecutionReport, ListenKeyExpired, UnknownEvent, accepts, decode,
+    trade_report)
+from .journal import EventJournal
+from .keepalive import (
+    LISTEN_KEY_TIMEOUT, RETRY_DELAY, RETRY_MAX, KeepAliveScheduler)
+from .log import JsonFormatter
+from .market import SNAPSHOT_LIMIT, MarketData, OrderBook, PriceLevels
+from .metrics import REGISTRY, Counter, Histogram, render
+from .models import LinkedAccount, Profile
+from .portfolio import Balances, PriceCache, format_portfolio
+from .profiler import frame_account, frame_name
+from .profiles import PROGRESS_INTERVAL, ProfileStore, WarmupProgress
+from .rest import WeightBudget, request_weight
+from .sharding import HashRing, ShardCoordinator, ShardManager
+from .status import StatusExport, StatusQuery
+from .streams import MultiplexedSocket, StreamMultiplexer
+from .telegram_utils import (
+    BinanceBot, ProfileMixin, TelegramBot, parse_alert)
+from .vault import (
+    Fernet, SecretCache, Vault, VaultError, get_vault, is_sealed)
+from .webhook import SECRET_HEADER, WEBHOOK_PATH, BotApplication
+
+
+async def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Condition not met in time")
+        await asyncio.sleep(.01)
+
+
+# `telegram.Bot` stand-in recording calls; `failures` are raised first
+class FakeBot:
+    def __init__(self, *failures):
+        self.calls = []
+        self.failures = [*failures]
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            if self.failures:
+                raise self.failures.pop(0)
+            self.calls.append((method, args, kwargs))
+        return call
+
+
+# Session whose requests never complete, for cancelling calls mid-flight
+class HangingSession:
+    def get(self, url, **kwargs):
+        return self
+
+    async def __aenter__(self):
+        await asyncio.sleep(60)
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    URL = 'http://breaker.test/'
+
+    def tearDown(self):
+        ConnectionManager.breakers.pop('breaker.test', None)
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker('host', threshold=2, reset_timeout=60)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_trial_closes_or_reopens(self):
+        breaker = CircuitBreaker('host', threshold=1, reset_timeout=0)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    async def test_cancelled_trial_reopens(self):
+        breaker = ConnectionManager.breaker(self.URL)
+        breaker.failure()
+        breaker.state, breaker.opened = CircuitBreaker.OPEN, 0
+        with mock.patch.object(
+                ConnectionManager, 'get_session',
+                return_value=HangingSession()):
+            task = asyncio.ensure_future(ConnectionManager().fetch(self.URL))
+            await asyncio.sleep(0)
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(breaker.allow())
+
+
+class RateLimiterTests(SimpleTestCase):
+    async def test_waits_once_burst_is_spent(self):
+        limiter = RateLimiter(50, burst=2)
+        started = time.monotonic()
+        for _ in range(4):
+            await limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, .035)
+
+
+@mock.patch('bot.delivery.CHAT_INTERVAL', 0)
+# Event stand-in rendering to its name, folded by `group`
+class FakeEvent:
+    def __init__(self, name, group=None):
+        self.name, self.group = name, group
+
+    def key(self):
+        return self.group
+
+    def render(self, locale=None):
+        return self.name
+
+    @classmethod
+    def render_summary(cls, events, locale=None):
+        return '+'.join(event.name for event in events)
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, chat_id, text, on_sent=()):
+        self.sent.append((chat_id, text))
+
+
+class OutboxTests(SimpleTestCase):
+    async def test_merges_plain_messages_per_chat(self):
+        bot = FakeBot()
+        outbox = Outbox(bot, asyncio.get_running_loop(), workers=1)
+        sent = []
+        outbox.send('1', 'a')
+        outbox.send('1', 'b', on_sent=[lambda: sent.append('b')])
+        outbox.send('2', 'c')
+        outbox.start()
+        await wait_until(lambda: len(bot.calls) == 2)
+        await outbox.stop()
+        self.assertEqual(bot.calls, [
+            ('send_message', ('1', 'a\n\nb'), {}),
+            ('send_message', ('2', 'c'), {}),
+        ])
+        self.assertEqual(sent, ['b'])
+        self.assertEqual(outbox.stats.batched, 1)
+        self.assertEqual(outbox.depth, 0)
+
+    async def test_batches_stop_at_markup_and_length(self):
+        outbox = Outbox(FakeBot(), asyncio.get_running_loop())
+        outbox.send('1', 'a' * (MAX_MESSAGE_LENGTH - 10))
+        outbox.send('1', 'b' * 20)
+        outbox.send('1', 'c', reply_markup='markup')
+        self.assertEqual(len(outbox.take_batch('1')), 1)
+        self.assertEqual(len(outbox.take_batch('1')), 1)
+        self.assertEqual(
+            outbox.take_batch('1')[0].kwargs, {'reply_markup': 'markup'})
+
+    async def test_chat_queue_drops_its_oldest(self):
+        outbox = Outbox(FakeBot(), asyncio.get_running_loop())
+        with mock.patch('bot.delivery.CHAT_QUEUE_SIZE', 2):
+            for text in 'abc':
+                outbox.send('1', text)
+        self.assertEqual(
+            [item.text for item in outbox.chats['1']], ['b', 'c'])
+        self.assertEqual(outbox.stats.dropped, 1)
+
+    async def test_retries_after_flood_control(self):
+        bot = FakeBot(RetryAfter(0))
+        outbox = Outbox(bot, asyncio.get_running_loop(), workers=1)
+        outbox.send('1', 'a')
+        outbox.start()
+        await wait_until(lambda: bot.calls)
+        await outbox.stop()
+        self.assertEqual(bot.calls, [('send_message', ('1', 'a'), {})])
+        self.assertEqual(outbox.stats.retried, 1)
+
+    @mock.patch('bot.delivery.CHAT_INTERVAL', 0)
+    async def test_stop_delivers_queued_messages_first(self):
+        bot = FakeBot(RetryAfter(0))
+        outbox = Outbox(bot, asyncio.get_running_loop(), workers=2)
+        outbox.start()
+        for chat_id in '123':
+            outbox.send(chat_id, 'a')
+        await outbox.stop()
+        self.assertEqual(len(bot.calls), 3)
+        self.assertEqual((outbox.depth, outbox.sending), (0, 0))
+
+    async def test_stop_gives_up_after_the_timeout(self):
+        bot = FakeBot()
+        outbox = Outbox(bot, asyncio.get_running_loop(), workers=1)
+        outbox.start()
+        # The second message waits for the chat's interval
+        outbox.send('1', 'a', reply_markup='markup')
+        outbox.send('1', 'b', reply_markup='markup')
+        started = time.monotonic()
+        await outbox.stop(timeout=.1)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(len(bot.calls), 1)
+        self.assertEqual(outbox.depth, 1)
+
+
+class HashRingTests(SimpleTestCase):
+    KEYS = [f'key-{number}' for number in range(2000)]
+
+    def placement(self, ring):
+        return {key: ring.lookup(key) for key in self.KEYS}
+
+    def test_empty_ring(self):
+        self.assertIsNone(HashRing().lookup('key'))
+
+    def test_spreads_keys(self):
+        counts = {}
+        for shard in self.placement(HashRing(range(4))).values():
+            counts[shard] = counts.get(shard, 0) + 1
+        self.assertEqual(set(counts), {0, 1, 2, 3})
+        self.assertGreater(min(counts.values()), len(self.KEYS) / 8)
+
+    def test_adding_a_shard_only_moves_keys_to_it(self):
+        ring = HashRing(range(3))
+        before = self.placement(ring)
+        ring.add(3)
+        after = self.placement(ring)
+        moved = [key for key in self.KEYS if before[key] != after[key]]
+        self.assertTrue(moved)
+        self.assertLess(len(moved), len(self.KEYS) / 2)
+        self.assertTrue(all(after[key] == 3 for key in moved))
+
+    def test_removing_a_shard_restores_placement(self):
+        ring = HashRing(range(3))
+        before = self.placement(ring)
+        ring.add(3)
+        ring.remove(3)
+        self.assertEqual(self.placement(ring), before)
+        self.assertNotIn(3, ring)
+
+
+class ShardCoordinatorTests(SimpleTestCase):
+    class SlowShard:
+        def __init__(self):
+            self.commands = []
+            self.process = mock.Mock()
+            self.process.join.side_effect = lambda timeout: time.sleep(.2)
+            self.process.is_alive.return_value = False
+
+        def send(self, *command):
+            self.commands.append(command)
+
+    async def test_stopping_shards_keeps_the_loop_running(self):
+        coordinator = ShardCoordinator(asyncio.Queue(), 0)
+        shards = coordinator.shards = {
+            0: self.SlowShard(), 1: self.SlowShard()}
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(.01)
+
+        ticker = asyncio.create_task(tick())
+        await coordinator.stop()
+        ticker.cancel()
+        self.assertGreater(len(ticks), 5)
+        self.assertEqual(coordinator.shards, {})
+        for shard in shards.values():
+            self.assertEqual(shard.commands, [('stop',)])
+            shard.process.terminate.assert_not_called()
+
+    async def test_shard_that_does_not_stop_is_terminated(self):
+        coordinator = ShardCoordinator(asyncio.Queue(), 0)
+        shard = coordinator.shards[0] = self.SlowShard()
+        shard.process.join.side_effect = None
+        shard.process.is_alive.return_value = True
+        await coordinator.stop()
+        shard.process.terminate.assert_called_once_with()
+        self.assertEqual(shard.process.join.call_count, 2)
+
+
+class ShardManagerTests(SimpleTestCase):
+    @mock.patch('bot.sharding.LISTEN_TIMEOUT', .01)
+    async def test_pump_keeps_polling_for_commands(self):
+        manager = ShardManager.__new__(ShardManager)
+        manager.queue, commands, bot = asyncio.Queue(), Queue(), object()
+        pump = asyncio.create_task(manager.pump(commands, bot))
+        await asyncio.sleep(.05)
+        commands.put(('profile', {'telegram_chat_id': '1'}, True))
+        try:
+            self.assertEqual(
+                await asyncio.wait_for(manager.queue.get(), 1),
+                ({'telegram_chat_id': '1'}, bot, True))
+        finally:
+            pump.cancel()
+
+
+class ProfileRefreshTests(TransactionTestCase):
+    def store(self):
+        store = ProfileStore()
+        store.load_chunk(0, 100)
+        store.loaded = True
+        return store
+
+    def test_own_writes_are_not_reported(self):
+        Profile.objects.create(telegram_chat_id='1')
+        store = self.store()
+        store.update('1', notifications=False)
+        store.update('2', notifications=True)
+        store.flush()
+        self.assertEqual(store.refresh(), {})
+        Profile.objects.filter(telegram_chat_id='2').update(
+            locale='en', updated=timezone.now())
+        self.assertEqual(store.refresh(), {'2': ()})
+        self.assertEqual(store.get('2').locale, 'en')
+
+    def test_rotated_linked_accounts_are_reported(self):
+        Profile.objects.create(telegram_chat_id='1')
+        LinkedAccount.objects.create(
+            telegram_chat_id='1', label='Work', binance_api_key='key',
+            binance_secret_key='secret')
+        store = self.store()
+        with mock.patch('bot.vault.vault', Vault([
+                Fernet.generate_key().decode()])):
+            call_command('rotate_credentials', stdout=StringIO())
+        [account] = store.refresh()['1']
+        self.assertTrue(is_sealed(account['binance_api_key']))
+        self.assertEqual(account['label'], 'Work')
+
+
+class ProfileSaveTests(TransactionTestCase):
+    def mixin(self):
+        mixin = ProfileMixin.__new__(ProfileMixin)
+        mixin.store = ProfileStore()
+        return mixin
+
+    # Shard stores are never marked loaded; a miss must not hit the
+    # database on the loop
+    async def test_uncached_chat_is_saved_off_the_loop(self):
+        await sync_to_async(Profile.objects.create)(
+            telegram_chat_id='1', binance_api_key='old')
+        mixin = self.mixin()
+        await mixin.save_profile_db({
+            'telegram_chat_id': '1', 'binance_api_key': 'new',
+            'alerts': ()})
+        self.assertEqual(mixin.store.profiles['1'].binance_api_key, 'new')
+        await sync_to_async(mixin.store.flush)()
+        profile = await sync_to_async(Profile.objects.get)(
+            telegram_chat_id='1')
+        self.assertEqual(profile.binance_api_key, 'new')
+
+    async def test_new_chat_is_created(self):
+        mixin = self.mixin()
+        await mixin.save_profile_db({
+            'telegram_chat_id': '2', 'notifications': True})
+        await sync_to_async(mixin.store.flush)()
+        self.assertTrue(await sync_to_async(
+            Profile.objects.filter(
+                telegram_chat_id='2', notifications=True).exists)())
+
+
+class WarmupProgressTests(SimpleTestCase):
+    def test_progress_is_reported_with_rate_and_eta(self):
+        clock = FakeClock(1000)
+        with mock.patch('bot.profiles.time.monotonic', clock.time):
+            progress = WarmupProgress(100)
+            with self.assertNoLogs('bot.profiles', 'INFO'):
+                for _ in range(10):
+                    progress.advance()
+            clock.now += PROGRESS_INTERVAL
+            with self.assertLogs('bot.profiles', 'INFO') as logs:
+                progress.advance()
+        [record] = logs.records
+        self.assertEqual(
+            (record.done, record.total, record.percent, record.rate,
+             record.eta_s),
+            (11, 100, 11.0, 1.1, 81))
+
+    def test_empty_warmup_is_complete(self):
+        progress = WarmupProgress(0)
+        with self.assertLogs('bot.profiles', 'INFO') as logs:
+            progress.report()
+            progress.finish()
+        report, done = logs.records
+        self.assertEqual((report.percent, report.eta_s), (100, 0))
+        self.assertEqual(done.done, 0)
+
+
+class UpdateOrderTests(SimpleTestCase):
+    def message(self, update_id, text):
+        return {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': 0, 'text': text,
+            'chat': {'id': 1, 'type': 'private'}}}
+
+    def test_updates_before_ready_keep_their_order(self):
+        bot = TelegramBot.__new__(TelegramBot)
+        bot.bot, bot.waiting, loaded, handled = None, deque(), [], []
+        bot.ready = lambda: bool(loaded)
+        bot.dispatch = lambda update: handled.append(update.message.text)
+        bot.process_update(self.message(1, 'api key'))
+        bot.process_update(self.message(2, 'secret'))
+        self.assertEqual(handled, [])
+        loaded.append(True)
+        bot.dispatch_waiting()
+        bot.process_update(self.message(3, 'after'))
+        self.assertEqual(handled, ['api key', 'secret', 'after'])
+
+    @mock.patch('bot.telegram_utils.POLL_RETRY_DELAY', 0)
+    async def test_webhook_removal_is_retried(self):
+        bot = TelegramBot.__new__(TelegramBot)
+        bot.handed_over, handled = asyncio.Event(), []
+        bot.handed_over.set()
+        bot.process_update = lambda data: handled.append(data['update_id'])
+        bot.api = mock.AsyncMock(side_effect=[
+            ClientError(), None, [{'update_id': 5}],
+            asyncio.TimeoutError(), asyncio.CancelledError()])
+        with self.assertRaises(asyncio.CancelledError):
+            await bot.poll_updates()
+        self.assertEqual(
+            [call.args[0] for call in bot.api.call_args_list],
+            ['deleteWebhook', 'deleteWebhook', 'getUpdates', 'getUpdates',
+             'getUpdates'])
+        self.assertEqual(bot.api.call_args.kwargs['offset'], 6)
+        self.assertEqual(handled, [5])
+
+
+@override_settings(BOT_WARMUP_CHUNK_SIZE=2)
+class WarmupTests(TransactionTestCase):
+    def create(self):
+        for chat_id in '12345':
+            Profile.objects.create(telegram_chat_id=chat_id)
+        LinkedAccount.objects.create(
+            telegram_chat_id='2', label='work', binance_api_key='key')
+
+    async def test_updates_are_handled_while_accounts_are_admitted(self):
+        await sync_to_async(self.create)()
+        # Admission stalls on the first chat until the queue is read
+        queue = asyncio.Queue(maxsize=1)
+        checkpoints = mock.Mock(
+            priority=lambda: ['4', '9'], owners_running=lambda: set())
+        with mock.patch(
+                'bot.telegram_utils.Checkpoints', return_value=checkpoints):
+            # Warms up on its own
+            bot = BinanceBot(asyncio.get_running_loop(), queue)
+            await wait_until(lambda: bot.ready() and queue.full())
+        self.assertLessEqual({*'12345'}, bot.profiles.keys())
+        admitted = []
+        while len(admitted) < 5:
+            profile, _, stored = await asyncio.wait_for(queue.get(), 1)
+            self.assertTrue(stored)
+            admitted.append(profile['telegram_chat_id'])
+            queue.task_done()
+        await bot.outbox.stop()
+        self.assertEqual(admitted, ['4', '1', '2', '3', '5'])
+        self.assertEqual(
+            [account['label'] for account in bot.profiles['2']['accounts']],
+            ['work'])
+
+    @override_settings(BOT_RESUME_RATE=100, BOT_WARMUP_RATE=10)
+    async def test_chunks_are_admitted_at_their_rate(self):
+        await sync_to_async(self.create)()
+        queue = asyncio.Queue()
+        checkpoints = mock.Mock(
+            priority=lambda: ['4'], owners_running=lambda: set())
+        limiters = []
+
+        class Limiter:
+            def __init__(self, rate):
+                self.rate, self.acquired = rate, 0
+                limiters.append(self)
+
+            async def acquire(self):
+                self.acquired += 1
+
+        with mock.patch(
+                'bot.telegram_utils.Checkpoints', return_value=checkpoints), \
+                mock.patch('bot.telegram_utils.RateLimiter', Limiter):
+            bot = BinanceBot(asyncio.get_running_loop(), queue)
+            # Patched before the scheduled warm-up starts
+            load_chunk = bot.store.load_chunk = mock.Mock(
+                wraps=bot.store.load_chunk)
+            await wait_until(lambda: queue.qsize() == 5)
+        await bot.outbox.stop()
+        self.assertEqual(
+            [call.args[1] for call in load_chunk.call_args_list], [2] * 4)
+        self.assertEqual(
+            [(limiter.rate, limiter.acquired) for limiter in limiters],
+            [(100, 1), (10, 4)])
+
+    @mock.patch('bot.telegram_utils.HANDOVER_GRACE', 0)
+    async def test_polling_waits_for_the_previous_process_to_exit(self):
+        await sync_to_async(self.create)()
+        queue = asyncio.Queue(maxsize=1)
+        checkpoints = mock.Mock(
+            priority=lambda: [], owners_running=lambda: {123})
+        exited = asyncio.Event()
+        with mock.patch(
+                'bot.telegram_utils.Checkpoints', return_value=checkpoints), \
+                mock.patch('bot.telegram_utils.retire') as retire, \
+                mock.patch('bot.telegram_utils.wait_exited',
+                           lambda pids: exited.wait()):
+            bot = BinanceBot(asyncio.get_running_loop(), queue)
+            bot.api = mock.AsyncMock(side_effect=asyncio.CancelledError)
+            polling = asyncio.create_task(bot.poll_updates())
+            await wait_until(lambda: bot.ready() and queue.full())
+            for _ in range(5):
+                await queue.get()
+                queue.task_done()
+            await wait_until(lambda: retire.called)
+            retire.assert_called_once_with({123})
+            self.assertFalse(bot.api.called)
+            exited.set()
+            with self.assertRaises(asyncio.CancelledError):
+                await asyncio.wait_for(polling, 1)
+        bot.api.assert_called_once_with('deleteWebhook')
+        await bot.outbox.stop()
+
+
+# Front-end bot driven by scripted updates: Telegram calls are recorded by
+# a `FakeBot`, and the profile cache starts empty and warm
+class ScriptedBot(BinanceBot):
+    async def dump_profiles(self):
+        self.store.loaded = True
+        self.dispatch_waiting()
+
+
+@mock.patch('bot.delivery.CHAT_INTERVAL', 0)
+class DispatcherTests(TransactionTestCase):
+    CHAT = {'id': 42, 'type': 'private'}
+    USER = {'id': 42, 'is_bot': False, 'first_name': 'Ann',
+            'language_code': 'en'}
+
+    async def start_bot(self):
+        self.queue = asyncio.Queue()
+        self.bot = ScriptedBot(asyncio.get_running_loop(), self.queue)
+        self.telegram = self.bot.outbox.bot = FakeBot()
+        # Command filters read the username from the bot's own user
+        self.bot.bot._bot = User(1, 'bot', True, username='test_bot')
+        with mock.patch.object(
+                type(self.bot.bot), 'get_me', return_value=self.bot.bot._bot):
+            await self.bot.create_dispatcher()
+        self.updates = iter(range(1, 100))
+        await asyncio.sleep(0)
+
+    def message(self, text):
+        update_id = next(self.updates)
+        message = {
+            'message_id': update_id, 'date': 0, 'text': text,
+            'chat': self.CHAT, 'from': self.USER}
+        if text.startswith('/'):
+            message['entities'] = [
+                {'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        self.bot.process_update({'update_id': update_id, 'message': message})
+
+    def callback(self, data):
+        update_id = next(self.updates)
+        self.bot.process_update({'update_id': update_id, 'callback_query': {
+            'id': f'query-{update_id}', 'from': self.USER,
+            'chat_instance': 'chat', 'data': data,
+            'message': {
+                'message_id': 1000, 'date': 0, 'text': 'menu',
+                'chat': self.CHAT}}})
+
+    def calls(self, method):
+        return [call for call in self.telegram.calls if call[0] == method]
+
+    async def test_keys_are_added_from_the_inline_menu(self):
+        await self.start_bot()
+        self.message('/start')
+        self.callback('0')
+        self.message('API-KEY')
+        self.message('SECRET-KEY')
+        profile, bot, stored = await asyncio.wait_for(self.queue.get(), 1)
+        self.assertEqual(profile['binance_api_key'], 'API-KEY')
+        self.assertEqual(profile['binance_secret_key'], 'SECRET-KEY')
+        self.assertTrue(profile['notifications'])
+        self.assertFalse(stored)
+        await wait_until(lambda: len(self.calls('delete_message')) == 2
+                         and self.calls('edit_message_text'))
+        await self.bot.outbox.stop()
+        self.assertEqual(len(self.calls('answer_callback_query')), 1)
+        [(_, args, kwargs)] = self.calls('edit_message_text')
+        self.assertEqual(kwargs, {'chat_id': 42, 'message_id': 1000})
+        self.assertTrue(all(
+            'KEY' not in args[1] for _, args, _ in self.calls('send_message')))
+
+    async def test_malformed_account_message_is_deleted(self):
+        await self.start_bot()
+        self.message('/start')
+        self.callback('3')
+        self.message('API-KEY SECRET-KEY')
+        self.message('-1')
+        await wait_until(lambda: len(self.calls('send_message')) == 2
+                         and len(self.calls('delete_message')) == 2)
+        await self.bot.outbox.stop()
+        self.assertEqual(
+            [args for _, args, _ in self.calls('delete_message')],
+            [('42', 3), ('42', 4)])
+        invalid = self.bot.text('42', 'accounts.invalid')
+        [_, (_, (_, text), _)] = self.calls('send_message')
+        self.assertEqual(text, f'{invalid}\n\n{invalid}')
+
+    async def test_spread_alert_is_added(self):
+        await self.start_bot()
+        self.message('/start')
+        self.callback('2')
+        self.message('ethusdt spread 1,5')
+        profile, bot, stored = await asyncio.wait_for(self.queue.get(), 1)
+        await self.bot.outbox.stop()
+        [alert] = profile['alerts']
+        self.assertEqual(
+            (alert['symbol'], alert['kind'], alert['value']),
+            ('ETHUSDT', SPREAD, 1.5))
+        self.assertEqual(
+            self.bot.describe_alerts('42')[1], "1. ETHUSDT spread 1.5")
+
+class PriceLevelsTests(SimpleTestCase):
+    def test_best_level_is_last_on_both_sides(self):
+        bids, asks = PriceLevels(1), PriceLevels(-1)
+        for price in (100, 102, 101):
+            bids.update(price, 1)
+            asks.update(price, 1)
+        self.assertEqual(bids.best(), (102, 1))
+        self.assertEqual(asks.best(), (100, 1))
+        self.assertEqual([price for price, _ in bids.top(2)], [102, 101])
+        self.assertEqual([price for price, _ in asks.top(5)], [100, 101, 102])
+
+    def test_update_replaces_and_zero_removes(self):
+        bids = PriceLevels(1)
+        bids.update(100, 1)
+        bids.update(100, 3)
+        self.assertEqual(bids.best(), (100, 3))
+        bids.update(100, 0)
+        bids.update(99, 0)
+        self.assertEqual(len(bids), 0)
+        self.assertIsNone(bids.best())
+
+    def test_trim_keeps_the_top(self):
+        bids = PriceLevels(1)
+        for price in range(10):
+            bids.update(price, 1)
+        bids.trim(limit=3)
+        self.assertEqual([price for price, _ in bids.top(10)], [9, 8, 7])
+
+
+class OrderBookTests(SimpleTestCase):
+    SNAPSHOT = {
+        'lastUpdateId': 10,
+        'bids': [['100', '1'], ['99', '2']],
+        'asks': [['101', '1'], ['102', '0']],
+    }
+
+    def diff(self, first, last, bids=(), asks=()):
+        return {'U': first, 'u': last, 'b': [*bids], 'a': [*asks]}
+
+    def test_buffers_until_snapshot(self):
+        book = OrderBook('BTCUSDT')
+        self.assertTrue(book.apply(self.diff(5, 8, bids=[['98', '1']])))
+        self.assertTrue(book.apply(self.diff(9, 12, bids=[['100', '0']])))
+        self.assertFalse(book.synced)
+        self.assertTrue(book.load(self.SNAPSHOT))
+        self.assertEqual(book.last_update_id, 12)
+        self.assertEqual(book.best_bid(), (99, 2))
+        self.assertEqual(book.best_ask(), (101, 1))
+        self.assertEqual(book.spread(), 2)
+
+    def test_skips_stale_and_resets_on_gap(self):
+        book = OrderBook('BTCUSDT')
+        book.load(self.SNAPSHOT)
+        self.assertTrue(book.apply(self.diff(8, 10, asks=[['100.5', '1']])))
+        self.assertEqual(book.best_ask(), (101, 1))
+        self.assertTrue(book.apply(self.diff(11, 11, asks=[['100.5', '1']])))
+        self.assertEqual(book.best_ask(), (100.5, 1))
+        self.assertFalse(book.apply(self.diff(13, 14)))
+        self.assertFalse(book.synced)
+
+
+class ParseAlertTests(SimpleTestCase):
+    def test_alerts(self):
+        self.assertEqual(parse_alert('btcusdt > 30000'),
+                         ('BTCUSDT', ABOVE, 30000))
+        self.assertEqual(parse_alert('BTCUSDT<25000,5'),
+                         ('BTCUSDT', BELOW, 25000.5))
+        self.assertEqual(parse_alert('BTCUSDT 5%'), ('BTCUSDT', MOVE, 5))
+        self.assertEqual(parse_alert('BTCUSDT ± 5 %'), ('BTCUSDT', MOVE, 5))
+        self.assertEqual(parse_alert('BTCUSDT Spread 2'),
+                         ('BTCUSDT', SPREAD, 2))
+
+    def test_ambiguous_signs_are_rejected(self):
+        for text in ['BTCUSDT ± 5', 'BTCUSDT 30000', 'BTCUSDT > 5%',
+                     'BTCUSDT < 5%', 'BTCUSDT spread', '- 1']:
+            with self.subTest(text=text):
+                self.assertIsNone(parse_alert(text))
+
+
+class KeepAliveSchedulerTests(SimpleTestCase):
+    def scheduler(self, *results, on_expired=None):
+        scheduler = KeepAliveScheduler(
+            on_expired or mock.AsyncMock(return_value=True))
+        account = mock.Mock(fingerprint='abc')
+        account.keep_alive_listen_key = mock.AsyncMock(side_effect=results)
+        scheduler.add(account, delay=0)
+        return scheduler, scheduler.entries[account]
+
+    async def refresh(self, scheduler, entry):
+        await scheduler.semaphore.acquire()
+        await scheduler.refresh(entry)
+        return entry.deadline - time.monotonic()
+
+    async def test_failures_back_off_until_a_refresh_succeeds(self):
+        scheduler, entry = self.scheduler(
+            RuntimeError("unexpected"), ClientError(), None, None, True)
+        for delay in [RETRY_DELAY, 2 * RETRY_DELAY, 4 * RETRY_DELAY,
+                      RETRY_MAX]:
+            self.assertAlmostEqual(
+                await self.refresh(scheduler, entry), delay, places=1)
+        self.assertEqual(entry.failures, 4)
+        self.assertGreater(
+            await self.refresh(scheduler, entry), LISTEN_KEY_TIMEOUT * .8)
+        self.assertEqual(entry.failures, 0)
+
+    async def test_dropped_key_is_renewed_by_the_owner(self):
+        on_expired = mock.AsyncMock(side_effect=[ValueError(), True])
+        scheduler, entry = self.scheduler(False, False, on_expired=on_expired)
+        self.assertAlmostEqual(
+            await self.refresh(scheduler, entry), RETRY_DELAY, places=1)
+        await self.refresh(scheduler, entry)
+        on_expired.assert_awaited_with(entry.account)
+        self.assertEqual(entry.failures, 0)
+
+    async def test_due_entries_are_refreshed_by_the_run_task(self):
+        scheduler, entry = self.scheduler(True)
+        scheduler.start()
+        try:
+            await wait_until(lambda: entry.deadline > time.monotonic() + 60)
+        finally:
+            scheduler.task.cancel()
+        entry.account.keep_alive_listen_key.assert_awaited_once()
+        # A removed account is not rescheduled
+        scheduler.remove(entry.account)
+        self.assertFalse(scheduler.is_current(entry, entry.seq))
+
+
+class BalancesTests(SimpleTestCase):
+    ACCOUNT = {'updateTime': 100, 'balances': [
+        {'asset': 'BTC', 'free': '1', 'locked': '0.5'},
+        {'asset': 'USDT', 'free': '0', 'locked': '0'}]}
+
+    def position(self, time, asset, free, locked='0'):
+        return {'e': 'outboundAccountPosition', 'E': time,
+                'B': [{'a': asset, 'f': free, 'l': locked}]}
+
+    def delta(self, time, asset, delta):
+        return {'e': 'balanceUpdate', 'E': time, 'a': asset, 'd': delta}
+
+    def test_stream_keeps_loaded_balances_current(self):
+        balances = Balances()
+        balances.load(self.ACCOUNT)
+        self.assertEqual(balances.held(), {'BTC': Decimal('1.5')})
+        balances.apply(self.delta(110, 'USDT', '50'))
+        balances.apply(self.position(120, 'BTC', '0.25', '0.25'))
+        self.assertEqual(
+            balances.held(), {'BTC': Decimal('0.5'), 'USDT': Decimal(50)})
+
+    def test_delta_is_counted_once_with_its_position(self):
+        balances = Balances()
+        balances.load(self.ACCOUNT)
+        # Position first: it already includes the deposit
+        balances.apply(self.position(111, 'USDT', '50'))
+        balances.apply(self.delta(110, 'USDT', '50'))
+        # Delta first: the position replaces it
+        balances.apply(self.delta(120, 'BTC', '1'))
+        balances.apply(self.position(121, 'BTC', '2', '0.5'))
+        self.assertEqual(
+            balances.held(), {'BTC': Decimal('2.5'), 'USDT': Decimal(50)})
+
+    def test_events_older_than_the_snapshot_are_ignored(self):
+        balances = Balances()
+        balances.load(self.ACCOUNT)
+        balances.apply(self.delta(90, 'BTC', '5'))
+        balances.apply(self.position(100, 'USDT', '7'))
+        self.assertEqual(
+            balances.held(), {'BTC': Decimal('1.5'), 'USDT': Decimal(7)})
+
+
+class PriceCacheTests(SimpleTestCase):
+    PRICES = {'BTCUSDT': Decimal(30000), 'ETHBTC': Decimal('0.05')}
+
+    async def test_prices_are_fetched_once_per_ttl(self):
+        cache = PriceCache(ttl=60)
+        cache.api = mock.AsyncMock(return_value=[
+            {'symbol': 'BTCUSDT', 'price': '30000.00'}])
+        self.assertEqual(await cache.get(), {'BTCUSDT': Decimal(30000)})
+        await cache.get()
+        cache.api.assert_awaited_once_with('/api/v3/ticker/price')
+        cache.expires = 0
+        await cache.get()
+        self.assertEqual(cache.api.await_count, 2)
+
+    def test_value_goes_through_the_bridge(self):
+        cache = PriceCache()
+        self.assertEqual(cache.value(self.PRICES, 'USDT', Decimal(5)), 5)
+        self.assertEqual(
+            cache.value(self.PRICES, 'BTC', Decimal(2)), Decimal(60000))
+        self.assertEqual(
+            cache.value(self.PRICES, 'ETH', Decimal(2)), Decimal(3000))
+        self.assertIsNone(cache.value(self.PRICES, 'XYZ', Decimal(1)))
+
+
+class FormatPortfolioTests(SimpleTestCase):
+    def test_rows_are_sorted_by_value_and_totalled(self):
+        held = {'BTC': Decimal('0.50'), 'XYZ': Decimal(3),
+                'USDT': Decimal('100')}
+        values = {'BTC': Decimal(15000), 'XYZ': None, 'USDT': Decimal(100)}
+        self.assertEqual(format_portfolio(held, values, 'en'), '\n'.join([
+            "Portfolio:",
+            "BTC: 0.5 ≈ 15000.00 USDT",
+            "USDT: 100 ≈ 100.00 USDT",
+            "XYZ: 3 (no price)",
+            "Total ≈ 15100.00 USDT",
+        ]))
+
+    def test_long_and_empty_portfolios(self):
+        self.assertEqual(
+            format_portfolio({}, {}, 'en'), "The account holds no funds.")
+        held = {f'A{number}': Decimal(1) for number in range(32)}
+        lines = format_portfolio(held, {}, 'en').split('\n')
+        self.assertEqual(len(lines), 1 + 30 + 2)
+        self.assertEqual(lines[-2], "…and 2 more")
+
+
+class MetricsTests(SimpleTestCase):
+    def metric(self, kind, *args, **kwargs):
+        metric = kind(*args, **kwargs)
+        self.addCleanup(REGISTRY.remove, metric)
+        return metric
+
+    def test_counter_exposition(self):
+        counter = self.metric(
+            Counter, 'test_total', 'Test calls', labels=('method',))
+        counter.labels('send').inc()
+        counter.labels('edit').inc(2)
+        counter.labels('send').inc()
+        self.assertEqual(counter.render(), '\n'.join([
+            '# HELP test_total Test calls',
+            '# TYPE test_total counter',
+            'test_total{method="edit"} 2',
+            'test_total{method="send"} 2',
+        ]))
+        self.assertIn(counter.render(), render())
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.metric(
+            Histogram, 'test_seconds', 'Test latency',
+            buckets=(.5, 1, float('inf')))
+        for value in (.25, .5, 1, 3):
+            histogram.observe(value)
+        self.assertEqual(histogram.samples(), [
+            'test_seconds_bucket{le="0.5"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 4.75',
+            'test_seconds_count 4',
+        ])
+        labelled = self.metric(
+            Histogram, 'test_labelled_seconds', 'Test latency',
+            labels=('method',), buckets=(float('inf'),))
+        labelled.labels('send').observe(1)
+        self.assertEqual(labelled.samples()[0], (
+            'test_labelled_seconds_bucket{method="send",le="+Inf"} 1'))
+
+
+class JsonFormatterTests(SimpleTestCase):
+    def record(self, **extra):
+        logger = logging.getLogger('bot.test')
+        return logger.makeRecord(
+            'bot.test', logging.WARNING, __file__, 1, "Stream %s",
+            ('closed',), None, extra=extra)
+
+    def test_extra_fields_are_included(self):
+        entry = json.loads(JsonFormatter().format(self.record(
+            chat_id='1', error=ValueError('bad'), label='Счёт')))
+        self.assertEqual(entry['level'], 'WARNING')
+        self.assertEqual(entry['logger'], 'bot.test')
+        self.assertEqual(entry['message'], 'Stream closed')
+        self.assertEqual(
+            (entry['chat_id'], entry['error'], entry['label']),
+            ('1', 'bad', 'Счёт'))
+        self.assertNotIn('args', entry)
+        self.assertNotIn('exception', entry)
+
+    def test_exception_is_formatted(self):
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            record = self.record()
+            record.exc_info = sys.exc_info()
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertIn('ValueError: bad', entry['exception'])
+
+
+class WebhookTests(SimpleTestCase):
+    async def request(self, app, path, method='POST', secret=None):
+        headers = [(b'content-type', b'application/json')]
+        if secret is not None:
+            headers.append((SECRET_HEADER, secret))
+        sent = []
+        body = iter([{'type': 'http.request', 'body': b'{"update_id": 1}'}])
+
+        async def receive():
+            return next(body)
+
+        async def send(message):
+            sent.append(message)
+
+        await app({'type': 'http', 'path': path, 'method': method,
+                   'headers': headers}, receive, send)
+        return sent[0]['status'] if sent else None
+
+    async def test_secret_is_checked(self):
+        inner = mock.AsyncMock()
+        app = BotApplication(inner)
+        app.runtime = mock.Mock()
+        secret = app.secret
+        self.assertEqual(await self.request(app, WEBHOOK_PATH), 403)
+        self.assertEqual(
+            await self.request(app, WEBHOOK_PATH, secret=secret[:-1]), 403)
+        self.assertEqual(
+            await self.request(app, WEBHOOK_PATH, 'GET', secret), 405)
+        self.assertEqual(
+            await self.request(app, WEBHOOK_PATH, secret=secret), 200)
+        app.runtime.bot.process_update.assert_called_once_with(
+            {'update_id': 1})
+
+    async def test_metrics_are_not_served_on_the_webhook_app(self):
+        inner = mock.AsyncMock()
+        await self.request(BotApplication(inner), '/metrics', 'GET')
+        inner.assert_awaited_once()
+
+
+class Frame:
+    def __init__(self, f_locals=None, f_back=None, code=None):
+        self.f_code = code or mock.Mock(spec=['co_name'], co_name='run')
+        self.f_globals = {'__name__': 'bot.example'}
+        self.f_locals = f_locals or {}
+        self.f_back = f_back
+
+
+# Frame whose locals change under the sample
+class BrokenFrame(Frame):
+    @property
+    def f_locals(self):
+        raise RuntimeError("dictionary changed size during iteration")
+
+    @f_locals.setter
+    def f_locals(self, value):
+        pass
+
+
+class ProfilerTests(SimpleTestCase):
+    def test_frame_name_falls_back_to_the_plain_name(self):
+        self.assertEqual(frame_name(Frame()), 'bot.example.run')
+        code = mock.Mock(co_name='run', co_qualname='Worker.run')
+        self.assertEqual(
+            frame_name(Frame(code=code)), 'bot.example.Worker.run')
+
+    def test_frame_account_reads_plain_attributes_only(self):
+        class Account:
+            @property
+            def chat_id(self):
+                raise AssertionError("property read off the loop thread")
+
+        account = Account()
+        account.subscribers = {'7': None}
+        chat = SimpleNamespace(chat_id='5')
+        self.assertEqual(frame_account(Frame({'self': account})), '7')
+        self.assertEqual(frame_account(
+            Frame({'x': 1}, Frame({'account': chat}))), '5')
+        self.assertIsNone(frame_account(Frame({'self': Account()})))
+        # A frame whose locals cannot be read mid-sample
+        self.assertIsNone(
+            frame_account(BrokenFrame(f_back=Frame({'self': chat}))))
+
+
+class FakeMux:
+    def __init__(self):
+        self.routes = {}
+
+    def add(self, stream, callback):
+        self.routes[stream] = callback
+
+    def remove(self, stream):
+        del self.routes[stream]
+
+
+class MarketDataTests(SimpleTestCase):
+    SNAPSHOT = {'lastUpdateId': 10, 'bids': [['99', '1']],
+                'asks': [['101', '1']]}
+
+    def market_data(self):
+        mux = FakeMux()
+        market = MarketData(mux)
+        market.api = mock.AsyncMock(return_value=self.SNAPSHOT)
+        return market, mux
+
+    def rule(self, pk, kind, value, callback=None):
+        return AlertRule('1', callback, pk, 'btcusdt', kind, value)
+
+    async def test_depth_is_only_watched_for_spread_alerts(self):
+        market, mux = self.market_data()
+        market.add_alert(self.rule(1, ABOVE, 110))
+        self.assertEqual([*mux.routes], ['btcusdt@aggTrade'])
+        spread = self.rule(2, SPREAD, 5)
+        market.add_alert(spread)
+        self.assertEqual(
+            [*mux.routes], ['btcusdt@aggTrade', 'btcusdt@depth@100ms'])
+        await wait_until(lambda: market.markets['BTCUSDT'].book.synced)
+        market.api.assert_awaited_once_with(
+            '/api/v3/depth', symbol='BTCUSDT', limit=SNAPSHOT_LIMIT)
+        market.remove_alert(spread)
+        self.assertEqual([*mux.routes], ['btcusdt@aggTrade'])
+        self.assertFalse(market.markets['BTCUSDT'].book.synced)
+
+    async def test_spread_alert_fires_once_on_a_wide_book(self):
+        market, mux = self.market_data()
+        fired = []
+        market.add_alert(self.rule(
+            1, SPREAD, 5, lambda rule, spread: fired.append((rule, spread))))
+        await wait_until(lambda: market.markets['BTCUSDT'].book.synced)
+        depth = mux.routes['btcusdt@depth@100ms']
+        depth({'U': 11, 'u': 11, 'b': [], 'a': [['101', '0'], ['103', '1']]})
+        self.assertEqual(fired, [])
+        depth({'U': 12, 'u': 12, 'b': [['99', '0'], ['98', '1']], 'a': []})
+        [(rule, spread)] = fired
+        self.assertEqual((rule.pk, spread), (1, 5))
+        self.assertEqual(mux.routes, {})
+        self.assertEqual(market.markets, {})
+
+
+class AlertIndexTests(SimpleTestCase):
+    def rule(self, pk, kind, value, reference=None):
+        return AlertRule('1', None, pk, 'btcusdt', kind, value, reference)
+
+    def test_crossed_fires_each_rule_once(self):
+        index = AlertIndex()
+        for rule in [
+                self.rule(1, ABOVE, 110), self.rule(2, ABOVE, 120),
+                self.rule(3, BELOW, 90), self.rule(4, BELOW, 80)]:
+            index.add(rule)
+        self.assertEqual(index.crossed(95, 105), [])
+        fired = index.crossed(85, 115)
+        self.assertEqual(
+            sorted((rule.pk, price) for rule, price in fired),
+            [(1, 115), (3, 85)])
+        self.assertEqual(index.crossed(85, 115), [])
+        self.assertEqual(len(index), 2)
+
+    def test_move_is_armed_by_the_next_price_and_fires_once(self):
+        index = AlertIndex()
+        index.add(self.rule(1, MOVE, 10))
+        self.assertEqual(index.crossed(0, 1000), [])
+        [armed] = index.arm(100)
+        self.assertEqual(armed.reference, 100)
+        self.assertEqual(index.crossed(95, 105), [])
+        [(rule, price)] = index.crossed(85, 115)
+        self.assertEqual((rule.pk, price), (1, 115))
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.sides[False][1], [])
+
+    def test_removed_rule_does_not_fire(self):
+        index = AlertIndex()
+        rule = self.rule(1, ABOVE, 110)
+        index.add(rule)
+        index.remove(rule)
+        self.assertEqual(index.crossed(0, 200), [])
+
+
+class AlertEngineTests(SimpleTestCase):
+    ALERT = {'pk': 7, 'symbol': 'BTCUSDT', 'kind': ABOVE, 'value': 110.0,
+             'reference': None}
+
+    def engine(self):
+        market = mock.Mock()
+        engine = AlertEngine(market)
+        engine.deactivate = mock.AsyncMock()
+        return engine, market
+
+    async def test_fired_alert_waits_for_the_profile_to_drop_it(self):
+        engine, market = self.engine()
+        bot, reported = mock.Mock(), []
+        engine.on_fired = lambda chat_id, pk: reported.append((chat_id, pk))
+        engine.sync('1', [self.ALERT], bot)
+        [[rule], _] = market.add_alert.call_args
+        engine.fire(rule, 115.0)
+        bot.forget_alert.assert_called_once_with('1', 7)
+        self.assertEqual(reported, [('1', 7)])
+        # A profile sent before the alert fired still lists it
+        engine.sync('1', [self.ALERT], bot)
+        self.assertEqual(market.add_alert.call_count, 1)
+        engine.sync('1', [], bot)
+        self.assertEqual(engine.fired, {})
+        self.assertEqual(engine.chats, {})
+
+    async def test_notification_is_in_the_chat_locale(self):
+        engine, market = self.engine()
+        bots = {'1': mock.Mock(), '2': mock.Mock()}
+        bots['1'].locale.return_value = 'en'
+        bots['2'].locale.return_value = 'ru'
+        move = {**self.ALERT, 'pk': 8, 'kind': MOVE, 'value': 5.0,
+                'reference': 100.0}
+        for chat_id, bot in bots.items():
+            engine.sync(chat_id, [self.ALERT, move], bot)
+        for [rule], _ in market.add_alert.call_args_list:
+            engine.fire(rule, 115.0)
+        sent = [
+            call.args for bot in bots.values()
+            for call in bot.outbox.send.call_args_list]
+        self.assertEqual(sent, [
+            ('1', "🔔 BTCUSDT: price 115 ≥ 110"),
+            ('1', "🔔 BTCUSDT: price 115 (+15.00% from 100)"),
+            ('2', "🔔 BTCUSDT: цена 115 ≥ 110"),
+            ('2', "🔔 BTCUSDT: цена 115 (+15.00% от 100)"),
+        ])
+
+    async def test_spread_notification(self):
+        engine, market = self.engine()
+        bot = mock.Mock()
+        bot.locale.return_value = 'en'
+        engine.sync('1', [{**self.ALERT, 'kind': SPREAD, 'value': 5.0}], bot)
+        [[rule], _] = market.add_alert.call_args
+        engine.fire(rule, 6.0)
+        bot.outbox.send.assert_called_once_with(
+            '1', "🔔 BTCUSDT: spread 6 ≥ 5")
+
+
+class MessagesTests(SimpleTestCase):
+    def test_tables_are_loaded_and_compiled_on_first_use(self):
+        with mock.patch.dict(messages.tables, clear=True):
+            self.assertEqual(messages.tables, {})
+            strings = messages.table('en')
+            self.assertEqual([*messages.tables], ['en'])
+            self.assertIs(messages.table('en'), strings)
+            self.assertEqual(strings.templates, {})
+            self.assertEqual(
+                messages.text('alerts.limit', 'en', limit=3),
+                "No more than 3 alerts, delete some first.")
+            self.assertEqual([*strings.templates], ['alerts.limit'])
+
+    def test_unknown_locale_falls_back_to_the_default(self):
+        self.assertEqual(messages.supported('de'), messages.DEFAULT_LOCALE)
+        self.assertEqual(messages.supported(None), messages.DEFAULT_LOCALE)
+        self.assertEqual(messages.supported('en'), 'en')
+        self.assertIs(
+            messages.table('de'), messages.table(messages.DEFAULT_LOCALE))
+        self.assertEqual(
+            messages.text('alerts.none', 'de'),
+            messages.text('alerts.none', messages.DEFAULT_LOCALE))
+
+    def test_render_fields_is_keyed_on_locale_and_shown_fields(self):
+        messages.render_fields.cache_clear()
+        values = {'symbol': 'BTCUSDT', 'side': 'BUY', 'price': 100}
+        english = messages.render('executionReport', values, 'en')
+        # Fields the template does not show share the rendering
+        self.assertEqual(messages.render(
+            'executionReport', {**values, 'unshown': 1}, 'en'), english)
+        russian = messages.render('executionReport', values, 'ru')
+        self.assertNotEqual(english, russian)
+        # An unknown locale shares the default locale's rendering
+        messages.render('executionReport', values, 'de')
+        info = messages.render_fields.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 2))
+
+
+class CoalescerTests(SimpleTestCase):
+    def coalescer(self):
+        outbox = FakeOutbox()
+        return Coalescer(outbox, asyncio.get_running_loop()), outbox
+
+    async def test_folds_events_sharing_a_key(self):
+        coalescer, outbox = self.coalescer()
+        coalescer.push('1', FakeEvent('a', 'k'), window=.01)
+        coalescer.push('1', FakeEvent('b', 'k'), window=.01)
+        coalescer.push('1', FakeEvent('c'), window=.01)
+        coalescer.push('2', FakeEvent('d', 'k'), window=0)
+        self.assertEqual(outbox.sent, [('1', 'c'), ('2', 'd')])
+        await wait_until(lambda: len(outbox.sent) == 3)
+        self.assertEqual(outbox.sent[2], ('1', 'a+b'))
+        self.assertEqual(len(coalescer), 0)
+
+    async def test_flush_all_keeps_the_digest_header(self):
+        coalescer, outbox = self.coalescer()
+        coalescer.push('1', FakeEvent('a', 'k'), digest=True)
+        coalescer.push('1', FakeEvent('b', 'k'), digest=True)
+        coalescer.push('2', FakeEvent('c', 'k'), window=60)
+        coalescer.flush_all()
+        self.assertEqual(outbox.sent, [
+            ('1', messages.text('digest.title', None, count=2)),
+            ('1', 'a+b'), ('2', 'c')])
+        self.assertEqual(coalescer.timers, {})
+        self.assertEqual(coalescer.digests, set())
+
+
+class EventJournalTests(SimpleTestCase):
+    FILL = {
+        'e': 'executionReport', 'E': 1700000000123, 's': 'BTCUSDT',
+        'c': 'web_1', 'S': 'BUY', 'o': 'LIMIT', 'X': 'FILLED', 'x': 'TRADE',
+        'i': 42, 'l': '0.5', 'L': '100', 'n': '0.01', 'N': 'BNB',
+        'T': 1700000000120, 't': 7}
+    TRADE = {
+        'symbol': 'BTCUSDT', 'id': 7, 'orderId': 42, 'price': '100',
+        'qty': '0.5', 'commission': '0.01', 'commissionAsset': 'BNB',
+        'time': 1700000000120, 'isBuyer': True}
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = f'{directory.name}/journal.sqlite3'
+
+    async def test_resynced_fill_is_deduplicated_against_the_stream(self):
+        journal = EventJournal(self.path, 1)
+        try:
+            seq = journal.record('1', self.FILL)
+            self.assertIsNotNone(seq)
+            # Still on its way to the chat
+            self.assertIsNone(journal.record('1', trade_report(self.TRADE)))
+            journal.mark_delivered([seq])
+            self.assertIsNone(journal.record('1', trade_report(self.TRADE)))
+            self.assertIsNotNone(journal.record('2', trade_report(self.TRADE)))
+            other = dict(self.TRADE, id=8)
+            self.assertIsNotNone(journal.record('1', trade_report(other)))
+        finally:
+            journal.flush()
+            journal.db.close()
+
+    async def test_processes_sharing_the_file_do_not_collide(self):
+        frame = {'e': 'balanceUpdate', 'E': 1, 'a': 'BTC', 'd': '1'}
+        with mock.patch('bot.journal.os.getpid', return_value=100):
+            old = EventJournal(self.path, 1)
+            old.record('1', frame)
+        with mock.patch('bot.journal.os.getpid', return_value=200):
+            new = EventJournal(self.path, 1)
+            seq = new.record('2', frame)
+        try:
+            old.flush()
+            new.flush()
+            new.mark_delivered([seq])
+            new.flush()
+            self.assertEqual(len(new), 2)
+            new.reload()
+            self.assertIsNone(new.record('2', frame))
+            self.assertIsNotNone(new.record('1', frame))
+        finally:
+            for journal in (old, new):
+                journal.flush()
+                journal.db.close()
+
+    async def test_other_frames_are_deduplicated_whole(self):
+        journal = EventJournal(self.path, 1)
+        try:
+            frame = {'e': 'outboundAccountPosition', 'E': 1, 'u': 1, 'B': []}
+            journal.mark_delivered([journal.record('1', frame)])
+            self.assertIsNone(journal.record('1', frame))
+            self.assertIsNotNone(journal.record('1', dict(frame, E=2)))
+            journal.flush()
+            self.assertEqual(len(journal), 2)
+        finally:
+            journal.flush()
+            journal.db.close()
+
+
+async def idle(socket):
+    await asyncio.Event().wait()
+
+
+# Sockets never connect; frames are fed to `route` directly
+@mock.patch.object(MultiplexedSocket, 'run', idle)
+class StreamMultiplexerTests(SimpleTestCase):
+    def frame(self, stream, data):
+        return json.dumps({'stream': stream, 'data': data})
+
+    async def test_bad_frame_or_callback_does_not_stop_routing(self):
+        mux = StreamMultiplexer('wss://test')
+        received = []
+
+        def callback(data):
+            if data == 'boom':
+                raise RuntimeError(data)
+            received.append(data)
+        mux.add('a', callback)
+        [socket] = mux.sockets
+        with self.assertLogs('bot.streams', 'WARNING') as logs:
+            mux.route(socket, b'{not json')
+            mux.route(socket, b'[1, 2]')
+            mux.route(socket, self.frame('a', 'boom'))
+        mux.route(socket, self.frame('a', 'ok'))
+        self.assertEqual(received, ['ok'])
+        self.assertEqual(len(logs.records), 3)
+        await mux.close()
+
+    async def test_rebalance_keeps_old_socket_until_confirmed(self):
+        mux = StreamMultiplexer('wss://test', streams_per_socket=2)
+        received = []
+        for stream in 'abc':
+            mux.add(stream, lambda data, stream=stream: received.append(
+                (stream, data)))
+        first, second = mux.sockets
+        self.assertEqual((first.streams, second.streams), ({'a', 'b'}, {'c'}))
+        mux.remove('b')
+        # `a` is subscribed on the second socket, still served by the first
+        self.assertEqual(mux.moving, {'a': first})
+        self.assertIs(mux.owners['a'], second)
+        self.assertIn('a', second.pending['SUBSCRIBE'])
+        mux.route(second, self.frame('a', 'early'))
+        mux.route(first, self.frame('a', 1))
+        second.requests[1] = 'SUBSCRIBE', ['a']  # as sent by `flush`
+        mux.route(second, json.dumps({'result': None, 'id': 1}))
+        self.assertEqual(mux.moving, {})
+        self.assertEqual(mux.sockets, [second])
+        mux.route(first, self.frame('a', 'late'))
+        mux.route(second, self.frame('a', 2))
+        self.assertEqual(received, [('a', 1), ('a', 2)])
+        await wait_until(lambda: first.task.done())
+        await mux.close()
+
+
+class MultiplexedSocketTests(SimpleTestCase):
+    async def test_unexpected_error_is_retried(self):
+        attempts = []
+
+        async def connect(socket):
+            attempts.append(socket)
+            if len(attempts) == 1:
+                raise RuntimeError('boom')
+            await asyncio.Event().wait()
+        with mock.patch.object(MultiplexedSocket, 'connect', connect), \
+                mock.patch('bot.core.Backoff.next', return_value=0), \
+                self.assertLogs('bot.streams', 'ERROR'):
+            socket = MultiplexedSocket(StreamMultiplexer('wss://test'), 1)
+            await wait_until(lambda: len(attempts) == 2)
+        self.assertTrue(socket.alive)
+        socket.close()
+
+
+# Wall clock advanced only by the sleeps of the code under test
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.sleeps.append(round(delay, 3))
+        self.now += delay
+
+
+class WeightBudgetTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock(6000.5)
+        for target, clock in [
+                ('bot.rest.time.time', self.clock.time),
+                ('bot.rest.asyncio.sleep', self.clock.sleep)]:
+            patcher = mock.patch(target, clock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_waits_for_the_next_window_past_the_headroom(self):
+        budget = WeightBudget('api', limit=100)
+        await budget.acquire(50)
+        await budget.acquire(40)
+        self.assertEqual(self.clock.sleeps, [])
+        await budget.acquire(20)
+        self.assertEqual(self.clock.sleeps, [59.5])
+        self.assertEqual(budget.used, 20)
+
+    async def test_used_weight_header_accounts_for_other_processes(self):
+        budget = WeightBudget('api', limit=100)
+        await budget.acquire(10)
+        budget.update(200, {
+            'X-MBX-USED-WEIGHT-1M': '85', 'X-MBX-ORDER-COUNT-10S': '3'})
+        self.assertEqual((budget.used, budget.order_counts), (85, {'10S': 3}))
+        budget.update(200, {'X-MBX-USED-WEIGHT-1M': '5'})
+        self.assertEqual(budget.used, 85)
+        await budget.acquire(10)
+        self.assertEqual(self.clock.sleeps, [59.5])
+
+    async def test_ban_blocks_until_retry_after(self):
+        budget = WeightBudget('api', limit=100)
+        with self.assertLogs('bot.rest', 'WARNING'):
+            budget.update(429, {'Retry-After': '120'})
+        await budget.acquire(1)
+        self.assertEqual(self.clock.sleeps, [120])
+
+    def test_request_weight(self):
+        self.assertEqual(request_weight('/api/v3/depth', {'limit': 5000}), 250)
+        self.assertEqual(request_weight('/api/v3/openOrders', {}), 80)
+        self.assertEqual(request_weight('/api/v3/time', {}), 1)
+
+
+@skipIf(Fernet is None, "cryptography is not installed")
+class VaultTests(SimpleTestCase):
+    def setUp(self):
+        self.old, self.new = Fernet.generate_key().decode(), (
+            Fernet.generate_key().decode())
+
+    def test_seal_and_reveal(self):
+        vault = Vault([self.old])
+        token = vault.seal('secret')
+        self.assertTrue(is_sealed(token))
+        self.assertNotIn('secret', token)
+        self.assertNotEqual(token, vault.seal('secret'))
+        self.assertEqual(vault.seal(token), token)
+        self.assertEqual(vault.reveal(token), 'secret')
+        self.assertEqual(vault.reveal('legacy'), 'legacy')
+        self.assertEqual(vault.fingerprint(token), vault.fingerprint('secret'))
+
+    def test_rotate_rewraps_under_the_current_key(self):
+        token = Vault([self.old]).seal('secret')
+        vault = Vault([self.new, self.old])
+        rotated = vault.rotate(token)
+        self.assertEqual(rotated.split('$')[3], token.split('$')[3])
+        self.assertEqual(vault.rotate(rotated), rotated)
+        self.assertEqual(Vault([self.new]).reveal(rotated), 'secret')
+        self.assertEqual(vault.reveal(vault.rotate('legacy')), 'legacy')
+        with self.assertRaises(VaultError):
+            Vault([self.new]).open(token)
+        with self.assertRaises(VaultError):
+            vault.open('vault1$broken')
+
+    def test_disabled_vault_passes_values_through(self):
+        vault = Vault([])
+        self.assertFalse(vault.enabled)
+        self.assertEqual(vault.seal('secret'), 'secret')
+        self.assertEqual(vault.rotate('secret'), 'secret')
+
+
+class SecretCacheTests(SimpleTestCase):
+    def test_evicted_plaintext_is_zeroed(self):
+        cache = SecretCache(size=1, ttl=60)
+        cache.put('a', 'one')
+        [(_, secret)] = cache.entries.values()
+        cache.put('b', 'two')
+        self.assertEqual(secret, bytearray(3))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 'two')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+class FakeCoalescer:
+    def __init__(self):
+        self.pushed = []
+
+    def push(self, chat_id, event, *args):
+        self.pushed.append((chat_id, event))
+
+
+# Chats sharing a Binance key share its account, listenKey and stream
+@mock.patch.object(MultiplexedSocket, 'run', idle)
+class SharedAccountTests(SimpleTestCase):
+    FILL = {'e': 'executionReport', 'E': 1, 's': 'BTCUSDT', 'x': 'TRADE',
+            'X': 'FILLED', 'i': 1, 't': 1}
+
+    def profile(self, chat_id, notifications=True):
+        return {
+            'telegram_chat_id': chat_id, 'binance_api_key': 'API-KEY',
+            'binance_secret_key': 'SECRET-KEY',
+            'notifications': notifications}
+
+    async def test_chats_share_one_stream_and_frames_fan_out(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with override_settings(
+                BOT_JOURNAL_PATH=f'{directory.name}/journal.sqlite3',
+                BOT_CHECKPOINT_PATH=f'{directory.name}/checkpoint.json'):
+            manager = BinanceAccountsManager(asyncio.Queue())
+        requested = []
+
+        async def get_listen_key(account):
+            requested.append(account)
+            account.listen_key = 'listen-key'
+            return account.listen_key
+        bot = mock.Mock(coalescer=FakeCoalescer())
+        try:
+            with mock.patch.object(
+                    BinanceAccount, 'get_listen_key', get_listen_key):
+                for chat_id, notifications in [
+                        ('1', True), ('2', False), ('3', True)]:
+                    await manager.reconcile(
+                        self.profile(chat_id, notifications), bot,
+                        stored=True)
+            [account] = manager.accounts.values()
+            self.assertEqual(requested, [account])
+            self.assertEqual([*account.subscribers], ['1', '2', '3'])
+            self.assertEqual([*manager.mux.routes], ['listen-key'])
+            account.process_msg(self.FILL)
+            [(first, event), (second, same)] = bot.coalescer.pushed
+            self.assertEqual((first, second), ('1', '3'))
+            self.assertIs(event, same)
+            manager.drop_chat('1')
+            self.assertEqual([*account.subscribers], ['2', '3'])
+            self.assertTrue(account.notifications)
+        finally:
+            await manager.mux.close()
+            manager.journal.flush()
+            manager.journal.db.close()
+
+
+# Frames a chat's filter drops are rejected before any event is built
+class EventFilterTests(SimpleTestCase):
+    BALANCE = {'e': 'balanceUpdate', 'E': 1, 'a': 'BTC', 'd': '1',
+               'T': 1}
+
+    def test_accepts_follows_the_filter(self):
+        self.assertTrue(accepts(FILTER_DEFAULT, 'balanceUpdate'))
+        self.assertFalse(accepts(FILTER_DEFAULT, 'outboundAccountPosition'))
+        self.assertTrue(accepts(FILTER_ORDERS, 'executionReport'))
+        self.assertFalse(accepts(FILTER_ORDERS, 'balanceUpdate'))
+        self.assertTrue(accepts(FILTER_ALL, 'outboundAccountPosition'))
+        self.assertTrue(accepts(FILTER_ALL, 'somethingNew'))
+
+    def test_service_events_pass_every_filter(self):
+        for notification_filter in (FILTER_ALL, FILTER_DEFAULT,
+                                    FILTER_ORDERS):
+            self.assertTrue(
+                accepts(notification_filter, 'listenKeyExpired'))
+
+    def test_unknown_filter_falls_back_to_default(self):
+        self.assertTrue(accepts('bogus', 'balanceUpdate'))
+        self.assertFalse(accepts('bogus', 'outboundAccountPosition'))
+
+    def test_decode_builds_the_event_class(self):
+        self.assertIsInstance(decode(self.BALANCE), BalanceUpdate)
+        self.assertIsInstance(
+            decode({'e': 'executionReport'}, FILTER_ORDERS),
+            ExecutionReport)
+        self.assertIsInstance(
+            decode({'e': 'listenKeyExpired'}, FILTER_ORDERS),
+            ListenKeyExpired)
+        self.assertIsInstance(
+            decode({'e': 'somethingNew'}, FILTER_ALL), UnknownEvent)
+
+    def test_dropped_frames_are_never_built(self):
+        factory = mock.Mock()
+        with mock.patch.dict(EVENT_TYPES, balanceUpdate=factory), \
+                mock.patch('bot.events.UnknownEvent') as unknown:
+            self.assertIsNone(decode(self.BALANCE, FILTER_ORDERS))
+            self.assertIsNone(decode({'e': 'somethingNew'}))
+        factory.assert_not_called()
+        unknown.assert_not_called()
+
+    def test_deliver_skips_chats_filtering_the_frame_out(self):
+        bot = mock.Mock(coalescer=FakeCoalescer())
+        account = BinanceAccount(bot, 'fingerprint', 'API-KEY')
+        account.journal = mock.Mock()
+        account.journal.record.return_value = 1
+        for chat_id, notification_filter in [
+                ('1', FILTER_ORDERS), ('2', FILTER_DEFAULT)]:
+            subscription = account.subscribers[chat_id] = Subscription(
+                chat_id)
+            subscription.notifications = True
+            subscription.notification_filter = notification_filter
+        with mock.patch('bot.binance_utils.decode', wraps=decode) as built:
+            account.deliver(self.BALANCE)
+            account.deliver({'e': 'outboundAccountPosition', 'B': []})
+        built.assert_called_once_with(self.BALANCE, FILTER_ALL)
+        account.journal.record.assert_called_once_with('2', self.BALANCE)
+        [(chat_id, event)] = bot.coalescer.pushed
+        self.assertEqual(chat_id, '2')
+        self.assertIsInstance(event, BalanceUpdate)
+
+
+class ReconcileTests(SimpleTestCase):
+    def profile(self, api_key='API-KEY', notifications=True, alerts=()):
+        return {
+            'telegram_chat_id': '1', 'binance_api_key': api_key,
+            'binance_secret_key': 'SECRET-KEY',
+            'notifications': notifications, 'alerts': alerts}
+
+    async def reconciled(self, *profiles):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with override_settings(
+                BOT_JOURNAL_PATH=f'{directory.name}/journal.sqlite3',
+                BOT_CHECKPOINT_PATH=f'{directory.name}/checkpoint.json'):
+            manager = BinanceAccountsManager(asyncio.Queue())
+        manager.alerts.sync = mock.Mock()
+        requested = []
+
+        async def get_listen_key(account):
+            requested.append(account.fingerprint)
+            account.listen_key = f'listen-key-{len(requested)}'
+            return account.listen_key
+        bot = mock.Mock(coalescer=FakeCoalescer())
+        bot.outbox.send.side_effect = lambda chat_id, text: told.append(text)
+        told = []
+        try:
+            with mock.patch.object(
+                    BinanceAccount, 'get_listen_key', get_listen_key):
+                for profile in profiles:
+                    await manager.reconcile(profile, bot, stored=True)
+        finally:
+            await manager.mux.close()
+            manager.journal.flush()
+            manager.journal.db.close()
+        return manager, requested, told
+
+    async def test_key_change_moves_the_chat_to_the_new_account(self):
+        manager, requested, told = await self.reconciled(
+            self.profile(), self.profile('NEW-KEY'))
+        [account] = manager.accounts.values()
+        self.assertEqual(requested, [
+            get_vault().fingerprint('API-KEY'), account.fingerprint])
+        self.assertEqual([*manager.chats['1']], [account.fingerprint])
+        self.assertEqual([*manager.mux.routes], ['listen-key-2'])
+        opened, closed = (
+            messages.text(key) for key in ('stream.opened', 'stream.closed'))
+        self.assertEqual(told, [opened, closed, opened])
+
+    async def test_alert_change_leaves_the_stream_alone(self):
+        alerts = ({'pk': 1, 'symbol': 'BTCUSDT', 'kind': ABOVE,
+                   'value': 1.0, 'reference': None},)
+        manager, requested, told = await self.reconciled(
+            self.profile(), self.profile(alerts=alerts))
+        self.assertEqual(len(requested), 1)
+        self.assertEqual(told, [messages.text('stream.opened')])
+        self.assertEqual(
+            manager.alerts.sync.call_args_list[-1].args[:2], ('1', alerts))
+
+    async def test_notifications_off_closes_the_stream(self):
+        manager, requested, told = await self.reconciled(
+            self.profile(), self.profile(notifications=False))
+        [account] = manager.accounts.values()
+        self.assertFalse(account.notifications)
+        self.assertEqual(manager.mux.routes, {})
+        self.assertEqual(told, [
+            messages.text('stream.opened'), messages.text('stream.closed')])
+        # Turning them back on opens a new stream
+        manager, requested, told = await self.reconciled(
+            self.profile(notifications=False), self.profile())
+        self.assertEqual(len(requested), 1)
+        self.assertEqual(told, [messages.text('stream.opened')])
+
+    async def test_queued_updates_collapse_per_chat(self):
+        queue = asyncio.Queue()
+        manager = BinanceAccountsManager.__new__(BinanceAccountsManager)
+        manager.queue = queue
+        bot = object()
+        for chat_id, version, stored in [
+                ('1', 1, True), ('2', 1, True), ('1', 2, False),
+                ('1', 3, True)]:
+            queue.put_nowait((
+                {'telegram_chat_id': chat_id, 'version': version}, bot,
+                stored))
+        pending = manager.drain_queue(queue.get_nowait())
+        self.assertEqual(pending, {
+            '1': ({'telegram_chat_id': '1', 'version': 3}, bot, False),
+            '2': ({'telegram_chat_id': '2', 'version': 1}, bot, True),
+        })
+        self.assertTrue(queue.empty())
+        await asyncio.wait_for(queue.join(), 1)
+
+
+class CheckpointsTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = f'{directory.name}/checkpoint.json'
+
+    def write(self, name, pid, owner, accounts=None, version=1):
+        with open(self.path.replace('checkpoint', name), 'w') as file:
+            json.dump({
+                'version': version, 'pid': pid, 'owner': owner,
+                'saved': 0, 'accounts': accounts or {}}, file)
+
+    @mock.patch('bot.checkpoint.process_alive', lambda pid: pid != 4)
+    def test_running_skips_this_process_and_its_siblings(self):
+        me, coordinator = os.getpid(), os.getpid() + 1000
+        self.write('checkpoint-0', me, coordinator)
+        self.write('checkpoint-1', 2, coordinator)  # sibling shard
+        self.write('checkpoint-2', 3, 1)  # previous deploy
+        self.write('checkpoint-3', 4, 1)  # previous deploy, exited
+        self.write('checkpoint-4', 5, 1, version=0)
+        checkpoints = Checkpoints(self.path)
+        self.assertEqual(checkpoints.running(coordinator), {3})
+        self.assertEqual(checkpoints.running(), {2, 3})
+        self.assertEqual(checkpoints.owners, {coordinator, 1})
+
+    def test_priority_puts_recently_active_chats_first(self):
+        self.write('checkpoint', 1, 1, {
+            'a': ['key-a', 0, 100, 1, ['1', '2']],
+            'b': ['key-b', 0, 300, 1, ['3', '1']],
+            'c': ['key-c', 0, None, 2, ['4']]})
+        checkpoints = Checkpoints(self.path)
+        self.assertEqual(len(checkpoints), 3)
+        self.assertEqual(checkpoints.priority(), ['3', '1', '2', '4'])
+        self.assertFalse(checkpoints.accounts['a'].valid)
+
+    def test_listen_keys_are_saved_sealed(self):
+        manager = mock.Mock(is_shard=False)
+        manager.account_states.side_effect = lambda: iter([(
+            'a', AccountState('key-a', time.time() + 3600, 1, 0, ['1']))])
+        checkpointer = Checkpointer(manager, self.path)
+        with mock.patch('bot.vault.vault', Vault([
+                Fernet.generate_key().decode()])):
+            checkpointer.write()
+            with open(self.path) as file:
+                sealed = json.load(file)['accounts']['a'][0]
+            self.assertTrue(is_sealed(sealed))
+            self.assertEqual(
+                checkpointer.snapshot()['accounts']['a'][0], sealed)
+            state = Checkpoints(self.path).accounts['a']
+            self.assertEqual(state.listen_key, 'key-a')
+            self.assertTrue(state.valid)
+        # Under another master key the listenKey is renewed instead
+        with mock.patch('bot.vault.vault', Vault([
+                Fernet.generate_key().decode()])):
+            state = Checkpoints(self.path).accounts['a']
+        self.assertIsNone(state.listen_key)
+        self.assertFalse(state.valid)
+
+
+# Manager stand-in exporting one row per chat id
+class FakeManager:
+    def __init__(self, *chat_ids):
+        self.chat_ids = chat_ids
+
+    def status_rows(self):
+        for chat_id in self.chat_ids:
+            yield (chat_id, '', 'fp', 'streaming', 1, None, None, 0, None,
+                   0, None)
+
+    def status_summary(self):
+        return {'accounts': 1, 'chats': len(self.chat_ids), 'sockets': 1,
+                'outbox': 0}
+
+
+class StatusExportTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = f'{directory.name}/status.sqlite3'
+
+    async def export(self, pid, *chat_ids):
+        with mock.patch('bot.status.os.getpid', return_value=pid):
+            export = StatusExport(FakeManager(*chat_ids), 'main', self.path, 5)
+        export.write(*await export.collect())
+        return export
+
+    async def test_processes_sharing_a_name_keep_their_own_rows(self):
+        old = await self.export(100, '1', '2')
+        new = await self.export(200, '2')
+        query = StatusQuery(self.path)
+        self.assertEqual(
+            [(process['process'], process['pid'])
+             for process in query.processes()], [('main', 100), ('main', 200)])
+        self.assertEqual(query.count(), 3)
+        # Rewriting or removing only touches the writer's own rows
+        new.write(*await new.collect())
+        old.remove()
+        self.assertEqual(
+            [(row['pid'], row['chat_id']) for row in query[0:10]],
+            [(200, '2')])
+        new.remove()
+        self.assertEqual(query.processes(), [])
+
+
+# Restart while the previous process is still delivering from the journal
+@mock.patch.object(MultiplexedSocket, 'run', idle)
+class HandoverTests(SimpleTestCase):
+    PROFILE = {
+        'telegram_chat_id': '1', 'binance_api_key': 'API-KEY',
+        'binance_secret_key': 'SECRET-KEY', 'notifications': True}
+
+    def frame(self, delta):
+        return {'e': 'balanceUpdate', 'E': 1, 'a': 'BTC', 'd': delta}
+
+    async def test_journal_is_replayed_once_the_previous_process_exits(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = f'{directory.name}/journal.sqlite3'
+        with mock.patch('bot.journal.os.getpid', return_value=100):
+            old = EventJournal(path, 1)
+        with override_settings(
+                BOT_JOURNAL_PATH=path,
+                BOT_CHECKPOINT_PATH=f'{directory.name}/checkpoint.json'):
+            manager = BinanceAccountsManager(asyncio.Queue())
+
+        async def get_listen_key(account):
+            account.listen_key = 'listen-key'
+            return account.listen_key
+        bot = mock.Mock(coalescer=FakeCoalescer())
+        try:
+            with mock.patch('bot.journal.os.getpid', return_value=100):
+                delivered = old.record('1', self.frame('1'))
+                pending = old.record('1', self.frame('2'))
+            old.flush()
+            manager.holding = True
+            with mock.patch.object(
+                    BinanceAccount, 'get_listen_key', get_listen_key):
+                await manager.reconcile(self.PROFILE, bot, stored=True)
+            self.assertEqual(bot.coalescer.pushed, [])
+            # Still running, the previous process delivers what it had
+            # pending and journals one more frame before it exits
+            with mock.patch('bot.journal.os.getpid', return_value=100):
+                old.mark_delivered([delivered, pending])
+                old.record('1', self.frame('3'))
+            old.flush()
+            await manager.take_over(set())
+            self.assertEqual(
+                [event.delta for _, event in
+                 bot.coalescer.pushed], ['3'])
+            self.assertFalse(manager.holding)
+        finally:
+            await manager.mux.close()
+            for journal in (old, manager.journal):
+                journal.flush()
+                journal.db.close()
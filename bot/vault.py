@@ -0,0 +1,172 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = InvalidToken = None
+
+PREFIX = 'vault1'
+SEPARATOR = '$'
+
+
+class VaultError(Exception):
+    pass
+
+
+def key_id(key):
+    return hashlib.sha256(key.encode()).hexdigest()[:8]
+
+
+def is_sealed(value):
+    return bool(value) and value.startswith(PREFIX + SEPARATOR)
+
+
+# Decrypted secrets by ciphertext, least recently used first. Plaintexts are
+# kept in bytearrays that are overwritten with zeros when they expire or
+# are evicted; the `str` handed to callers is theirs to drop.
+class SecretCache:
+    def __init__(self, size, ttl):
+        self.size, self.ttl = size, ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, secret = entry
+            if expires < time.monotonic():
+                self.evict(token)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return secret.decode()
+
+    def put(self, token, plaintext):
+        with self.lock:
+            if token in self.entries:
+                self.evict(token)
+            self.entries[token] = (
+                time.monotonic() + self.ttl, bytearray(plaintext.encode()))
+            while len(self.entries) > self.size:
+                self.evict(next(iter(self.entries)))
+
+    def discard(self, token):
+        with self.lock:
+            if token in self.entries:
+                self.evict(token)
+
+    def evict(self, token):
+        expires, secret = self.entries.pop(token)
+        secret[:] = bytes(len(secret))
+
+    def clear(self):
+        with self.lock:
+            for token in [*self.entries]:
+                self.evict(token)
+
+
+# Envelope encryption of Binance credentials: every value gets its own data
+# key, and only that data key is encrypted with a master key from
+# `BOT_VAULT_KEYS`. Sealed values read `vault1$<master key id>$<wrapped data
+# key>$<ciphertext>`, so rotating the master key only rewraps data keys.
+# The first master key seals; the others are kept to open older values.
+# Values without the prefix are legacy plaintext and are returned as is.
+class Vault:
+    def __init__(self, keys=None, cache_size=None, cache_ttl=None):
+        keys = settings.BOT_VAULT_KEYS if keys is None else keys
+        if keys and Fernet is None:
+            raise ImproperlyConfigured(
+                "BOT_VAULT_KEYS is set but `cryptography` is not installed")
+        self.keys = {key_id(key): Fernet(key) for key in keys}
+        self.current = key_id(keys[0]) if keys else None
+        self.cache = SecretCache(
+            cache_size or settings.BOT_VAULT_CACHE_SIZE,
+            cache_ttl or settings.BOT_VAULT_CACHE_TTL)
+
+    @property
+    def enabled(self):
+        return self.current is not None
+
+    def seal(self, plaintext):
+        if not self.enabled or not plaintext or is_sealed(plaintext):
+            return plaintext
+        data_key = Fernet.generate_key()
+        return SEPARATOR.join([
+            PREFIX, self.current,
+            self.keys[self.current].encrypt(data_key).decode(),
+            Fernet(data_key).encrypt(plaintext.encode()).decode()])
+
+    def split(self, token):
+        try:
+            prefix, kid, wrapped, ciphertext = token.split(SEPARATOR)
+        except ValueError:
+            raise VaultError("Malformed sealed value")
+        master = self.keys.get(kid)
+        if master is None:
+            raise VaultError(f"Unknown master key {kid}")
+        return kid, master, wrapped, ciphertext
+
+    def open(self, token):
+        kid, master, wrapped, ciphertext = self.split(token)
+        try:
+            data_key = master.decrypt(wrapped.encode())
+            return Fernet(data_key).decrypt(ciphertext.encode()).decode()
+        except InvalidToken:
+            raise VaultError(f"Sealed value does not match key {kid}")
+
+    # Plaintext of a stored value, decrypted at most once per cache lifetime
+    def reveal(self, token):
+        if not is_sealed(token):
+            return token
+        plaintext = self.cache.get(token)
+        if plaintext is None:
+            plaintext = self.open(token)
+            self.cache.put(token, plaintext)
+        return plaintext
+
+    # Identity of a stored value whether it is sealed or not, and under
+    # whichever master key; chats sharing a Binance key are matched by it
+    def fingerprint(self, token):
+        return hashlib.sha256(self.reveal(token).encode()).hexdigest()[:16]
+
+    # The value sealed under the current master key: legacy plaintext is
+    # sealed, values under an older key get their data key rewrapped
+    def rotate(self, token):
+        if not self.enabled or not token:
+            return token
+        if not is_sealed(token):
+            return self.seal(token)
+        kid, master, wrapped, ciphertext = self.split(token)
+        if kid == self.current:
+            return token
+        try:
+            data_key = master.decrypt(wrapped.encode())
+        except InvalidToken:
+            raise VaultError(f"Sealed value does not match key {kid}")
+        return SEPARATOR.join([
+            PREFIX, self.current,
+            self.keys[self.current].encrypt(data_key).decode(), ciphertext])
+
+
+vault = None
+
+
+def get_vault():
+    global vault
+    if vault is None:
+        vault = Vault()
+    return vault
@@ -1,3 +1,56 @@
-from django.shortcuts import render
+from datetime import datetime, timezone
 
-# Create your views here.
+from django.contrib import admin
+from django.core.paginator import Paginator
+from django.template.response import TemplateResponse
+from django.utils.http import urlencode
+
+from .status import COLUMNS, ORDERINGS, STATES, StatusQuery
+
+PAGE_SIZE = 100
+FILTERS = ('state', 'process', 'q', 'o')
+
+
+def timestamp(seconds):
+    if seconds is None:
+        return None
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+
+# Live state exported by the running bot processes (see `bot.status`),
+# filtered and paginated in SQL; read-only, and never reaches the bot
+def status(request):
+    filters = {
+        name: request.GET[name] for name in FILTERS if request.GET.get(name)}
+    query = StatusQuery(
+        state=filters.get('state'), process=filters.get('process'),
+        search=filters.get('q', '').strip(), ordering=filters.get('o'))
+    page = Paginator(query, PAGE_SIZE).get_page(request.GET.get('p'))
+    rows = [{
+        **row,
+        'last_event': timestamp(
+            row['last_event'] and row['last_event'] / 1000),
+        'expires': timestamp(row['expires']),
+    } for row in page.object_list]
+    processes = [{
+        **process,
+        'started': timestamp(process['started']),
+        'updated': timestamp(process['updated']),
+    } for process in StatusQuery().processes()]
+    ordering = filters.get('o', '')
+    states = StatusQuery().states()
+    return TemplateResponse(request, 'admin/bot/status.html', {
+        **admin.site.each_context(request),
+        'title': 'Bot status',
+        'page': page,
+        'rows': rows,
+        'columns': [
+            (name, name in ORDERINGS and (
+                f'-{name}' if ordering == name else name))
+            for name in COLUMNS],
+        'processes': processes,
+        'states': [(state, states.get(state, 0)) for state in STATES],
+        'filters': filters,
+        'query': urlencode({
+            name: value for name, value in filters.items() if name != 'o'}),
+    })
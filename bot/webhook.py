@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import hmac
+import json
+
+from django.conf import settings
+
+from .runtime import BotRuntime
+
+WEBHOOK_PATH = '/telegram/webhook/'
+SECRET_HEADER = b'x-telegram-bot-api-secret-token'
+
+
+def webhook_secret():
+    return settings.TELEGRAM_WEBHOOK_SECRET or hashlib.sha256(
+        settings.TELEGRAM_BOT_TOKEN.encode()).hexdigest()[:32]
+
+
+# Wraps the Django ASGI application: runs the bot on the server's event loop
+# (started and stopped through the lifespan protocol) and feeds Telegram
+# webhook requests straight into its dispatcher. Metrics stay off this
+# public app, on the runtime's own `MetricsServer` port.
+class BotApplication:
+    def __init__(self, app):
+        self.app = app
+        self.runtime = None
+        self.secret = webhook_secret().encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['path'] == WEBHOOK_PATH:
+            return await self.webhook(scope, receive, send)
+        return await self.app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.runtime = BotRuntime(
+                    asyncio.get_running_loop(),
+                    webhook=(
+                        settings.TELEGRAM_WEBHOOK_URL.rstrip('/')
+                        + WEBHOOK_PATH,
+                        self.secret.decode(),
+                    ),
+                    metrics_port=settings.BOT_METRICS_PORT)
+                await self.runtime.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.runtime:
+                    await self.runtime.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def webhook(self, scope, receive, send):
+        headers = dict(scope['headers'])
+        if scope['method'] != 'POST':
+            status = 405
+        elif not hmac.compare_digest(
+                headers.get(SECRET_HEADER, b''), self.secret):
+            status = 403
+        elif self.runtime is None:
+            status = 503
+        else:
+            body = b''
+            more_body = True
+            while more_body:
+                message = await receive()
+                body += message.get('body', b'')
+                more_body = message.get('more_body', False)
+            self.runtime.bot.process_update(json.loads(body))
+            status = 200
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'text/plain')],
+        })
+        await send({'type': 'http.response.body', 'body': b''})